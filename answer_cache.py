@@ -0,0 +1,129 @@
+import json
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+import numpy as np
+
+
+class LRUCache:
+    """
+    Ordered dict with a size limit and a time-to-live. Entries are stored with the index
+    generation they were computed against and are dropped once the index moves on.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def get(self, key, generation):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        value, created, entry_generation = entry
+        if entry_generation != generation or (self.ttl and time.monotonic() - created > self.ttl):
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value, generation):
+        self.entries[key] = (value, time.monotonic(), generation)
+        self.entries.move_to_end(key)
+        while self.max_entries and len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def items(self, generation):
+        """Live (key, value) pairs, dropping expired and stale entries on the way."""
+        now = time.monotonic()
+        for key, (value, created, entry_generation) in list(self.entries.items()):
+            if entry_generation != generation or (self.ttl and now - created > self.ttl):
+                del self.entries[key]
+            else:
+                yield key, value
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class AnswerCache:
+    """
+    Layered cache in front of the chat chain:
+
+    1. exact: normalized standalone question (and search filters) -> answer
+    2. semantic: closest stored question embedding above a cosine threshold -> answer
+    3. retrieval: query embedding -> top-k documents, so a new wording of a known question
+       at least skips the Chroma search
+
+    Every entry carries the index generation it was computed against, so re-indexing
+    invalidates all of them.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self.answers = LRUCache(config.answer_cache_max_entries, config.answer_cache_ttl)
+        self.retrievals = LRUCache(config.answer_cache_max_entries, config.answer_cache_ttl)
+        self.counts = Counter()
+
+    @staticmethod
+    def normalize(question):
+        return re.sub(r'\s+', ' ', question).strip().strip('?!.').strip().lower()
+
+    @staticmethod
+    def filters_key(filters):
+        return json.dumps(filters, sort_keys=True, default=str) if filters else ''
+
+    @classmethod
+    def vector_key(cls, embedding, k, filters=None):
+        return np.asarray(embedding, dtype=np.float32).tobytes(), k, cls.filters_key(filters)
+
+    def get_exact(self, question, generation, filters=None):
+        with self.lock:
+            entry = self.answers.get((self.normalize(question), self.filters_key(filters)), generation)
+            self.counts['exact_hits' if entry else 'exact_misses'] += 1
+            return entry[1] if entry else None
+
+    def get_similar(self, embedding, generation, filters=None):
+        """The cached answer (under the same filters) whose question embedding is closest, if it clears the threshold."""
+        filters_key = self.filters_key(filters)
+        with self.lock:
+            entries = [value for key, value in self.answers.items(generation) if key[1] == filters_key]
+            best = None
+            if entries:
+                matrix = np.array([vector for vector, _ in entries], dtype=np.float32)
+                query = np.asarray(embedding, dtype=np.float32)
+                norms = np.linalg.norm(matrix, axis=1) * (np.linalg.norm(query) or 1.0)
+                scores = matrix @ query / np.where(norms == 0, 1.0, norms)
+                index = int(np.argmax(scores))
+                if scores[index] >= self.config.answer_cache_similarity:
+                    best = entries[index][1]
+            self.counts['semantic_hits' if best is not None else 'semantic_misses'] += 1
+            return best
+
+    def put_answer(self, question, embedding, answer, generation, filters=None):
+        with self.lock:
+            key = (self.normalize(question), self.filters_key(filters))
+            self.answers.put(key, (np.asarray(embedding, dtype=np.float32), answer), generation)
+
+    def get_documents(self, embedding, k, generation, filters=None):
+        with self.lock:
+            docs = self.retrievals.get(self.vector_key(embedding, k, filters), generation)
+            self.counts['retrieval_hits' if docs is not None else 'retrieval_misses'] += 1
+            return docs
+
+    def put_documents(self, embedding, k, docs, generation, filters=None):
+        with self.lock:
+            self.retrievals.put(self.vector_key(embedding, k, filters), docs, generation)
+
+    def stats(self):
+        with self.lock:
+            stats = {}
+            for layer in ('exact', 'semantic', 'retrieval'):
+                hits, misses = self.counts[f"{layer}_hits"], self.counts[f"{layer}_misses"]
+                stats[f"{layer}_hits"], stats[f"{layer}_misses"] = hits, misses
+                stats[f"{layer}_hit_rate"] = hits / (hits + misses) if hits + misses else 0.0
+            stats['answers'] = len(self.answers)
+            stats['retrievals'] = len(self.retrievals)
+            return stats
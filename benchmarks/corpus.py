@@ -0,0 +1,247 @@
+import io
+import random
+import zipfile
+from xml.sax.saxutils import escape
+
+
+DOCX_MIME_TYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+XLSX_MIME_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+PPTX_MIME_TYPE = 'application/vnd.openxmlformats-officedocument.presentationml.presentation'
+PDF_MIME_TYPE = 'application/pdf'
+GOOGLE_DOC_MIME_TYPE = 'application/vnd.google-apps.document'
+GOOGLE_SHEET_MIME_TYPE = 'application/vnd.google-apps.spreadsheet'
+GOOGLE_SLIDES_MIME_TYPE = 'application/vnd.google-apps.presentation'
+
+# File kinds the corpus can generate; 'png' stands for a file type that is not indexed
+FORMATS = ('pdf', 'docx', 'gdoc', 'gsheet', 'gslides', 'xlsx', 'pptx', 'csv', 'md', 'txt', 'html', 'png')
+
+
+def make_docx(paragraphs):
+    """A minimal DOCX file with one paragraph per string."""
+    body = ''.join(
+        f'<w:p><w:r><w:t xml:space="preserve">{escape(paragraph)}</w:t></w:r></w:p>' for paragraph in paragraphs
+    )
+    document = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+        f'<w:body>{body}</w:body></w:document>'
+    )
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as docx:
+        docx.writestr(
+            '[Content_Types].xml',
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/word/document.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+            '</Types>'
+        )
+        docx.writestr('word/document.xml', document)
+    return buffer.getvalue()
+
+
+def make_package(parts):
+    """A zip package (DOCX/XLSX/PPTX) from part name -> XML string."""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as package:
+        for name, xml in parts.items():
+            package.writestr(name, '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>' + xml)
+    return buffer.getvalue()
+
+
+def relationships(targets):
+    return (
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        + ''.join(f'<Relationship Id="rId{i + 1}" Target="{target}"/>' for i, target in enumerate(targets))
+        + '</Relationships>'
+    )
+
+
+def make_xlsx(sheets):
+    """A minimal XLSX workbook from sheet name -> rows of cell strings (inline strings, no shared table)."""
+    main = 'xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"'
+    r = 'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships"'
+    parts = {
+        'xl/workbook.xml': f'<workbook {main} {r}><sheets>' + ''.join(
+            f'<sheet name="{escape(name)}" sheetId="{i + 1}" r:id="rId{i + 1}"/>' for i, name in enumerate(sheets)
+        ) + '</sheets></workbook>',
+        'xl/_rels/workbook.xml.rels': relationships(f"worksheets/sheet{i + 1}.xml" for i in range(len(sheets)))
+    }
+    for i, rows in enumerate(sheets.values()):
+        parts[f'xl/worksheets/sheet{i + 1}.xml'] = f'<worksheet {main}><sheetData>' + ''.join(
+            f'<row r="{n + 1}">' + ''.join(
+                f'<c r="{chr(65 + c)}{n + 1}" t="inlineStr"><is><t>{escape(value)}</t></is></c>'
+                for c, value in enumerate(row)
+            ) + '</row>' for n, row in enumerate(rows)
+        ) + '</sheetData></worksheet>'
+    return make_package(parts)
+
+
+def make_pptx(slides):
+    """A minimal PPTX deck from (title, lines) slides."""
+    p = 'xmlns:p="http://schemas.openxmlformats.org/presentationml/2006/main"'
+    a = 'xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main"'
+    r = 'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships"'
+
+    def shape(kind, lines):
+        placeholder = f'<p:ph type="{kind}"/>' if kind else ''
+        return (f'<p:sp><p:nvSpPr><p:cNvPr id="1" name=""/><p:cNvSpPr/><p:nvPr>{placeholder}</p:nvPr></p:nvSpPr>'
+                '<p:txBody>' + ''.join(f'<a:p><a:r><a:t>{escape(line)}</a:t></a:r></a:p>' for line in lines)
+                + '</p:txBody></p:sp>')
+
+    parts = {
+        'ppt/presentation.xml': f'<p:presentation {p} {r}><p:sldIdLst>' + ''.join(
+            f'<p:sldId id="{256 + i}" r:id="rId{i + 1}"/>' for i in range(len(slides))
+        ) + '</p:sldIdLst></p:presentation>',
+        'ppt/_rels/presentation.xml.rels': relationships(f"slides/slide{i + 1}.xml" for i in range(len(slides)))
+    }
+    for i, (title, lines) in enumerate(slides):
+        parts[f'ppt/slides/slide{i + 1}.xml'] = (
+            f'<p:sld {p} {a}><p:cSld><p:spTree>{shape("title", [title])}{shape(None, lines)}</p:spTree></p:cSld></p:sld>'
+        )
+    return make_package(parts)
+
+
+def make_pdf(pages):
+    """A minimal PDF with one page of Helvetica text per list of lines."""
+    def pdf_string(text):
+        return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+    objects = []
+    page_ids = []
+    font_id = 3
+    next_id = 4
+    for lines in pages:
+        stream = 'BT /F1 10 Tf 12 TL 50 780 Td ' + ' '.join(f'({pdf_string(line)}) Tj T*' for line in lines) + ' ET'
+        page_id, content_id = next_id, next_id + 1
+        next_id += 2
+        page_ids.append(page_id)
+        objects.append((page_id, f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] '
+                                 f'/Resources << /Font << /F1 {font_id} 0 R >> >> /Contents {content_id} 0 R >>'))
+        objects.append((content_id, f'<< /Length {len(stream)} >>\nstream\n{stream}\nendstream'))
+    objects.append((1, '<< /Type /Catalog /Pages 2 0 R >>'))
+    objects.append((2, f'<< /Type /Pages /Kids [{" ".join(f"{i} 0 R" for i in page_ids)}] /Count {len(page_ids)} >>'))
+    objects.append((font_id, '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>'))
+    objects.sort()
+
+    out = io.BytesIO()
+    out.write(b'%PDF-1.4\n')
+    offsets = {}
+    for object_id, body in objects:
+        offsets[object_id] = out.tell()
+        out.write(f'{object_id} 0 obj\n{body}\nendobj\n'.encode('latin-1'))
+    xref = out.tell()
+    out.write(f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'.encode('latin-1'))
+    for object_id in range(1, len(objects) + 1):
+        out.write(f'{offsets[object_id]:010d} 00000 n \n'.encode('latin-1'))
+    out.write(f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n'.encode('latin-1'))
+    return out.getvalue()
+
+
+class SyntheticCorpus:
+    """
+    Deterministic generator of files made of pseudo-words, with headings and identifiers
+    (invoice numbers, code names) mixed in so lexical search has something to find. formats
+    picks the kinds of file generated, in rotation (see FORMATS); Google Docs, Sheets and
+    Slides carry every export the fake Drive may be asked for. A duplicates fraction of files are
+    "Copy of" an earlier file with one line per page changed, like the versions that pile up in a Drive.
+    """
+
+    SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'ti', 'vo', 'qu', 'ze', 'ar', 'en', 'is', 'ol', 'um', 'dra', 'ple']
+
+    def __init__(self, pages=3, lines_per_page=40, words_per_line=12, vocabulary=2000, seed=0,
+                 formats=('pdf', 'docx', 'gdoc'), duplicates=0.0):
+        self.formats = formats
+        self.duplicates = duplicates
+        self.pages = pages
+        self.lines_per_page = lines_per_page
+        self.words_per_line = words_per_line
+        rng = random.Random(seed)
+        self.vocabulary = sorted({
+            ''.join(rng.choice(self.SYLLABLES) for _ in range(rng.randint(2, 4))) for _ in range(vocabulary)
+        })
+        self.count = 0
+        # Pages of every original file, for copies to be made of
+        self.documents = []
+        self.copies = 0
+        # Identifiers written into documents, for exact-match retrieval checks
+        self.identifiers = []
+
+    def line(self, rng):
+        words = [rng.choice(self.vocabulary) for _ in range(self.words_per_line)]
+        if rng.random() < 0.05:
+            identifier = f"INV-{rng.randint(10000, 99999)}"
+            self.identifiers.append(identifier)
+            words.insert(rng.randrange(len(words)), identifier)
+        return ' '.join(words)
+
+    def page(self, rng):
+        lines = [f"# {' '.join(rng.choice(self.vocabulary) for _ in range(3)).title()}"]
+        lines.extend(self.line(rng) for _ in range(self.lines_per_page - 1))
+        return lines
+
+    def next_file(self, rng):
+        """Return (name, content, mime type) for the next synthetic file; content is bytes, or export MIME type -> bytes."""
+        self.count += 1
+        kind = self.formats[(self.count - 1) % len(self.formats)]
+        name = f"{kind}_{self.count:05d}"
+        if kind == 'png':
+            # No text, so no identifiers to look for
+            return f"{name}.png", b'\x89PNG\r\n\x1a\n' + bytes(rng.getrandbits(8) for _ in range(2048)), 'image/png'
+        if self.duplicates and self.documents and rng.random() < self.duplicates:
+            pages = [list(page) for page in rng.choice(self.documents)]
+            for page in pages:
+                page[rng.randrange(1, len(page))] = self.line(rng)
+            self.copies += 1
+            name, content, mime_type = self.make_file(kind, name, pages)
+            return f"Copy of {name}", content, mime_type
+        pages = [self.page(rng) for _ in range(self.pages)]
+        if self.duplicates:
+            self.documents.append(pages)
+        return self.make_file(kind, name, pages)
+
+    def make_file(self, kind, name, pages):
+        """(name, content, mime type) of a file of the given kind with the given pages of lines."""
+        paragraphs = [line for page in pages for line in page]
+        # Pages as titled slides, sheets of (line number, text) rows, or Markdown sections
+        slides = [(page[0].lstrip('# '), page[1:]) for page in pages]
+        sheets = {page[0].lstrip('# '): [['Line', 'Text']] + [[str(n + 1), line] for n, line in enumerate(page[1:])]
+                  for page in pages}
+        text = '\n\n'.join('\n\n'.join(page) for page in pages)
+        if kind == 'pdf':
+            return f"report_{self.count:05d}.pdf", make_pdf(pages), PDF_MIME_TYPE
+        if kind == 'docx':
+            return f"notes_{self.count:05d}.docx", make_docx(paragraphs), DOCX_MIME_TYPE
+        if kind == 'gdoc':
+            # Exported by FakeDrive as DOCX, Markdown or plain text, like a real Google Doc
+            return f"doc_{self.count:05d}", {
+                DOCX_MIME_TYPE: make_docx(paragraphs),
+                'text/markdown': text.encode('utf-8'),
+                'text/plain': '\n\n'.join(line.lstrip('# ') for line in paragraphs).encode('utf-8')
+            }, GOOGLE_DOC_MIME_TYPE
+        if kind == 'gsheet':
+            return name, {XLSX_MIME_TYPE: make_xlsx(sheets)}, GOOGLE_SHEET_MIME_TYPE
+        if kind == 'gslides':
+            return name, {PPTX_MIME_TYPE: make_pptx(slides)}, GOOGLE_SLIDES_MIME_TYPE
+        if kind == 'xlsx':
+            return f"{name}.xlsx", make_xlsx(sheets), XLSX_MIME_TYPE
+        if kind == 'pptx':
+            return f"{name}.pptx", make_pptx(slides), PPTX_MIME_TYPE
+        if kind == 'csv':
+            rows = [['Line', 'Text']] + [[str(n + 1), line] for n, line in enumerate(paragraphs)]
+            return f"{name}.csv", '\n'.join(f'{n},"{line}"' for n, line in rows).encode('utf-8'), 'text/csv'
+        if kind == 'md':
+            return f"{name}.md", text.encode('utf-8'), 'text/markdown'
+        if kind == 'txt':
+            # No extension: stored under the one its MIME type implies
+            return name, text.encode('utf-8'), 'text/plain'
+        if kind == 'html':
+            body = ''.join(f"<h2>{escape(line.lstrip('# '))}</h2>" if line.startswith('#') else f"<p>{escape(line)}</p>"
+                           for line in paragraphs)
+        return f"{name}.html", f"<html><head><title>{name}</title></head><body>{body}</body></html>".encode('utf-8'), 'text/html'
+
+    def questions(self, count, seed=1):
+        """Queries made of corpus words, for retrieval latency measurements."""
+        rng = random.Random(seed)
+        return [' '.join(rng.choice(self.vocabulary) for _ in range(rng.randint(2, 6))) for _ in range(count)]
@@ -0,0 +1,221 @@
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from email.parser import FeedParser
+from urllib.parse import parse_qs, unquote, urlparse
+import httplib2
+from googleapiclient.discovery import build
+from google_drive import GoogleDrive
+
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+
+class FakeDrive:
+    """
+    In-memory Drive: a tree of folders and files with contents, plus a change log for the Changes API.
+    """
+
+    def __init__(self, latency=0.0, bytes_per_second=None):
+        self.latency = latency
+        self.bytes_per_second = bytes_per_second
+        self.lock = threading.Lock()
+        self.items = {}
+        self.content = {}
+        self.changes = []
+        self.requests = 0
+        self.root_id = self.new_id('root')
+        self.items[self.root_id] = {'id': self.root_id, 'name': 'My Drive', 'mimeType': FOLDER_MIME_TYPE, 'parents': []}
+
+    def new_id(self, prefix):
+        return f"{prefix}{len(self.items):06d}"
+
+    def add_folder(self, name, parent_id):
+        folder_id = self.new_id('folder')
+        self.put({'id': folder_id, 'name': name, 'mimeType': FOLDER_MIME_TYPE, 'parents': [parent_id]})
+        return folder_id
+
+    def add_file(self, name, parent_id, content, mime_type):
+        file_id = self.new_id('file')
+        self.put({'id': file_id, 'name': name, 'mimeType': mime_type, 'parents': [parent_id]}, content)
+        return file_id
+
+    def put(self, item, content=None):
+        """Add or update an item, recording a change."""
+        with self.lock:
+            item['modifiedTime'] = f"2024-01-01T00:00:{len(self.changes) % 60:02d}.{len(self.changes):06d}Z"
+            if content is not None:
+                self.content[item['id']] = content
+                if not isinstance(content, dict):
+                    item['size'] = str(len(content))
+                    item['md5Checksum'] = hashlib.md5(content).hexdigest()
+            self.items[item['id']] = item
+            self.changes.append({'fileId': item['id'], 'removed': False, 'file': dict(item)})
+
+    def remove(self, item_id):
+        with self.lock:
+            self.items.pop(item_id)
+            self.content.pop(item_id, None)
+            self.changes.append({'fileId': item_id, 'removed': True})
+
+    def files(self):
+        return [item for item in self.items.values() if item['mimeType'] != FOLDER_MIME_TYPE]
+
+    def folders(self):
+        return [item for item in self.items.values() if item['mimeType'] == FOLDER_MIME_TYPE and item['parents']]
+
+    def handle(self, method, path, params, headers):
+        """Serve one Drive v3 REST call. Returns (status, headers, body bytes)."""
+        with self.lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        if path == '/drive/v3/files':
+            match = re.match(r"'([^']+)' in parents", params.get('q', ''))
+            parent_id = self.root_id if match.group(1) == 'root' else match.group(1)
+            children = sorted(
+                (item for item in list(self.items.values()) if parent_id in item['parents']),
+                key=lambda item: item['id']
+            )
+            offset = int(params.get('pageToken') or 0)
+            page_size = int(params.get('pageSize') or 100)
+            response = {'files': children[offset:offset + page_size]}
+            if offset + page_size < len(children):
+                response['nextPageToken'] = str(offset + page_size)
+            return self.json(response)
+
+        if path == '/drive/v3/changes/startPageToken':
+            return self.json({'startPageToken': str(len(self.changes))})
+
+        if path == '/drive/v3/changes':
+            offset = int(params['pageToken'])
+            page_size = int(params.get('pageSize') or 100)
+            changes = self.changes[offset:offset + page_size]
+            response = {'changes': changes}
+            if offset + page_size < len(self.changes):
+                response['nextPageToken'] = str(offset + page_size)
+            else:
+                response['newStartPageToken'] = str(len(self.changes))
+            return self.json(response)
+
+        match = re.match(r'^/drive/v3/files/([^/]+)(/export)?$', path)
+        if match:
+            file_id = self.root_id if match.group(1) == 'root' else unquote(match.group(1))
+            if file_id not in self.items:
+                return 404, {'content-type': 'application/json'}, b'{"error": {"code": 404}}'
+            if params.get('alt') != 'media' and not match.group(2):
+                return self.json(self.items[file_id])
+            content = self.content[file_id]
+            if isinstance(content, dict):
+                # Google Workspace files: one body per export MIME type
+                if params.get('mimeType') not in content:
+                    return 400, {'content-type': 'application/json'}, b'{"error": {"code": 400}}'
+                content = content[params['mimeType']]
+            return self.media(content, headers)
+
+        return 404, {'content-type': 'application/json'}, b'{"error": {"code": 404}}'
+
+    def json(self, response):
+        return 200, {'content-type': 'application/json'}, json.dumps(response).encode('utf-8')
+
+    def media(self, content, headers):
+        """Serve a (ranged) media download the way MediaIoBaseDownload requests it."""
+        range_header = (headers or {}).get('range') or (headers or {}).get('Range')
+        start, end = 0, len(content) - 1
+        if range_header:
+            match = re.match(r'bytes=(\d+)-(\d*)', range_header)
+            start = int(match.group(1))
+            end = min(int(match.group(2)) if match.group(2) else end, len(content) - 1)
+        body = content[start:end + 1]
+        if self.bytes_per_second:
+            time.sleep(len(body) / self.bytes_per_second)
+        return 206, {
+            'content-type': 'application/octet-stream',
+            'content-range': f"bytes {start}-{end}/{len(content)}",
+            'content-length': str(len(body))
+        }, body
+
+
+class FakeHttp:
+    """
+    httplib2.Http stand-in that routes googleapiclient requests, including batch requests, to a FakeDrive.
+    """
+
+    def __init__(self, drive):
+        self.drive = drive
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=None, connection_type=None):
+        parsed = urlparse(uri)
+        if parsed.path.startswith('/batch/'):
+            return self.batch(body, headers)
+        params = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+        status, response_headers, content = self.drive.handle(method, parsed.path, params, headers)
+        return httplib2.Response({'status': status, **response_headers}), content
+
+    def batch(self, body, headers):
+        """Answer a multipart/mixed batch request part by part."""
+        parser = FeedParser()
+        parser.feed(f"content-type: {headers['content-type']}\r\n\r\n{body}")
+        message = parser.close()
+        boundary = 'fake_batch_boundary'
+        parts = []
+        for part in message.get_payload():
+            request_line = part.get_payload().split('\n', 1)[0].strip()
+            method, target, _ = request_line.split(' ', 2)
+            parsed = urlparse(target)
+            params = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+            status, _, content = self.drive.handle(method, parsed.path, params, {})
+            content_id = part['Content-ID']
+            parts.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\n"
+                f"Content-ID: <response-{content_id[1:]}\r\n\r\n"
+                f"HTTP/1.1 {status} OK\r\nContent-Type: application/json\r\n\r\n"
+                f"{content.decode('utf-8')}\r\n"
+            )
+        response_body = ''.join(parts) + f"--{boundary}--"
+        return httplib2.Response({
+            'status': 200, 'content-type': f"multipart/mixed; boundary={boundary}"
+        }), response_body.encode('utf-8')
+
+
+class FakeGoogleDrive(GoogleDrive):
+    """
+    GoogleDrive talking to a FakeDrive through the real googleapiclient request code.
+    """
+
+    def __init__(self, config, drive):
+        self.drive = drive
+        super().__init__(config)
+
+    def authenticate(self):
+        self.creds = None
+        self.service = self.new_service()
+
+    def new_service(self):
+        return build('drive', 'v3', http=FakeHttp(self.drive), cache_discovery=False, static_discovery=True)
+
+
+def generate_drive(corpus, depth=3, folders_per_level=3, files_per_folder=5, latency=0.0,
+                   bytes_per_second=None, seed=0):
+    """
+    Build a FakeDrive with a regular tree: folders_per_level subfolders per folder down to depth,
+    and files_per_folder files from the corpus generator in every folder.
+    """
+    rng = random.Random(seed)
+    drive = FakeDrive(latency=latency, bytes_per_second=bytes_per_second)
+    frontier = [drive.root_id]
+    for level in range(depth + 1):
+        next_frontier = []
+        for parent_id in frontier:
+            for _ in range(files_per_folder):
+                name, content, mime_type = corpus.next_file(rng)
+                drive.add_file(name, parent_id, content, mime_type)
+            if level < depth:
+                for index in range(folders_per_level):
+                    next_frontier.append(drive.add_folder(f"Folder {level}-{len(next_frontier)}", parent_id))
+        frontier = next_frontier
+    return drive
@@ -0,0 +1,41 @@
+import hashlib
+import math
+import re
+import time
+from typing import List
+from langchain_core.embeddings import Embeddings
+
+
+class HashEmbeddings(Embeddings):
+    """
+    Deterministic local embeddings: hashed bag of words, L2-normalized.
+
+    Texts that share words get similar vectors, so retrieval behaves plausibly without
+    calling an embedding API. An optional per-request latency simulates the network.
+    """
+
+    def __init__(self, dimensions=256, latency=0.0):
+        self.dimensions = dimensions
+        self.latency = latency
+        self.model = f"hash-{dimensions}"
+        self.requests = 0
+        self.texts = 0
+
+    def vector(self, text):
+        vector = [0.0] * self.dimensions
+        for word in re.findall(r'\w+', text.lower()):
+            digest = hashlib.md5(word.encode('utf-8')).digest()
+            index = int.from_bytes(digest[:4], 'little') % self.dimensions
+            vector[index] += 1.0 if digest[4] & 1 else -1.0
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+        return [value / norm for value in vector]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.requests += 1
+        self.texts += len(texts)
+        if self.latency:
+            time.sleep(self.latency)
+        return [self.vector(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
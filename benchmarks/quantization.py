@@ -0,0 +1,150 @@
+"""
+Recall vs. memory of the compact vector storage modes, against exact float32 search and Chroma.
+
+Run from the repository root:
+
+    python -m benchmarks.quantization --vectors 20000 --dimensions 1536 --output quantization.json
+
+Vectors are synthetic: clustered, with variance decaying across dimensions the way it does in real
+embeddings, so truncating to a prefix (vector_dimensions) behaves roughly as it does for Matryoshka
+models. Recall@k is measured against exact cosine top-k. Everything runs in a temporary directory.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import chromadb
+import numpy as np
+from compact_vectors import CompactVectors, normalize
+from config_file import Config
+
+
+def synthetic_vectors(count, dimensions, clusters, rng):
+    centers = rng.standard_normal((clusters, dimensions))
+    points = centers[rng.integers(clusters, size=count)] + 0.6 * rng.standard_normal((count, dimensions))
+    decay = np.exp(-np.arange(dimensions) / (dimensions / 4))
+    return normalize(points * decay)
+
+
+def recall(found, truth):
+    return float(np.mean([len(set(f) & set(t)) / len(t) for f, t in zip(found, truth)]))
+
+
+def directory_bytes(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def measure(search, queries, truth, k):
+    samples, found = [], []
+    for query in queries:
+        start = time.perf_counter()
+        found.append(search(query))
+        samples.append((time.perf_counter() - start) * 1000)
+    return {
+        f'recall@{k}': round(recall(found, truth), 4),
+        'p50_ms': round(float(np.percentile(samples, 50)), 2),
+        'p95_ms': round(float(np.percentile(samples, 95)), 2)
+    }
+
+
+def run(args):
+    rng = np.random.default_rng(args.seed)
+    vectors = synthetic_vectors(args.vectors, args.dimensions, args.clusters, rng)
+    queries = synthetic_vectors(args.queries, args.dimensions, args.clusters, np.random.default_rng(args.seed))
+    ids = [f"chunk-{i:08d}" for i in range(args.vectors)]
+    k = args.k
+    truth = [[ids[i] for i in np.argsort(-(vectors @ query))[:k]] for query in queries]
+    results = {'parameters': vars(args)}
+
+    results['exact_float32'] = measure(
+        lambda query: [ids[i] for i in np.argpartition(-(vectors @ query), k)[:k]], queries, truth, k
+    )
+    results['exact_float32']['memory_bytes_per_vector'] = args.dimensions * 4
+
+    if not args.skip_chroma:
+        client = chromadb.PersistentClient('chroma_bench')
+        collection = client.get_or_create_collection('quantization_bench', metadata={'hnsw:space': 'cosine'})
+        start = time.perf_counter()
+        for i in range(0, args.vectors, 5000):
+            collection.add(ids=ids[i:i + 5000], embeddings=vectors[i:i + 5000].tolist())
+        build = time.perf_counter() - start
+        results['chroma'] = measure(
+            lambda query: collection.query(query_embeddings=[query.tolist()], n_results=k, include=[])['ids'][0],
+            queries, truth, k
+        )
+        results['chroma']['build_seconds'] = round(build, 2)
+        results['chroma']['disk_bytes_per_vector'] = round(directory_bytes('chroma_bench') / args.vectors, 1)
+
+    for mode, dimensions, subvectors in args.variants:
+        for rescore in (0, args.rescore_candidates):
+            config = Config()
+            config.vector_storage = mode
+            config.vector_store_directory = f"vectors_{mode}_{dimensions}_{subvectors}_{rescore}"
+            config.vector_dimensions = dimensions or None
+            config.pq_subvectors = subvectors
+            config.rescore_candidates = rescore
+            store = CompactVectors(config)
+            start = time.perf_counter()
+            for i in range(0, args.vectors, args.batch_size):
+                store.add(ids[i:i + args.batch_size], vectors[i:i + args.batch_size])
+            build = time.perf_counter() - start
+            name = f"{mode}" + (f"_pq{subvectors}" if mode == 'pq' else '') + (f"_d{dimensions}" if dimensions else '')
+            name += f"_rescore{rescore}" if rescore else '_no_rescore'
+            results[name] = measure(lambda query: [i for i, _ in store.search(query, k)], queries, truth, k)
+            stats = store.stats()
+            results[name]['build_seconds'] = round(build, 2)
+            results[name]['memory_bytes_per_vector'] = round(stats['compact_bytes'] / stats['vectors'], 1)
+            results[name]['disk_bytes_per_vector'] = round(directory_bytes(config.vector_store_directory) / stats['vectors'], 1)
+            print(f"{name}: {results[name]}", file=sys.stderr)
+    return results
+
+
+def variant(text):
+    """mode[:dimensions[:subvectors]], e.g. int8, int8:512, pq:0:96"""
+    parts = text.split(':')
+    return parts[0], int(parts[1]) if len(parts) > 1 else 0, int(parts[2]) if len(parts) > 2 else 96
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--vectors', type=int, default=20000)
+    parser.add_argument('--dimensions', type=int, default=1536)
+    parser.add_argument('--clusters', type=int, default=200)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=1000, help='vectors per add, as in upsert batches')
+    parser.add_argument('--rescore-candidates', type=int, default=100)
+    parser.add_argument('--variants', type=variant, nargs='+',
+                        default=[variant(v) for v in ('int8', 'int8:512', 'pq:0:96', 'pq:0:192', 'pq:512:64')],
+                        help='storage variants as mode[:dimensions[:pq subvectors]]')
+    parser.add_argument('--skip-chroma', action='store_true', help='skip the Chroma HNSW baseline')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='also write the JSON report to this file')
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    workdir = tempfile.mkdtemp(prefix='rag_quant_')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        results = run(args)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    results['parameters']['variants'] = [':'.join(map(str, v)) for v in args.variants]
+    report = json.dumps(results, indent=2)
+    print(report)
+    if output:
+        with open(output, 'w') as f:
+            f.write(report)
+
+
+if __name__ == '__main__':
+    main()
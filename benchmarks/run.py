@@ -0,0 +1,391 @@
+"""
+Ingest and query benchmark against a fake Drive and a local embedding function.
+
+Run from the repository root:
+
+    python -m benchmarks.run --depth 3 --folders-per-level 3 --files-per-folder 5 --output bench.json
+
+Every stage runs in a fresh temporary directory, so nothing touches your real download
+directory, metadata, ledger or Chroma collection. Results are printed as JSON.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from benchmarks.corpus import FORMATS, SyntheticCorpus
+from benchmarks.fake_drive import FakeGoogleDrive, generate_drive
+from benchmarks.fake_embeddings import HashEmbeddings
+from config_file import Config
+from embedding_backends import LocalEmbeddings
+from gradio_interface import GradioInterface
+from instrumentation import configure, metrics
+from near_duplicates import MinHasher
+from sharded_index import ShardedChroma, make_index
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux; parse workers are counted as children
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return {'self': round(own, 1), 'children': round(children, 1)}
+
+
+def timed(results, name, function, count=None, unit=None):
+    start = time.perf_counter()
+    value = function()
+    seconds = time.perf_counter() - start
+    results[name] = {'seconds': round(seconds, 3)}
+    if count is not None:
+        results[name][unit] = count(value) if callable(count) else count
+        results[name][f"{unit}_per_sec"] = round(results[name][unit] / seconds, 2) if seconds else None
+    print(f"{name}: {results[name]}", file=sys.stderr)
+    return value
+
+
+def latencies(function, queries):
+    samples = []
+    for query in queries:
+        start = time.perf_counter()
+        function(query)
+        samples.append((time.perf_counter() - start) * 1000)
+    return {
+        'queries': len(samples),
+        'p50_ms': round(percentile(samples, 0.50), 2),
+        'p95_ms': round(percentile(samples, 0.95), 2)
+    }
+
+
+def collections(chroma):
+    """The Chroma collections of an index: its shards, or itself."""
+    return list(chroma.shards.values()) if isinstance(chroma, ShardedChroma) else [chroma]
+
+
+def chunk_stats(chroma):
+    """Size of the indexed chunks in tokens: what each query puts in front of the LLM, and what was embedded."""
+    documents = [text for collection in collections(chroma)
+                 for text in collection.db._collection.get(include=['documents'])['documents']]
+    tokens = [len(chroma.encoder.encode(text, disallowed_special=())) for text in documents]
+    return {'chunks': len(tokens), 'total_tokens': sum(tokens),
+            'mean_tokens': round(sum(tokens) / len(tokens), 1) if tokens else None,
+            'p95_tokens': percentile(tokens, 0.95), 'max_tokens': max(tokens, default=None)}
+
+
+def identifier_recall(search, identifiers, k=5):
+    """Share of identifier queries whose top-k results contain the identifier."""
+    found = sum(any(identifier in doc.page_content for doc in search(identifier, k)) for identifier in identifiers)
+    return round(found / len(identifiers), 3) if identifiers else None
+
+
+def redundant_results(search, queries, signature, k=5, threshold=0.5):
+    """Mean number of top-k results per query that nearly repeat (MinHash Jaccard >= threshold) a better one."""
+    redundant = 0
+    for query in queries:
+        kept = []
+        for doc in search(query, k):
+            current = signature(doc.page_content)
+            redundant += any((current == other).mean() >= threshold for other in kept)
+            kept.append(current)
+    return round(redundant / len(queries), 3) if queries else None
+
+
+def answer_context(chroma, gradio, questions, identifiers, signature, k=5):
+    """
+    What the answer prompt gets per question: the plain top-k chunks whole (as the chat used to send them), the
+    reranker's chunks whole, and the reranker's chunks compressed. Reports context tokens, distinct files and
+    near-repeats among the chunks, the share of question words and of identifier queries' identifiers the
+    context still contains, and the time to choose and assemble it.
+    """
+    config, reranker, compressor = gradio.config, gradio.reranker, gradio.compressor
+    compression = config.context_compression
+    results = {}
+    for name in ('top_k', 'reranked', 'compressed'):
+        tokens = files = redundant = covered = kept = 0
+        samples = []
+        for question in questions + identifiers:
+            embedding = chroma.embeddings.embed_query(question)
+            start = time.perf_counter()
+            if name == 'top_k':
+                docs = chroma.search(question, k=k, embedding=embedding)
+                context = "\n\n".join(doc.page_content for doc in docs)
+            else:
+                candidates = chroma.search(question, k=config.retrieval_candidates, embedding=embedding)
+                docs = reranker.select(question, candidates, chroma.cached_vectors(candidates))
+                config.context_compression = name == 'compressed'
+                context = compressor.context(question, docs)
+            samples.append((time.perf_counter() - start) * 1000)
+            if question in identifiers:
+                kept += question in context
+                continue
+            tokens += compressor.count(context)
+            files += len({doc.metadata.get('source') for doc in docs})
+            terms = question.split()
+            covered += sum(term in context for term in terms) / len(terms)
+            previous = []
+            for doc in docs:
+                current = signature(doc.page_content)
+                redundant += any((current == other).mean() >= 0.5 for other in previous)
+                previous.append(current)
+        count = len(questions) or 1
+        results[name] = {'mean_tokens': round(tokens / count, 1), 'mean_files': round(files / count, 2),
+                         'mean_redundant': round(redundant / count, 3),
+                         'question_words_kept': round(covered / count, 3),
+                         'identifiers_kept': round(kept / len(identifiers), 3) if identifiers else None,
+                         'p50_ms': round(percentile(samples, 0.50), 2), 'p95_ms': round(percentile(samples, 0.95), 2)}
+    config.context_compression = compression
+    return results
+
+
+def query_embedding(embeddings, questions, users):
+    """
+    Query embedding latency without the embedding cache: one question at a time, and users questions at once
+    """
+    results = {'sequential': latencies(embeddings.embed_query, questions)}
+    samples = []
+
+    async def ask(question):
+        start = time.perf_counter()
+        await embeddings.aembed_query(question)
+        samples.append((time.perf_counter() - start) * 1000)
+
+    async def main():
+        for offset in range(0, len(questions), users):
+            await asyncio.gather(*(ask(question) for question in questions[offset:offset + users]))
+
+    asyncio.run(main())
+    results['concurrent'] = {'users': users, 'p50_ms': round(percentile(samples, 0.50), 2),
+                             'p95_ms': round(percentile(samples, 0.95), 2)}
+    return results
+
+
+def concurrent_chat(gradio, questions, users):
+    """
+    Split the questions over simulated users who ask one after another while the users run concurrently.
+    Every question opens a new session: the fake LLM would condense follow-ups into one and the same question. Reports time to first token, full-answer latency and overall throughput.
+    """
+    first_token, total = [], []
+
+    async def ask(request, question):
+        start = time.perf_counter()
+        ttft = None
+        async for partial in gradio.chat(question, [], request=request):
+            if ttft is None and partial:
+                ttft = (time.perf_counter() - start) * 1000
+        first_token.append(ttft)
+        total.append((time.perf_counter() - start) * 1000)
+
+    async def session(index):
+        for number, question in enumerate(questions[index::users]):
+            await ask(SimpleNamespace(session_hash=f"bench-user-{index}-{number}"), question)
+
+    async def main():
+        await asyncio.gather(*(session(index) for index in range(users)))
+
+    start = time.perf_counter()
+    asyncio.run(main())
+    seconds = time.perf_counter() - start
+    return {
+        'users': users,
+        'queries': len(total),
+        'ttft_p50_ms': round(percentile(first_token, 0.50), 2),
+        'ttft_p95_ms': round(percentile(first_token, 0.95), 2),
+        'p50_ms': round(percentile(total, 0.50), 2),
+        'p95_ms': round(percentile(total, 0.95), 2),
+        'queries_per_sec': round(len(total) / seconds, 2) if seconds else None
+    }
+
+
+def long_session(gradio, questions):
+    """
+    Ask every question as follow-ups in one session and report how large the history sent with each turn got.
+    """
+    request = SimpleNamespace(session_hash='bench-long-session')
+
+    async def main():
+        for question in questions:
+            async for _ in gradio.chat(question, [], request=request):
+                pass
+
+    asyncio.run(main())
+    stats = gradio.memory_for(request.session_hash).stats()
+    prompt_tokens = stats.pop('prompt_tokens')
+    stats['turns'] = len(questions)
+    stats['max_prompt_history_tokens'] = max(prompt_tokens, default=0)
+    return stats
+
+
+def run(args):
+    corpus = SyntheticCorpus(pages=args.pages, lines_per_page=args.lines_per_page, seed=args.seed,
+                             formats=args.formats.split(','), duplicates=args.duplicates)
+    drive = generate_drive(
+        corpus, depth=args.depth, folders_per_level=args.folders_per_level,
+        files_per_folder=args.files_per_folder, latency=args.drive_latency_ms / 1000,
+        bytes_per_second=args.drive_mbps * 1024 * 1024 if args.drive_mbps else None, seed=args.seed
+    )
+    config = Config()
+    config.chunker = args.chunker
+    config.near_duplicate_dedup = not args.no_dedup
+    config.shard_by = args.shard_by
+    config.reranker_model = args.reranker
+    config.reranker_budget_ms = args.reranker_budget_ms
+    config.log_format = args.log_format
+    config.profile_stages = [stage for stage in args.profile.split(',') if stage]
+    config.profile_directory = args.profile_directory or config.profile_directory
+    configure(config)
+    results = {
+        'parameters': vars(args),
+        'drive': {'files': len(drive.files()), 'folders': len(drive.folders()),
+                  # Google Workspace files count at their largest export
+                  'bytes': sum(len(content) if isinstance(content, bytes) else max(map(len, content.values()))
+                               for content in drive.content.values())}
+    }
+
+    # Sync stages
+    gd = FakeGoogleDrive(config, drive)
+    drive_map = timed(results, 'crawl', gd.map_drive_structure, lambda m: len(m['files']) + len(m['folders']), 'items')
+    results['crawl']['requests'] = drive.requests
+    timed(results, 'download', lambda: gd.download_files(drive_map, config.downloaded_files_path),
+          len(drive_map['files']), 'files')
+    gd.save_metadata()
+
+    # Ingest stages
+    if args.local_embeddings:
+        config.embedding_backend = 'local'
+        config.local_embedding_model = args.local_embeddings
+        embeddings = LocalEmbeddings(config)
+    else:
+        embeddings = HashEmbeddings(dimensions=args.dimensions, latency=args.embed_latency_ms / 1000)
+    chroma = make_index(config, embeddings=embeddings)
+    if not args.shard_by:
+        timed(results, 'get_documents', chroma.get_documents, len, 'pages')
+    timed(results, 'process_and_store', chroma.process_and_store, lambda _: chroma.count(), 'chunks')
+    results['process_and_store']['embedding_requests'] = metrics.value('rag_embedding_requests_total', outcome='ok')
+    results['chunk_sizes'] = chunk_stats(chroma)
+    results['drive']['copies'] = corpus.copies
+    if config.near_duplicate_dedup:
+        stats = [collection.dedup.stats() for collection in collections(chroma)]
+        results['near_duplicates'] = {key: sum(shard[key] for shard in stats) for key in stats[0]} if stats else {}
+    if args.shard_by:
+        results['shards'] = {'shards': len(chroma.shards),
+                             'chunks': sorted(shard.count() for shard in chroma.shards.values())}
+
+    # Query stages
+    questions = corpus.questions(args.queries, seed=args.seed + 1)
+    results['query_embedding'] = query_embedding(embeddings, questions, args.users)
+    # Embed the questions first, so both retrieval passes measure search alone
+    for question in questions:
+        chroma.embeddings.embed_query(question)
+    results['retrieval'] = latencies(lambda question: chroma.search(question, k=5), questions)
+    results['redundant_results@5'] = redundant_results(chroma.search, questions, MinHasher().signature)
+    identifiers = random.Random(args.seed).sample(corpus.identifiers, min(args.queries, len(corpus.identifiers)))
+    results['identifier_recall@5'] = {'hybrid': identifier_recall(chroma.search, identifiers)}
+    # Shards search with copies of the config
+    for collection in [chroma] + collections(chroma):
+        collection.config.hybrid_search = False
+    results['retrieval_dense_only'] = latencies(lambda question: chroma.search(question, k=5), questions)
+    results['identifier_recall@5']['dense'] = identifier_recall(chroma.search, identifiers)
+    for collection in [chroma] + collections(chroma):
+        collection.config.hybrid_search = True
+    # One top-level folder's worth of the Drive: a single shard when sharding by folder
+    folder = next(iter(chroma.catalog.directories()), None)
+    if folder:
+        folder = folder.split(os.sep)[0]
+        results['retrieval_folder_filter'] = latencies(
+            lambda question: chroma.search(question, k=5, filters={'folder': folder}), questions)
+        results['retrieval_folder_filter']['folder'] = folder
+    llm = FakeListChatModel(responses=["This is a benchmark answer streamed one character at a time."],
+                            sleep=args.llm_token_ms / 1000)
+    gradio = GradioInterface(config, chroma, llm=llm)
+    if args.reranker:
+        # Measure with the model loaded, not the questions that skip it while it loads
+        gradio.reranker.load()
+        gradio.reranker.loading.join()
+    results['answer_context'] = answer_context(chroma, gradio, questions, identifiers, MinHasher().signature)
+    results['chat'] = concurrent_chat(gradio, questions, args.users)
+    # Same questions again, in new sessions: served from the answer cache
+    gradio.sessions.clear()
+    results['chat_repeated'] = concurrent_chat(gradio, questions, args.users)
+    results['chat_cache'] = gradio.cache.stats()
+    results['chat_memory'] = long_session(gradio, questions)
+
+    results['stages'] = metrics.stages()
+    results['peak_rss_mb'] = peak_rss_mb()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--depth', type=int, default=2, help='folder levels below My Drive')
+    parser.add_argument('--folders-per-level', type=int, default=3, help='subfolders in every folder')
+    parser.add_argument('--files-per-folder', type=int, default=4, help='files in every folder')
+    parser.add_argument('--pages', type=int, default=3, help='pages per document')
+    parser.add_argument('--lines-per-page', type=int, default=40)
+    parser.add_argument('--formats', default='pdf,docx,gdoc',
+                        help=f"comma-separated file kinds, generated in rotation, from {','.join(FORMATS)}")
+    parser.add_argument('--drive-latency-ms', type=float, default=20.0, help='simulated latency per Drive request')
+    parser.add_argument('--drive-mbps', type=float, default=0, help='simulated download bandwidth per request (0: unlimited)')
+    parser.add_argument('--embed-latency-ms', type=float, default=50.0, help='simulated latency per embedding request')
+    parser.add_argument('--dimensions', type=int, default=256, help='embedding dimensions')
+    parser.add_argument('--local-embeddings', metavar='MODEL',
+                        help='embed with this sentence-transformers model on CPU instead of the simulated API')
+    parser.add_argument('--duplicates', type=float, default=0.0,
+                        help='share of files that are a "Copy of" an earlier one with one line per page changed')
+    parser.add_argument('--no-dedup', action='store_true', help='index near-duplicate chunks separately')
+    parser.add_argument('--shard-by', help="split the index into shards by 'folder' (top-level) or a metadata key")
+    parser.add_argument('--chunker', default=Config.chunker, help="'token', 'character' or a chunker class path")
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--users', type=int, default=8, help='concurrent chat sessions')
+    parser.add_argument('--llm-token-ms', type=float, default=5.0, help='simulated delay per streamed LLM token')
+    parser.add_argument('--reranker', help='local cross-encoder to rerank chat retrieval with (sentence-transformers name or path)')
+    parser.add_argument('--reranker-budget-ms', type=float, default=Config.reranker_budget_ms,
+                        help='reranking time budget per question')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--log-format', choices=['text', 'json'], default='text', help='format of the progress log (stderr)')
+    parser.add_argument('--profile', default='', help='comma-separated stages to run under cProfile (e.g. parse,split,upsert)')
+    parser.add_argument('--profile-directory', help='where the .prof files go (default: profiles/ in the working directory)')
+    parser.add_argument('--output', help='also write the JSON report to this file')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary working directory')
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    if args.profile_directory:
+        args.profile_directory = os.path.abspath(args.profile_directory)
+    workdir = tempfile.mkdtemp(prefix='rag_bench_')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        results = run(args)
+    finally:
+        os.chdir(cwd)
+        if args.keep:
+            print(f"Working directory kept at {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = json.dumps(results, indent=2)
+    print(report)
+    if output:
+        with open(output, 'w') as f:
+            f.write(report)
+
+
+if __name__ == '__main__':
+    main()
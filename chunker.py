@@ -0,0 +1,152 @@
+import importlib
+import re
+from typing import NamedTuple, Optional
+from langchain.schema import Document
+from langchain.text_splitter import CharacterTextSplitter
+
+# The same header pattern enhance_document_metadata takes a page title from
+HEADING_PATTERN = re.compile(r'^#+\s+(.+)$')
+PARAGRAPH_BREAK = re.compile(r'\n\s*\n')
+SENTENCE_BREAK = re.compile(r'(?<=[.!?])\s+(?=\S)')
+
+
+class Unit(NamedTuple):
+    """A piece of a document that is never split further: a heading, paragraph, sentence or token window."""
+    text: str
+    tokens: int
+    page: Optional[int]
+    heading: Optional[str]
+    separator: str
+
+
+class CharacterChunker:
+    """
+    The original splitter: 2000 characters with 300 characters of overlap, split on blank lines only
+    """
+
+    def __init__(self, config, encoder):
+        self.splitter = CharacterTextSplitter(chunk_size=2000, chunk_overlap=300)
+        self.signature = 'character:2000:300'
+
+    def split_documents(self, docs):
+        return self.splitter.split_documents(docs)
+
+
+class TokenChunker:
+    """
+    Chunks of at most chunk_tokens tokens (counted with the embedding model's encoder), packed from whole
+    paragraphs. A paragraph that does not fit is split into sentences, and a sentence that does not fit into
+    token windows. A heading line starts a new chunk once the current one has chunk_min_tokens, and becomes the
+    title of the chunks that follow it. Chunks run across page breaks and record the pages they span.
+    """
+
+    def __init__(self, config, encoder):
+        self.encoder = encoder
+        self.max_tokens = config.chunk_tokens
+        self.min_tokens = config.chunk_min_tokens
+        self.overlap_tokens = config.chunk_overlap_tokens
+        self.signature = f"token:{self.max_tokens}:{self.min_tokens}:{self.overlap_tokens}"
+
+    def count(self, text):
+        return len(self.encoder.encode(text, disallowed_special=()))
+
+    def pieces(self, text, page):
+        """A paragraph as one unit, or as sentences (or token windows) when it is over the budget."""
+        text = text.strip()
+        if not text:
+            return
+        tokens = self.count(text)
+        if tokens <= self.max_tokens:
+            yield Unit(text, tokens, page, None, '\n\n')
+            return
+        separator = '\n\n'
+        for sentence in SENTENCE_BREAK.split(text):
+            tokens = self.encoder.encode(sentence, disallowed_special=())
+            for start in range(0, len(tokens), self.max_tokens):
+                window = tokens[start:start + self.max_tokens]
+                text = sentence if len(window) == len(tokens) else self.encoder.decode(window)
+                yield Unit(text, len(window), page, None, separator)
+                separator = ' '
+
+    def units(self, docs):
+        for doc in docs:
+            page = doc.metadata.get('page')
+            for block in PARAGRAPH_BREAK.split(doc.page_content):
+                paragraph = []
+                for line in block.split('\n'):
+                    match = HEADING_PATTERN.match(line.strip())
+                    if not match:
+                        paragraph.append(line)
+                        continue
+                    yield from self.pieces('\n'.join(paragraph), page)
+                    paragraph = []
+                    yield Unit(line.strip(), self.count(line.strip()), page, match.group(1).strip(), '\n\n')
+                yield from self.pieces('\n'.join(paragraph), page)
+
+    def chunk(self, units, metadata, title):
+        text = units[0].text + ''.join(unit.separator + unit.text for unit in units[1:])
+        metadata = {key: value for key, value in metadata.items() if key not in ('page', 'page_end', 'title')}
+        pages = [unit.page for unit in units if unit.page is not None]
+        if pages:
+            metadata['page'] = pages[0]
+            metadata['page_end'] = pages[-1]
+        if title:
+            metadata['title'] = title
+        return Document(page_content=text, metadata=metadata)
+
+    def overlap(self, units, following):
+        """The trailing units of a full chunk to repeat at the start of the next one, up to chunk_overlap_tokens."""
+        overlap, tokens = [], 0
+        for unit in reversed(units):
+            if unit.heading is not None or tokens + unit.tokens + 1 > self.overlap_tokens:
+                break
+            overlap.insert(0, unit)
+            tokens += unit.tokens + 1
+        return overlap if tokens + following.tokens + 1 <= self.max_tokens else []
+
+    def split_documents(self, docs):
+        """Split the pages of one file into chunks carrying the file's metadata, pages and section title."""
+        docs = list(docs)
+        if not docs:
+            return []
+        metadata = docs[0].metadata
+        chunks, current, tokens = [], [], 0
+        section, title = None, None
+
+        for unit in self.units(docs):
+            flushed = False
+            if current and unit.heading is not None and tokens >= self.min_tokens:
+                chunks.append(self.chunk(current, metadata, title))
+                current, tokens, flushed = [], 0, True
+            # The separator costs about a token
+            elif current and tokens + unit.tokens + 1 > self.max_tokens:
+                chunks.append(self.chunk(current, metadata, title))
+                current, flushed = self.overlap(current, unit), True
+                tokens = sum(previous.tokens + 1 for previous in current)
+            if unit.heading is not None:
+                section = unit.heading
+            if flushed or not current:
+                title = section
+            current.append(unit)
+            tokens += unit.tokens + (1 if len(current) > 1 else 0)
+
+        if current:
+            chunks.append(self.chunk(current, metadata, title))
+        return chunks
+
+
+CHUNKERS = {'token': TokenChunker, 'character': CharacterChunker}
+
+
+def make_chunker(config, encoder):
+    """
+    The chunker named by Config.chunker: 'token', 'character', or the dotted path of a class taking
+    (config, encoder) with a split_documents(docs) method and a signature string
+    """
+    name = config.chunker
+    if name in CHUNKERS:
+        chunker_class = CHUNKERS[name]
+    else:
+        module, _, attribute = name.rpartition('.')
+        chunker_class = getattr(importlib.import_module(module), attribute)
+    return chunker_class(config, encoder)
@@ -0,0 +1,224 @@
+import numpy as np
+from segments import Segment, SegmentedIndex
+
+SCORE_BLOCK = 4096
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1.0, norms)
+
+
+def kmeans(points, clusters, iterations, rng):
+    """Plain Lloyd's k-means; returns the centroids."""
+    centroids = points[rng.choice(len(points), clusters, replace=False)].copy()
+    for _ in range(iterations):
+        distances = (points ** 2).sum(1)[:, None] - 2 * points @ centroids.T + (centroids ** 2).sum(1)[None, :]
+        assignment = distances.argmin(1)
+        counts = np.bincount(assignment, minlength=clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, points)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+    return centroids
+
+
+class Int8Segment(Segment):
+    """
+    Vectors as int8 codes with one float scale per vector, plus the full float32 vectors for rescoring
+    """
+
+    FIELDS = ('ids', 'codes', 'scales', 'full', 'live')
+
+    @staticmethod
+    def encode(compact):
+        scales = np.abs(compact).max(axis=1) / 127
+        scales[scales == 0] = 1.0
+        codes = np.round(compact / scales[:, None]).astype(np.int8)
+        return {'codes': codes, 'scales': scales.astype(np.float32)}
+
+    def scores(self, query, rows):
+        return (self.codes[rows].astype(np.float32) @ query) * self.scales[rows]
+
+    def compact_bytes(self):
+        return self.codes.nbytes + self.scales.nbytes
+
+
+class PQSegment(Segment):
+    """
+    Vectors as product-quantization codes (one byte per subvector) against a codebook, usually the one
+    shared by the whole index, plus the full float32 vectors for rescoring
+    """
+
+    FIELDS = ('ids', 'codes', 'codebook', 'full', 'live')
+
+    @staticmethod
+    def split(compact, subvectors):
+        """The vectors cut into subvectors, padded so they split evenly"""
+        count, dimensions = compact.shape
+        padded = np.zeros((count, -(-dimensions // subvectors) * subvectors), dtype=np.float32)
+        padded[:, :dimensions] = compact
+        return padded.reshape(count, subvectors, -1)
+
+    @staticmethod
+    def train(sample, subvectors, iterations=15, seed=0):
+        """A codebook of up to 256 centroids per subvector, trained on a sample of compact vectors"""
+        parts = PQSegment.split(sample, subvectors)
+        rng = np.random.default_rng(seed)
+        clusters = min(256, len(parts))
+        return np.stack([kmeans(parts[:, m], clusters, iterations, rng) for m in range(subvectors)]).astype(np.float32)
+
+    @staticmethod
+    def encode(compact, codebook):
+        parts = PQSegment.split(compact, len(codebook))
+        codes = np.empty(parts.shape[:2], dtype=np.uint8)
+        for m, centroids in enumerate(codebook):
+            distances = -2 * parts[:, m] @ centroids.T + (centroids ** 2).sum(1)[None, :]
+            codes[:, m] = distances.argmin(1)
+        return {'codes': codes, 'codebook': codebook}
+
+    def scores(self, query, rows):
+        subvectors, _, width = self.codebook.shape
+        padded = np.zeros(subvectors * width, dtype=np.float32)
+        padded[:len(query)] = query
+        # Inner product of the query with every centroid, then one table lookup per subvector
+        table = np.einsum('mkd,md->mk', self.codebook, padded.reshape(subvectors, width))
+        return table[np.arange(subvectors), self.codes[rows]].sum(axis=1)
+
+    def compact_bytes(self):
+        return self.codes.nbytes + self.codebook.nbytes
+
+
+class CompactVectors(SegmentedIndex):
+    """
+    Chunk vectors kept outside Chroma in a compact form: int8 codes or product-quantization codes,
+    optionally of only the first vector_dimensions dimensions (for embedding models trained so that a
+    prefix is a usable embedding, such as text-embedding-3-*).
+
+    A search scores the compact codes, keeps the best rescore_candidates, and re-scores those against
+    the full float32 vectors, which stay on disk and are only paged in for the shortlist. Similarity
+    is cosine.
+    """
+
+    def __init__(self, config):
+        self.mode = config.vector_storage
+        self.segment_class = {'int8': Int8Segment, 'pq': PQSegment}[self.mode]
+        super().__init__(config, config.vector_store_directory, config.segment_merge_factor)
+
+    def compact(self, full):
+        if self.config.vector_dimensions:
+            return normalize(full[:, :self.config.vector_dimensions])
+        return full
+
+    def encode(self, full, stored=False):
+        """
+        The compact codes of full vectors, and the segment's manifest stats. stored says the vectors are
+        already in the index (a merge) rather than a new batch.
+        """
+        if self.mode == 'int8':
+            return Int8Segment.encode(self.compact(full)), {}
+        codebook, trained = self.codebook(full, stored)
+        return PQSegment.encode(self.compact(full), codebook), {'trained': trained}
+
+    def codebook(self, full, stored):
+        """
+        The index-wide PQ codebook and how many vectors it was trained on. It is trained afresh on up to
+        pq_train_size vectors sampled from the whole index only while the index has at least twice the
+        vectors the current one saw, so small batches are coded against a codebook trained on many
+        vectors, and it stops changing once trained on pq_train_size.
+        """
+        best = None
+        for segment, entry in zip(self.segments, self.manifest['segments']):
+            trained = entry.get('trained', min(entry['docs'], self.config.pq_train_size))
+            if best is None or trained > best[1]:
+                best = (np.asarray(segment.codebook), trained)
+        available = min(self.config.pq_train_size, self.live_count() + (0 if stored else len(full)))
+        if best is not None and 2 * best[1] >= available:
+            return best
+        sample = self.training_sample(full[:0] if stored else full, available)
+        return PQSegment.train(self.compact(sample), self.config.pq_subvectors), len(sample)
+
+    def training_sample(self, full, size, seed=0):
+        """size vectors drawn at random from the new ones and the live stored ones"""
+        pools = [full] + [segment.full for segment in self.segments]
+        rows = [np.arange(len(full))] + [np.flatnonzero(np.asarray(segment.live) == 1) for segment in self.segments]
+        offsets = np.cumsum([0] + [len(pool_rows) for pool_rows in rows])
+        picks = np.sort(np.random.default_rng(seed).choice(offsets[-1], min(size, offsets[-1]), replace=False))
+        parts = []
+        for pool, pool_rows, start, end in zip(pools, rows, offsets, offsets[1:]):
+            chosen = picks[(picks >= start) & (picks < end)] - start
+            if len(chosen):
+                parts.append(np.asarray(pool[pool_rows[chosen]]))
+        return np.concatenate(parts)
+
+    def add(self, ids, vectors):
+        """Store a batch of vectors; ids that are already stored are skipped."""
+        new = self.missing(ids)
+        if not new:
+            return
+        full = normalize([vectors[index] for index in new])
+        codes, stats = self.encode(full)
+        self.add_segment({'ids': self.encode_ids([ids[index] for index in new]), 'full': full, **codes}, stats)
+
+    def merge_arrays(self, segments):
+        ids, masks, order, _ = self.live_order(segments)
+        full = np.concatenate([np.asarray(segment.full)[live] for segment, live in zip(segments, masks)])[order]
+        if self.mode == 'int8':
+            codes = {
+                field: np.concatenate([np.asarray(getattr(segment, field))[live]
+                                       for segment, live in zip(segments, masks)])[order]
+                for field in ('codes', 'scales')
+            }
+            stats = {}
+        else:
+            # Segments may have been coded against older codebooks, so code the merged vectors again
+            codes, stats = self.encode(full, stored=True)
+        return {'ids': ids, 'full': full, **codes}, stats
+
+    def search(self, query, k, allowed=None):
+        """Top-k (chunk id, cosine similarity) pairs, only among the allowed chunk ids if given."""
+        self.load()
+        segments = self.segments
+        full_query = normalize(query)
+        compact_query = self.compact(full_query[None, :])[0]
+        shortlist = max(k, self.config.rescore_candidates)
+        allowed = self.encode_ids(list(allowed)) if allowed is not None else None
+
+        candidates = []
+        for number, segment in enumerate(segments):
+            mask = segment.mask(allowed) if allowed is not None else np.asarray(segment.live) == 1
+            rows = np.flatnonzero(mask)
+            if not len(rows):
+                continue
+            # Blocks small enough that the decoded floats stay in cache; with every row wanted, slice the
+            # memory map rather than copying it by index
+            blocks = [slice(start, start + SCORE_BLOCK) if len(rows) == len(mask) else rows[start:start + SCORE_BLOCK]
+                      for start in range(0, len(rows), SCORE_BLOCK)]
+            scores = np.concatenate([segment.scores(compact_query, block) for block in blocks])
+            top = np.argpartition(-scores, min(shortlist, len(scores)) - 1)[:shortlist]
+            candidates.extend((float(scores[i]), number, int(rows[i])) for i in top)
+        candidates.sort(reverse=True)
+        candidates = candidates[:shortlist]
+
+        if self.config.rescore_candidates:
+            by_segment = {}
+            for _, number, row in candidates:
+                by_segment.setdefault(number, []).append(row)
+            candidates = []
+            for number, rows in by_segment.items():
+                # Sorted rows read the memory-mapped file front to back
+                rows = np.sort(rows)
+                exact = segments[number].full[rows] @ full_query
+                candidates.extend((float(score), number, int(row)) for score, row in zip(exact, rows))
+            candidates.sort(reverse=True)
+        return [(segments[number].ids[row].decode('utf-8'), score) for score, number, row in candidates[:k]]
+
+    def stats(self):
+        """Stored vectors and bytes held in compact codes (searched) and full vectors (paged in for rescoring)."""
+        self.load()
+        return {
+            'vectors': self.live_count(),
+            'compact_bytes': sum(segment.compact_bytes() + segment.ids.nbytes for segment in self.segments),
+            'full_bytes': sum(segment.full.nbytes for segment in self.segments)
+        }
@@ -11,3 +11,173 @@ class Config:
     collection_name = 'google_drive_collection'
     model = "gpt-4o-mini"
     folders_ignore = ['Research papers', 'Other paper reviews', 'Thesis', 'Videos', 'IAG', 'Photos', 'photos', 'videos', 'PhD', 'Documents', 'Projects and study', 'Gift cards']
+    # Incremental sync: keep a Drive change-page token and a manifest of downloaded files
+    # between runs so only added/changed/removed files are fetched. Set to False to wipe
+    # and re-download everything on every run.
+    incremental_sync = True
+    sync_state_file = 'drive_sync_state.json'
+    # Parallel downloads: worker threads (each with its own HTTP client), the cap on Drive
+    # requests in flight, the chunk size per request, and retry/backoff for 429/5xx responses
+    download_workers = 8
+    max_in_flight_requests = 8
+    download_chunk_size = 10 * 1024 * 1024
+    download_max_retries = 5
+    download_backoff_base = 1.0
+    download_backoff_max = 32.0
+    # Drive crawl: folders listed concurrently per tree level; set crawl_batch_size (max 100)
+    # to pack several folder listings into one Drive batch HTTP request
+    crawl_workers = 8
+    crawl_batch_size = 0
+    # Google Docs are exported as 'markdown' (keeps headings for the chunker), 'text' or 'docx'.
+    # Files of types no loader in document_parser.py can index are not downloaded at all.
+    google_docs_export = 'markdown'
+    # Which files (at which hash) are indexed in Chroma, and under which chunk ids
+    ingest_ledger_file = 'ingest_ledger.json'
+    # Local cache of embedding vectors keyed by model and chunk text, with LRU eviction
+    # beyond max_entries (0 for no limit)
+    embedding_cache_file = 'embedding_cache.sqlite'
+    embedding_cache_max_entries = 500000
+    # Ingest pipeline: chunks per embedding request, and chunks per upsert batch (the ledger
+    # is checkpointed after each upsert, so an interrupted run resumes from there)
+    embed_batch_size = 256
+    upsert_batch_size = 1000
+    # Document parsing runs in worker processes (None for one per CPU); a file that takes
+    # longer than parse_timeout seconds, or crashes its worker, is skipped
+    parse_workers = None
+    parse_timeout = 120
+    # Chunking: 'token' packs paragraphs (or sentences of long ones) into chunks of at most
+    # chunk_tokens tokens, starting a new chunk at a heading once the current one has
+    # chunk_min_tokens, and repeating up to chunk_overlap_tokens at the start of the next;
+    # 'character' is the original 2000/300-character splitter, and a dotted class path plugs
+    # in another. Changing these re-chunks every file on the next run.
+    chunker = 'token'
+    chunk_tokens = 500
+    chunk_min_tokens = 100
+    chunk_overlap_tokens = 0
+    # Embeddings: 'openai' sends embedding_model to the OpenAI API; 'local' runs the
+    # sentence-transformers model local_embedding_model (a name or a path) on CPU with the 'torch'
+    # or 'onnx' runtime ('onnx' needs optimum), loaded on first use. Local requests are served by
+    # local_embed_threads inference threads, and requests that arrive while all of them are busy
+    # are batched together, up to local_embed_batch_size texts. A dotted class path plugs in
+    # another backend. The collection records the model that built it and refuses to open with
+    # another, so switching needs a re-index.
+    embedding_backend = 'openai'
+    embedding_model = 'text-embedding-ada-002'
+    local_embedding_model = 'sentence-transformers/all-MiniLM-L6-v2'
+    local_embedding_runtime = 'torch'
+    local_embed_threads = 2
+    local_embed_batch_size = 64
+    # Embedding requests: token budget per request, concurrent requests, OpenAI rate limits,
+    # retries on 429/5xx, and how many batches may be embedded ahead of the Chroma writer
+    embed_batch_tokens = 100000
+    embed_concurrency = 4
+    embed_requests_per_minute = 3000
+    embed_tokens_per_minute = 1000000
+    embed_max_retries = 6
+    embed_pipeline_depth = 4
+    # Chat caches: answers by exact and by semantically similar (cosine >= similarity) standalone
+    # question, and retrieved chunks by query embedding; entries expire after ttl seconds, the
+    # least recently used go beyond max_entries, and all are dropped when the index changes
+    answer_cache_max_entries = 1000
+    answer_cache_ttl = 3600
+    answer_cache_similarity = 0.95
+    # Chat server: how many chats Gradio runs at once, and how many browser sessions keep
+    # their own conversation memory (least recently active dropped first)
+    chat_concurrency = 16
+    chat_max_sessions = 1000
+    # Conversation memory per session: token budget for the history sent with each follow-up
+    # question (recent turns verbatim, older turns as an LLM-written running summary), and
+    # the cap on the summary's share of it
+    memory_max_tokens = 2000
+    memory_summary_max_tokens = 500
+    # Hybrid search: a local BM25 index over the same chunks (memory-mapped segments, merged
+    # segment_merge_factor at a time) is queried alongside the vectors; the top hybrid_candidates
+    # of each are fused with reciprocal-rank fusion. Terms in more than lexical_max_df of all
+    # chunks are ignored at query time.
+    hybrid_search = True
+    lexical_index_directory = 'lexical_index'
+    segment_merge_factor = 10
+    lexical_max_df = 0.5
+    hybrid_candidates = 20
+    rrf_k = 60
+    bm25_k1 = 1.2
+    bm25_b = 0.75
+    # Shards: with shard_by = 'folder' the index is split into one collection (with its own
+    # lexical index, compact vectors, ledger and near-duplicate signatures) per top-level Drive
+    # folder, or per value of another file metadata key (e.g. 'mime_type'), under shards_directory.
+    # Only shards whose files changed are re-indexed; searches run in all shards at once and
+    # merge their results, and a folder filter searches only that folder's shard. None keeps one
+    # collection. Changing it builds the new layout from scratch (embeddings come from the cache).
+    shard_by = None
+    shards_directory = 'shards'
+    # Filtered search: when a filter matches at most this many chunks, they are searched
+    # exactly instead of through Chroma's where clause
+    filter_exact_search_max = 5000
+    # Vector storage: 'chroma' keeps float32 vectors in the Chroma collection; 'int8' or 'pq'
+    # (product quantization, pq_subvectors bytes per vector) keep compact codes in
+    # vector_store_directory, optionally of only the first vector_dimensions dimensions (for
+    # text-embedding-3-* models), and re-score the best rescore_candidates against the full
+    # vectors on disk. Switching modes needs a rebuild of the index.
+    vector_storage = 'chroma'
+    vector_store_directory = 'compact_vectors'
+    vector_dimensions = None
+    pq_subvectors = 96
+    pq_train_size = 20000
+    rescore_candidates = 100
+    # Near-duplicate chunks: MinHash signatures (dedup_permutations hashes of dedup_shingle_words-word
+    # shingles) with an LSH index find stored chunks a new chunk nearly repeats. At estimated Jaccard
+    # similarity >= dedup_threshold it is not embedded or stored again, and the file refers to the
+    # stored chunk (so the few words only the copy has are not searchable); at >= dedup_group_threshold
+    # it is stored, and search returns one chunk of the two.
+    near_duplicate_dedup = True
+    dedup_file = 'near_duplicates.sqlite'
+    dedup_threshold = 0.8
+    dedup_group_threshold = 0.5
+    dedup_permutations = 128
+    dedup_shingle_words = 5
+    # Chat retrieval: the answer prompt gets at most retrieval_k chunks and retrieval_max_tokens
+    # tokens, picked from the top retrieval_candidates search results. Maximal marginal relevance
+    # orders the candidates first (mmr_lambda weighs rank against similarity to chunks already
+    # picked: 1 keeps the search order, lower spreads the picks over more files). A local
+    # cross-encoder (a sentence-transformers model such as 'cross-encoder/ms-marco-MiniLM-L-6-v2',
+    # None to disable) can then re-score the first reranker_candidates on CPU, reranker_batch_size
+    # pairs at a time truncated to reranker_max_length tokens, for at most reranker_budget_ms per
+    # question; chunks it has not scored by then keep their MMR order.
+    retrieval_candidates = 50
+    retrieval_k = 5
+    retrieval_max_tokens = 3000
+    mmr_lambda = 0.7
+    reranker_model = None
+    reranker_candidates = 20
+    reranker_batch_size = 10
+    reranker_max_length = 512
+    reranker_budget_ms = 150
+    # Answer context: of the chosen chunks only the sentences (or lines) that share words with the
+    # question are sent, with context_window_sentences sentences either side, best first (BM25
+    # over the chunks' sentences, no LLM call) up to context_max_tokens tokens; sentences scoring
+    # below context_min_score of the best are left out, and a repeated sentence goes in once. Each
+    # chunk comes under a numbered citation with its path, pages and Google Drive link.
+    # context_compression = False sends the chunks whole.
+    context_compression = True
+    context_max_tokens = 1200
+    context_window_sentences = 1
+    context_min_score = 0.3
+    # Instrumentation: pipeline log lines as 'text' or 'json' (one object per line, to log_file
+    # or stderr), at log_level ('DEBUG' adds a line per downloaded and parsed file); Prometheus
+    # metrics on metrics_host:metrics_port (port None to disable; host '0.0.0.0' to let other
+    # machines scrape them); and the stages ('crawl', 'download_file', 'parse', 'split', 'upsert',
+    # 'retrieve') to run under cProfile, one .prof file per run in profile_directory
+    log_format = 'text'
+    log_level = 'INFO'
+    log_file = None
+    metrics_host = '127.0.0.1'
+    metrics_port = 9464
+    profile_stages = []
+    profile_directory = 'profiles'
+    # Daemon mode (python main.py daemon): sync Drive and index changed files every sync_interval
+    # seconds while the chat keeps answering. Each build goes into a copy of the index (a numbered
+    # generation under index_generations_directory) that is swapped in once complete;
+    # index_pointer_file names the generation every command uses.
+    sync_interval = 3600
+    index_generations_directory = 'index_generations'
+    index_pointer_file = 'current_index.json'
@@ -0,0 +1,145 @@
+import math
+import re
+from collections import Counter
+from chunker import SENTENCE_BREAK
+from lexical_index import tokenize
+
+
+class ContextCompressor:
+    """
+    Builds the context of the answer prompt from the chosen chunks, in tiktoken tokens of at most
+    Config.context_max_tokens.
+
+    Rather than whole chunks, it keeps the sentences (lines, in text without sentence punctuation) that
+    share words with the question, each with Config.context_window_sentences sentences either side. They
+    are scored locally with BM25, the sentences of the chunks serving as the collection, so no LLM call is
+    needed; sentences below Config.context_min_score of the best score are dropped. A sentence repeated
+    across chunks (chunk overlap, copies of a file) goes in once. Chunks with no matching sentence add
+    their opening sentence, if room is left.
+
+    Each chunk's sentences follow a numbered header citing its file, pages and Google Drive link; chunks of
+    the same file share a number.
+    """
+
+    def __init__(self, config, encoder):
+        self.config = config
+        self.encoder = encoder
+
+    def count(self, text):
+        return len(self.encoder.encode(text, disallowed_special=()))
+
+    @staticmethod
+    def sentences(text):
+        """(sentence, separator before it) pairs of a chunk's text; a sentence that starts a line follows a newline"""
+        pairs = []
+        for line in text.split('\n'):
+            separator = '\n'
+            for sentence in SENTENCE_BREAK.split(line):
+                if sentence.strip():
+                    pairs.append((sentence.strip(), separator))
+                    separator = ' '
+        return pairs
+
+    @staticmethod
+    def normalize(sentence):
+        return re.sub(r'\s+', ' ', sentence).strip().lower()
+
+    def scores(self, question, chunks):
+        """
+        BM25 score of every sentence of every chunk against the question. Terms in more than lexical_max_df of
+        the sentences are ignored, as the lexical index does.
+        """
+        counted = [[Counter(tokenize(sentence)) for sentence, _ in sentences] for sentences in chunks]
+        every = [terms for sentences in counted for terms in sentences]
+        if not every:
+            return [[] for _ in chunks]
+        average_length = sum(sum(terms.values()) for terms in every) / len(every) or 1.0
+        idf = {}
+        for term in set(tokenize(question)):
+            count = sum(term in terms for terms in every)
+            if 0 < count <= self.config.lexical_max_df * len(every):
+                idf[term] = math.log(1 + (len(every) - count + 0.5) / (count + 0.5))
+        k1, b = self.config.bm25_k1, self.config.bm25_b
+
+        def bm25(terms):
+            norm = k1 * (1 - b + b * sum(terms.values()) / average_length)
+            return sum(weight * terms[term] * (k1 + 1) / (terms[term] + norm)
+                       for term, weight in idf.items() if term in terms)
+
+        return [[bm25(terms) for terms in sentences] for sentences in counted]
+
+    def header(self, number, metadata):
+        """The citation line above a chunk's sentences: [n] path, pages (Google Drive link)."""
+        name = metadata.get('relative_path') or metadata.get('filename') or metadata.get('source', '')
+        page, page_end = metadata.get('page'), metadata.get('page_end')
+        if page is not None:
+            name += f", p. {page}" if page_end in (None, page) else f", pp. {page}-{page_end}"
+        url = metadata.get('google_drive_url')
+        return f"[{number}] {name}" + (f" ({url})" if url else '')
+
+    def spans(self, question, chunks):
+        """
+        (priority, chunk, sentence, sentences with neighbours) for the spans worth keeping, best first: sentences
+        matching the question, then the opening sentence of each chunk that matches nowhere
+        """
+        scores = self.scores(question, chunks)
+        best = max((score for chunk_scores in scores for score in chunk_scores), default=0.0)
+        window = self.config.context_window_sentences
+        spans = []
+        for chunk, chunk_scores in enumerate(scores):
+            matched = False
+            for index, score in enumerate(chunk_scores):
+                if score > 0 and score >= self.config.context_min_score * best:
+                    matched = True
+                    neighbours = range(max(index - window, 0), min(index + window + 1, len(chunk_scores)))
+                    spans.append((score, chunk, index, neighbours))
+            if not matched and chunk_scores:
+                spans.append((0.0, chunk, 0, range(1)))
+        # Ties (and the unmatched openings) go by the chunks' order
+        spans.sort(key=lambda span: (-span[0], span[1]))
+        return spans
+
+    def pack(self, docs, chunks, spans):
+        """
+        {chunk: sentence indexes} packed span by span, best first, while the context stays within
+        context_max_tokens: a span that doesn't fit is cut down to its matching sentence, or skipped
+        """
+        chosen, seen, used = {}, set(), 0
+        for _, chunk, index, neighbours in spans:
+            for candidate in (neighbours, [index]):
+                new = [i for i in candidate
+                       if i not in chosen.get(chunk, ()) and self.normalize(chunks[chunk][i][0]) not in seen]
+                if not new:
+                    break
+                # A sentence costs its tokens and a separator; a chunk's first sentence also its citation header
+                cost = sum(self.count(chunks[chunk][i][0]) + 1 for i in new)
+                if chunk not in chosen:
+                    cost += self.count(self.header(len(chosen) + 1, docs[chunk].metadata)) + 2
+                if used + cost > self.config.context_max_tokens:
+                    continue
+                used += cost
+                chosen.setdefault(chunk, set()).update(new)
+                seen.update(self.normalize(chunks[chunk][i][0]) for i in new)
+                break
+        return chosen
+
+    def context(self, question, docs):
+        """The context for the answer prompt from the chosen chunks (best first)."""
+        chunks = [self.sentences(doc.page_content) for doc in docs]
+        chosen = self.pack(docs, chunks, self.spans(question, chunks)) if self.config.context_compression else None
+        blocks, numbers = [], {}
+        for chunk, doc in enumerate(docs):
+            if chosen is None:
+                text = doc.page_content.strip()
+            elif chosen.get(chunk):
+                indexes = sorted(chosen[chunk])
+                text = chunks[chunk][indexes[0]][0]
+                for previous, index in zip(indexes, indexes[1:]):
+                    sentence, separator = chunks[chunk][index]
+                    # Mark where sentences were left out
+                    text += (separator if index == previous + 1 else ' … ') + sentence
+            else:
+                continue
+            number = numbers.setdefault(doc.metadata.get('source') or chunk, len(numbers) + 1)
+            blocks.append(f"{self.header(number, doc.metadata)}\n{text}")
+        return '\n\n'.join(blocks)
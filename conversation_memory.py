@@ -0,0 +1,70 @@
+class ConversationMemory:
+    """
+    Conversation history for the question-condensing prompt, kept within a token budget.
+
+    Recent turns are kept verbatim in a sliding window; turns that fall out of the window are
+    folded into a running summary by the LLM, a few at a time, so each turn's prompt stays
+    bounded however long the session gets. Tokens are counted with Chroma's tiktoken encoder.
+    """
+
+    def __init__(self, config, encoder, summarizer):
+        self.config = config
+        self.encoder = encoder
+        self.summarizer = summarizer
+        self.turns = []
+        self.summary = ''
+        self.summary_tokens = 0
+        # What an unbounded buffer would hold, for comparison
+        self.unbounded_tokens = 0
+        # History tokens sent with each turn's condensing prompt
+        self.prompt_tokens = []
+
+    def count(self, text):
+        return len(self.encoder.encode(text, disallowed_special=()))
+
+    def history(self):
+        """
+        The chat history string for the condensing prompt: summary of older turns, then recent turns
+        """
+        history = ''.join(text for text, _ in self.turns)
+        if self.summary:
+            history = f"\nSummary of earlier conversation: {self.summary}{history}"
+        if history:
+            self.prompt_tokens.append(self.summary_tokens + sum(tokens for _, tokens in self.turns))
+        return history
+
+    async def asave_context(self, question, answer):
+        """
+        Append a turn, and summarize the oldest turns once the window exceeds its share of the budget
+        """
+        text = f"\nHuman: {question}\nAssistant: {answer}"
+        tokens = self.count(text)
+        self.turns.append((text, tokens))
+        self.unbounded_tokens += tokens
+
+        window = self.config.memory_max_tokens - self.summary_tokens
+        if sum(tokens for _, tokens in self.turns) <= window:
+            return
+        # Evict down to half the window, so the summarizer runs every few turns rather than on every turn.
+        # The latest turn always stays verbatim, however long it is.
+        evicted = []
+        while len(self.turns) > 1 and sum(tokens for _, tokens in self.turns) > window // 2:
+            evicted.append(self.turns.pop(0)[0])
+        if not evicted:
+            return
+        self.summary = await self.summarizer.ainvoke({'summary': self.summary, 'new_lines': ''.join(evicted).strip()})
+        encoded = self.encoder.encode(self.summary, disallowed_special=())
+        if len(encoded) > self.config.memory_summary_max_tokens:
+            # Keep the end of an overlong summary: the progressive summary appends newer context there
+            encoded = encoded[-self.config.memory_summary_max_tokens:]
+            self.summary = self.encoder.decode(encoded)
+        self.summary_tokens = len(encoded)
+
+    def stats(self):
+        return {
+            'turns_verbatim': len(self.turns),
+            'summary_tokens': self.summary_tokens,
+            'history_tokens': self.summary_tokens + sum(tokens for _, tokens in self.turns),
+            'unbounded_tokens': self.unbounded_tokens,
+            'prompt_tokens': list(self.prompt_tokens)
+        }
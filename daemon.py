@@ -0,0 +1,96 @@
+import logging
+import threading
+from instrumentation import log, metrics
+from index_generations import IndexGenerations
+
+
+class Daemon:
+    """
+    Serve the chat while a background thread syncs Drive and re-indexes every Config.sync_interval seconds.
+
+    Each build indexes into a fresh index generation and is swapped into the chat only once it is
+    complete; the index it replaces is closed, and its lease given up so it can be pruned, at the start
+    of a later cycle, once no question is being answered from it any more.
+    """
+
+    def __init__(self, config, download, chroma, lease, gradio):
+        self.config = config
+        self.download = download
+        self.chroma = chroma
+        self.lease = lease
+        self.gradio = gradio
+        self.generations = IndexGenerations(config)
+        # (index, lease) of the generations swapped out
+        self.retired = []
+        self.stopped = threading.Event()
+
+    def refresh(self):
+        """One cycle: sync Drive, and if any file changed build a new index generation and swap it in."""
+        self.close_retired()
+        self.download.google_drive()
+        with self.generations.locked():
+            # Serve a generation another process published (python main.py index)
+            current = self.generations.current()
+            if current != self.lease.generation:
+                self.swap(current)
+            pending = self.chroma.pending_changes()
+            if pending:
+                self.build(pending)
+            else:
+                log('daemon.unchanged', "Index is up to date")
+            self.generations.prune()
+
+    def close_retired(self):
+        """Close the indexes swapped out earlier that no question is using any more"""
+        for chroma, lease in list(self.retired):
+            if not self.gradio.index_in_use(chroma):
+                self.retired.remove((chroma, lease))
+                chroma.close()
+                lease.release()
+        if self.retired:
+            log('daemon.draining', f"{len(self.retired)} replaced index generations still in use",
+                level=logging.DEBUG, indexes=len(self.retired))
+
+    def build(self, pending):
+        """Index the changes into a copy of the current generation, publish it and swap it in (lock held)"""
+        # Imported here so the daemon module stays cheap to import
+        from sharded_index import make_index
+        build, config = self.generations.prepare_next(self.chroma.unchanged_shards())
+        log('daemon.build', f"Indexing {pending} changed files into a new index generation", files=pending)
+        # Share the embedding model (and its loaded weights) with the index being served
+        chroma = make_index(config, embeddings=self.chroma.embeddings.embeddings)
+        try:
+            with metrics.timer('build'):
+                chroma.process_and_store()
+        finally:
+            # Opened again from the generation's own directory once published
+            chroma.close()
+        self.swap(self.generations.publish(build))
+
+    def swap(self, generation):
+        """Answer from another index generation, retiring the one served until now (lock held)"""
+        from sharded_index import make_index
+        lease = self.generations.lease(generation)
+        chroma = make_index(self.generations.config_for(generation), embeddings=self.chroma.embeddings.embeddings)
+        self.retired.append((self.chroma, self.lease))
+        self.chroma, self.lease = chroma, lease
+        self.gradio.swap_index(chroma)
+        metrics.set('rag_index_generation', generation)
+        log('daemon.swapped', f"Now serving index generation {generation}", generation=generation)
+
+    def loop(self):
+        while not self.stopped.is_set():
+            try:
+                self.refresh()
+            except Exception as e:
+                # Keep serving the current index and try again next cycle
+                log('daemon.error', f"Sync and index failed: {type(e).__name__}: {e}", level=logging.ERROR,
+                    error=f"{type(e).__name__}: {e}")
+            self.stopped.wait(self.config.sync_interval)
+
+    def run(self, **launch_options):
+        threading.Thread(target=self.loop, name='sync-daemon', daemon=True).start()
+        try:
+            self.gradio.run(**launch_options)
+        finally:
+            self.stopped.set()
@@ -0,0 +1,385 @@
+import cProfile
+import csv
+import multiprocessing
+import os
+import re
+import time
+import zipfile
+from multiprocessing.connection import wait
+from xml.etree import ElementTree
+
+# Parse functions by file extension: each takes a path and yields (text, metadata) pages
+LOADERS = {}
+
+# Extensions for files whose Drive name has none, by MIME type
+MIME_EXTENSIONS = {
+    'application/pdf': '.pdf',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document': '.docx',
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet': '.xlsx',
+    'application/vnd.openxmlformats-officedocument.presentationml.presentation': '.pptx',
+    'text/plain': '.txt',
+    'text/markdown': '.md',
+    'text/csv': '.csv',
+    'text/html': '.html'
+}
+
+# Spreadsheet rows per page handed to the chunker (each row is its own paragraph)
+ROWS_PER_PAGE = 100
+
+SPREADSHEET_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+PRESENTATION_NS = '{http://schemas.openxmlformats.org/presentationml/2006/main}'
+DRAWING_NS = '{http://schemas.openxmlformats.org/drawingml/2006/main}'
+RELATIONSHIP_ID = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id'
+
+
+def loader(*extensions):
+    """Register a parse function for these file extensions."""
+    def register(function):
+        for extension in extensions:
+            LOADERS[extension] = function
+        return function
+    return register
+
+
+def indexable(file_path):
+    return os.path.splitext(str(file_path))[1].lower() in LOADERS
+
+
+@loader('.pdf')
+def load_pdf(file_path):
+    # Imported on first use, so Drive sync (which only needs the extension registry) never loads the parsers
+    from langchain_community.document_loaders import PyPDFLoader
+    for doc in PyPDFLoader(file_path).lazy_load():
+        yield doc.page_content, doc.metadata
+
+
+@loader('.docx')
+def load_docx(file_path):
+    from langchain_community.document_loaders import Docx2txtLoader
+    for doc in Docx2txtLoader(file_path).lazy_load():
+        yield doc.page_content, doc.metadata
+
+
+@loader('.txt', '.md')
+def load_text(file_path):
+    with open(file_path, encoding='utf-8', errors='replace') as f:
+        yield f.read(), {'source': file_path}
+
+
+def row_text(header, row):
+    """One spreadsheet row as 'column: value' pairs, named by the header row where it has a name."""
+    return '; '.join(
+        f"{header[column] if column < len(header) and header[column] else f'Column {column + 1}'}: {value}"
+        for column, value in enumerate(row) if value not in (None, '')
+    )
+
+
+def row_pages(rows, file_path, heading=None):
+    """Group rows (the first one is the header) into pages of ROWS_PER_PAGE paragraphs, the first led by heading."""
+    header, lines, prefix = None, [], [heading] if heading else []
+    for row in rows:
+        if header is None:
+            header = [str(value).strip() if value is not None else '' for value in row]
+            continue
+        line = row_text(header, row)
+        if line:
+            lines.append(line)
+        if len(lines) >= ROWS_PER_PAGE:
+            yield '\n\n'.join(prefix + lines), {'source': file_path}
+            lines, prefix = [], []
+    if lines:
+        yield '\n\n'.join(prefix + lines), {'source': file_path}
+
+
+@loader('.csv')
+def load_csv(file_path):
+    with open(file_path, encoding='utf-8', errors='replace', newline='') as f:
+        yield from row_pages(csv.reader(f), file_path)
+
+
+def column_index(reference):
+    """Zero-based column of a cell reference such as 'AB12'."""
+    index = 0
+    for letter in reference:
+        if not letter.isalpha():
+            break
+        index = index * 26 + ord(letter.upper()) - ord('A') + 1
+    return index - 1
+
+
+def shared_strings(archive):
+    if 'xl/sharedStrings.xml' not in archive.namelist():
+        return []
+    strings = []
+    with archive.open('xl/sharedStrings.xml') as f:
+        for _, element in ElementTree.iterparse(f):
+            if element.tag == f'{SPREADSHEET_NS}si':
+                strings.append(''.join(text.text or '' for text in element.iter(f'{SPREADSHEET_NS}t')))
+                element.clear()
+    return strings
+
+
+def part_targets(archive, rels_path, base):
+    """Relationship id -> archive path, from a .rels part."""
+    rels = ElementTree.fromstring(archive.read(rels_path))
+    return {
+        rel.get('Id'): rel.get('Target').lstrip('/') if rel.get('Target').startswith('/') else f"{base}/{rel.get('Target')}"
+        for rel in rels
+    }
+
+
+def sheet_rows(archive, path, strings):
+    """Stream a worksheet's rows as lists of cell values, clearing each row once read."""
+    with archive.open(path) as f:
+        sheet_data = None
+        for event, element in ElementTree.iterparse(f, events=('start', 'end')):
+            if event == 'start':
+                if element.tag == f'{SPREADSHEET_NS}sheetData':
+                    sheet_data = element
+                continue
+            if element.tag != f'{SPREADSHEET_NS}row':
+                continue
+            row = []
+            for cell in element.iter(f'{SPREADSHEET_NS}c'):
+                cell_type, value = cell.get('t'), cell.find(f'{SPREADSHEET_NS}v')
+                if cell_type == 'inlineStr':
+                    text = ''.join(t.text or '' for t in cell.iter(f'{SPREADSHEET_NS}t'))
+                elif value is None or value.text is None:
+                    continue
+                elif cell_type == 's':
+                    text = strings[int(value.text)]
+                elif cell_type == 'b':
+                    text = 'TRUE' if value.text == '1' else 'FALSE'
+                else:
+                    text = value.text
+                column = column_index(cell.get('r', '')) if cell.get('r') else len(row)
+                row.extend([None] * (column - len(row) + 1))
+                row[column] = text
+            yield row
+            # Finished rows are dropped, so memory stays flat however long the sheet is
+            if sheet_data is not None:
+                sheet_data.clear()
+
+
+@loader('.xlsx')
+def load_xlsx(file_path):
+    with zipfile.ZipFile(file_path) as archive:
+        strings = shared_strings(archive)
+        targets = part_targets(archive, 'xl/_rels/workbook.xml.rels', 'xl')
+        workbook = ElementTree.fromstring(archive.read('xl/workbook.xml'))
+        for sheet in workbook.iter(f'{SPREADSHEET_NS}sheet'):
+            # Each sheet starts with its name as a heading, so the chunker titles its chunks by sheet
+            yield from row_pages(sheet_rows(archive, targets[sheet.get(RELATIONSHIP_ID)], strings), file_path,
+                                 heading=f"# {sheet.get('name')}")
+
+
+def paragraphs(element):
+    return [
+        text for text in (
+            ''.join(run.text or '' for run in paragraph.iter(f'{DRAWING_NS}t')).strip()
+            for paragraph in element.iter(f'{DRAWING_NS}p')
+        ) if text
+    ]
+
+
+@loader('.pptx')
+def load_pptx(file_path):
+    with zipfile.ZipFile(file_path) as archive:
+        targets = part_targets(archive, 'ppt/_rels/presentation.xml.rels', 'ppt')
+        presentation = ElementTree.fromstring(archive.read('ppt/presentation.xml'))
+        for number, slide_id in enumerate(presentation.iter(f'{PRESENTATION_NS}sldId')):
+            slide = ElementTree.fromstring(archive.read(targets[slide_id.get(RELATIONSHIP_ID)]))
+            lines = []
+            for shape in slide.iter(f'{PRESENTATION_NS}sp'):
+                placeholder = shape.find(f'{PRESENTATION_NS}nvSpPr/{PRESENTATION_NS}nvPr/{PRESENTATION_NS}ph')
+                text = paragraphs(shape)
+                if placeholder is not None and placeholder.get('type') in ('title', 'ctrTitle') and text:
+                    lines.insert(0, f"# {' '.join(text)}")
+                else:
+                    lines.extend(text)
+            # Tables
+            for frame in slide.iter(f'{PRESENTATION_NS}graphicFrame'):
+                lines.extend(paragraphs(frame))
+            # Numbered from 0 like PDF pages
+            yield '\n\n'.join(lines), {'source': file_path, 'page': number}
+
+
+@loader('.html', '.htm')
+def load_html(file_path):
+    from bs4 import BeautifulSoup
+    with open(file_path, encoding='utf-8', errors='replace') as f:
+        soup = BeautifulSoup(f, 'html.parser')
+    for element in soup(['script', 'style', 'head']):
+        element.decompose()
+    # Headings in the form the chunker recognises, and block elements as paragraphs
+    for heading in soup.find_all(re.compile(r'^h[1-6]$')):
+        heading.replace_with(f"\n\n{'#' * int(heading.name[1])} {heading.get_text(' ', strip=True)}\n\n")
+    for element in soup.find_all(['p', 'div', 'li', 'tr', 'pre', 'blockquote', 'table']):
+        element.append('\n\n')
+    for element in soup.find_all(['td', 'th']):
+        element.append(' ')
+    for element in soup.find_all('br'):
+        element.replace_with('\n')
+    text = re.sub(r'\n\s*\n\s*', '\n\n', soup.get_text())
+    yield text.strip(), {'source': file_path}
+
+
+def parse_file(file_path):
+    """
+    Parse one file into a list of (text, metadata) pages with the loader for its extension
+    """
+    load = LOADERS.get(os.path.splitext(str(file_path))[1].lower())
+    if load is None:
+        return []
+    # Plain text and metadata are much cheaper to send between processes than Documents
+    return [(text, metadata) for text, metadata in load(str(file_path)) if text.strip()]
+
+
+def worker(conn, profile_directory=None):
+    """
+    Parse files sent over conn until told to stop with None. With a profile_directory, each
+    file is parsed under cProfile and its profile written there.
+    """
+    parsed = 0
+    while True:
+        file_path = conn.recv()
+        if file_path is None:
+            break
+        profile = cProfile.Profile() if profile_directory else None
+        start = time.perf_counter()
+        try:
+            if profile:
+                profile.enable()
+            pages, error = parse_file(file_path), None
+        except Exception as e:
+            pages, error = None, f"{type(e).__name__}: {e}"
+        finally:
+            if profile:
+                profile.disable()
+        seconds = time.perf_counter() - start
+        if profile:
+            os.makedirs(profile_directory, exist_ok=True)
+            profile.dump_stats(os.path.join(profile_directory, f"parse-{os.getpid()}-{parsed:06d}.prof"))
+        parsed += 1
+        conn.send((pages, error, seconds))
+
+
+class ParserPool:
+    """
+    Parse documents in a pool of worker processes, one file per worker at a time.
+
+    Because each worker only ever holds one file, a worker that crashes or runs past
+    Config.parse_timeout identifies exactly which file was at fault: that file is
+    reported as failed, the worker is replaced, and the rest of the run carries on.
+
+    A persistent pool keeps its idle workers between imap() calls until close(), so a run that parses
+    in several passes (one per shard) pays for starting workers and their first-file imports once.
+    """
+
+    def __init__(self, config, persistent=False):
+        self.config = config
+        self.workers = self.config.parse_workers or os.cpu_count() or 1
+        # Spawn rather than fork: the parent holds Chroma/SQLite handles and threads
+        self.context = multiprocessing.get_context('spawn')
+        self.persistent = persistent
+        self.idle = []
+
+    def start_worker(self):
+        parent_conn, child_conn = self.context.Pipe()
+        profile_directory = self.config.profile_directory if 'parse' in self.config.profile_stages else None
+        process = self.context.Process(target=worker, args=(child_conn, profile_directory), daemon=True)
+        process.start()
+        child_conn.close()
+        return {'process': process, 'conn': parent_conn, 'task': None, 'started': None}
+
+    def stop_worker(self, slot, kill=False):
+        if kill:
+            slot['process'].kill()
+        else:
+            try:
+                slot['conn'].send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        slot['process'].join(timeout=5)
+        slot['conn'].close()
+
+    def imap(self, tasks):
+        """
+        Parse (file_path, extra) tasks and yield (file_path, extra, pages, error, seconds) as each one finishes.
+        New files are only pulled from tasks when a worker is free, so at most one file per worker is in flight.
+        """
+        tasks = iter(tasks)
+        slots = [slot for slot in self.idle if slot['process'].is_alive()]
+        for slot in self.idle:
+            if slot not in slots:
+                self.stop_worker(slot, kill=True)
+        self.idle = []
+        exhausted = False
+        try:
+            while True:
+                # Hand a file to every idle worker, starting workers only as they are needed
+                while not exhausted:
+                    idle = [slot for slot in slots if slot['task'] is None]
+                    if not idle and len(slots) >= self.workers:
+                        break
+                    task = next(tasks, None)
+                    if task is None:
+                        exhausted = True
+                        break
+                    if idle:
+                        slot = idle[0]
+                    else:
+                        slot = self.start_worker()
+                        slots.append(slot)
+                    slot['task'] = task
+                    slot['started'] = time.perf_counter()
+                    slot['conn'].send(str(task[0]))
+                busy = [slot for slot in slots if slot['task'] is not None]
+                if not busy:
+                    return
+
+                # Wait for a result, a dead worker, or the next timeout
+                now = time.perf_counter()
+                deadline = min(slot['started'] for slot in busy) + self.config.parse_timeout
+                ready = wait(
+                    [slot['conn'] for slot in busy] + [slot['process'].sentinel for slot in busy],
+                    timeout=max(0, deadline - now)
+                )
+
+                for index, slot in enumerate(slots):
+                    if slot['task'] is None:
+                        continue
+                    file_path, extra = slot['task']
+                    elapsed = time.perf_counter() - slot['started']
+                    replace = False
+                    if slot['conn'] in ready:
+                        try:
+                            pages, error, elapsed = slot['conn'].recv()
+                        except (EOFError, OSError):
+                            pages, error, replace = None, "parser process crashed", True
+                    elif slot['process'].sentinel in ready:
+                        pages, error, replace = None, f"parser process crashed (exit code {slot['process'].exitcode})", True
+                    elif elapsed >= self.config.parse_timeout:
+                        pages, error, replace = None, f"timed out after {self.config.parse_timeout}s", True
+                    else:
+                        continue
+
+                    if replace:
+                        # Replace the worker that crashed or hung on this file
+                        self.stop_worker(slot, kill=True)
+                        slots[index] = self.start_worker()
+                    else:
+                        slot['task'] = None
+                    yield file_path, extra, pages, error, elapsed
+        finally:
+            for slot in slots:
+                if self.persistent and slot['task'] is None:
+                    self.idle.append(slot)
+                else:
+                    self.stop_worker(slot, kill=slot['task'] is not None)
+
+    def close(self):
+        """Stop the workers a persistent pool kept."""
+        for slot in self.idle:
+            self.stop_worker(slot)
+        self.idle = []
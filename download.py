@@ -3,9 +3,11 @@ import os
 import pickle
 import io
 import json
+import logging
 from datetime import datetime
 from google_drive import GoogleDrive
 from config_file import Config
+from instrumentation import log, metrics
 
 class Download:
     def __init__(self, config):
@@ -13,21 +15,41 @@ class Download:
         self.gd = GoogleDrive(config=self.config)
         
     def google_drive(self):
-        print("Delete previously downloaded files")
-        self.gd.remove_files()
-        print("\nStructure of your Google Drive:")
-        self.gd.list_all_files()
+        with metrics.timer('sync'):
+            self.timed_sync()
+
+    def timed_sync(self):
         # Get download location
         local_base_path = self.config.downloaded_files_path
+        if self.config.incremental_sync and self.gd.load_sync_state():
+            log('sync.start', "Fetching changes since the last sync...", mode='incremental')
+            self.gd.sync_changes(local_base_path)
+            self.gd.save_metadata()
+            self.gd.save_sync_state()
+            log('sync.done', "Sync complete!", mode='incremental')
+            return
+
+        if not self.config.incremental_sync:
+            log('sync.reset', "Delete previously downloaded files")
+            self.gd.remove_files()
+        else:
+            self.gd.begin_full_sync()
         # Make sure base directory exists
         os.makedirs(local_base_path, exist_ok=True)
-        print(f"\nMapping Google Drive structure...")
-        drive_map = self.gd.map_drive_structure()
-        print(f"Found {len(drive_map['files'])} files in {len(drive_map['folders'])} folders.")
-        print(f"Downloading all files to: {os.path.abspath(local_base_path)}")
+        log('sync.start', "Mapping Google Drive structure...", mode='full')
+        root_id = self.gd.sync_state['root_id'] or 'root'
+        drive_map = self.gd.map_drive_structure(folder_id=root_id)
+        log('sync.mapped', f"Found {len(drive_map['files'])} files in {len(drive_map['folders'])} folders.",
+            files=len(drive_map['files']), folders=len(drive_map['folders']))
+        log('sync.tree', "Structure of your Google Drive:", level=logging.DEBUG)
+        self.gd.list_all_files(drive_map, folder_id=root_id)
+        log('sync.stage', f"Downloading all files to: {os.path.abspath(local_base_path)}", stage='download',
+            path=os.path.abspath(local_base_path))
         self.gd.download_files(drive_map, local_base_path)
-        print("\nDownload complete!")
+        log('sync.done', "Download complete!", mode='full')
         self.gd.save_metadata()
+        if self.config.incremental_sync:
+            self.gd.save_sync_state()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,124 @@
+import logging
+import os
+import random
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseDownload
+from instrumentation import log, metrics
+from metadata_store import HashingWriter
+
+
+class DownloadPool:
+    """
+    Download Drive files in parallel with a bounded pool of worker threads.
+
+    Each worker gets its own Drive service (and so its own HTTP client), since the
+    httplib2 clients behind build() are not thread-safe. A semaphore caps the number of
+    requests in flight across all workers, and rate-limit and server errors are retried
+    with exponential backoff and jitter.
+    """
+
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+    RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+
+    def __init__(self, config, service_factory):
+        self.config = config
+        self.service_factory = service_factory
+        self.local = threading.local()
+        self.in_flight = threading.BoundedSemaphore(self.config.max_in_flight_requests)
+        self.lock = threading.Lock()
+        self.bytes_downloaded = 0
+
+    def service(self):
+        """Return this worker thread's own Drive service."""
+        if not hasattr(self.local, 'service'):
+            self.local.service = self.service_factory()
+        return self.local.service
+
+    def run(self, jobs):
+        """
+        Download every job and yield (job, error) as each one finishes.
+
+        A job is a dict with 'file_item', 'file_path' and 'request', a function that
+        builds the media request from a Drive service.
+        """
+        if not jobs:
+            return
+        start = time.perf_counter()
+        completed = 0
+        with ThreadPoolExecutor(max_workers=self.config.download_workers) as executor:
+            futures = {executor.submit(self.download, job): job for job in jobs}
+            for future in as_completed(futures):
+                job = futures[future]
+                error = future.exception()
+                completed += 1
+                metrics.inc('rag_download_files_total', outcome='error' if error else 'ok')
+                if not error:
+                    log('download.file', f"[{completed}/{len(jobs)}] Downloaded: {job['file_item']['path']}",
+                        level=logging.DEBUG, path=job['file_item']['path'])
+                yield job, error
+
+        elapsed = time.perf_counter() - start
+        megabytes = self.bytes_downloaded / 1024 / 1024
+        metrics.observe('rag_stage_seconds', elapsed, stage='download')
+        log('download.done', f"Downloaded {completed} files, {megabytes:.2f} MB in {elapsed:.1f}s "
+                             f"({megabytes / elapsed if elapsed else 0:.2f} MB/s)",
+            files=completed, bytes=self.bytes_downloaded, seconds=round(elapsed, 3),
+            bytes_per_second=round(self.bytes_downloaded / elapsed if elapsed else 0))
+
+    def download(self, job):
+        """Stream one file to disk and record its MD5 in job['file_hash'], replacing the target only on success."""
+        file_path = job['file_path']
+        part_path = f"{file_path}.part"
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        request = job['request'](self.service())
+        try:
+            with metrics.timer('download_file'), open(part_path, 'wb') as f:
+                # Hash the bytes as they stream to disk instead of reading the file back
+                writer = HashingWriter(f)
+                downloader = MediaIoBaseDownload(writer, request, chunksize=self.config.download_chunk_size)
+                done = False
+                while not done:
+                    _, done = self.with_retries(downloader.next_chunk)
+            expected = job['file_item'].get('md5_checksum')
+            if expected and expected != writer.hexdigest():
+                raise IOError(f"checksum mismatch (expected {expected}, got {writer.hexdigest()})")
+            os.replace(part_path, file_path)
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+        job['file_hash'] = writer.hexdigest()
+        with self.lock:
+            self.bytes_downloaded += writer.size
+        metrics.inc('rag_download_bytes_total', writer.size)
+        metrics.observe('rag_stage_seconds', writer.hash_seconds, stage='hash')
+        return file_path
+
+    def with_retries(self, call):
+        """Run one HTTP request, retrying rate-limit and transient errors with exponential backoff and jitter."""
+        attempt = 0
+        while True:
+            try:
+                with self.in_flight:
+                    return call()
+            except (HttpError, socket.timeout, ConnectionError) as e:
+                if not self.is_retryable(e) or attempt >= self.config.download_max_retries:
+                    raise
+            # Full jitter: sleep a random time up to the exponential backoff
+            delay = min(self.config.download_backoff_max, self.config.download_backoff_base * 2 ** attempt)
+            time.sleep(random.uniform(0, delay))
+            attempt += 1
+
+    def is_retryable(self, error):
+        if not isinstance(error, HttpError):
+            return True
+        if error.resp.status in self.RETRY_STATUSES:
+            return True
+        # Drive reports some rate limits as 403s
+        return error.resp.status == 403 and any(
+            detail.get('reason') in self.RATE_LIMIT_REASONS for detail in (error.error_details or [])
+            if isinstance(detail, dict)
+        )
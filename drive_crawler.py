@@ -0,0 +1,145 @@
+import logging
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from googleapiclient.errors import HttpError
+from download_pool import DownloadPool
+from instrumentation import log, metrics
+
+
+class DriveCrawler:
+    """
+    Map a Google Drive folder tree breadth-first, listing each level's folders concurrently.
+
+    Listing requests share DownloadPool's per-worker Drive services, in-flight request cap
+    and retry/backoff. With Config.crawl_batch_size set, the listings for several folders
+    are packed into one Drive batch HTTP request.
+    """
+
+    FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+    LIST_FIELDS = 'nextPageToken, files(id, name, mimeType, size, modifiedTime, md5Checksum)'
+
+    def __init__(self, config, service_factory, file_item):
+        self.config = config
+        self.pool = DownloadPool(config, service_factory)
+        self.file_item = file_item
+
+    def crawl(self, folder_id='root', path=''):
+        """Map the structure of Google Drive below a folder and return a dictionary of all files and folders."""
+        drive_map = {'files': [], 'folders': []}
+        frontier = [(folder_id, path)]
+        batch_size = max(1, self.config.crawl_batch_size or 1)
+        start = time.perf_counter()
+        requests = 0
+
+        with metrics.timer('crawl'), ThreadPoolExecutor(max_workers=self.config.crawl_workers) as executor:
+            while frontier:
+                groups = [frontier[i:i + batch_size] for i in range(0, len(frontier), batch_size)]
+                listings = {}
+                for result in executor.map(self.list_folders, groups):
+                    listings.update(result)
+                requests += len(groups)
+                metrics.inc('rag_drive_list_requests_total', len(groups))
+
+                # Folders found at this level make up the next one
+                next_frontier = []
+                for parent_id, parent_path in frontier:
+                    for item in listings.get(parent_id, []):
+                        item_path = os.path.join(parent_path, item['name'])
+                        if item['mimeType'] == self.FOLDER_MIME_TYPE:
+                            if item['name'] in self.config.folders_ignore:
+                                continue
+                            drive_map['folders'].append({
+                                'id': item['id'],
+                                'name': item['name'],
+                                'path': item_path,
+                                'parent_id': parent_id
+                            })
+                            next_frontier.append((item['id'], item_path))
+                        else:
+                            drive_map['files'].append(self.file_item(item, item_path, parent_id))
+                frontier = next_frontier
+
+        elapsed = time.perf_counter() - start
+        log('crawl.done', f"Crawled {len(drive_map['folders']) + 1} folders with {requests} listing requests "
+                          f"in {elapsed:.1f}s",
+            folders=len(drive_map['folders']) + 1, files=len(drive_map['files']), requests=requests,
+            seconds=round(elapsed, 3))
+        return drive_map
+
+    def list_request(self, service, folder_id, page_token):
+        return service.files().list(
+            q=f"'{folder_id}' in parents and trashed=false",
+            spaces='drive',
+            fields=self.LIST_FIELDS,
+            pageSize=1000,
+            pageToken=page_token
+        )
+
+    def list_folders(self, folders):
+        """
+        List the direct children of each folder, following every page. Returns {folder_id: items}.
+
+        A listing that still fails after the retries raises: a partial map would make the sync delete every
+        local file in the folders it missed.
+        """
+        results = {folder_id: [] for folder_id, _ in folders}
+        if len(folders) == 1:
+            folder_id = folders[0][0]
+            page_token = None
+            while True:
+                try:
+                    response = self.pool.with_retries(
+                        self.list_request(self.pool.service(), folder_id, page_token).execute
+                    )
+                except Exception as e:
+                    log('crawl.error', f"Error listing folder {folders[0][1] or 'My Drive'}: {e}", level=logging.ERROR,
+                        folder=folders[0][1] or 'My Drive', error=str(e))
+                    raise
+                results[folder_id].extend(response.get('files', []))
+                page_token = response.get('nextPageToken')
+                if not page_token:
+                    break
+            return results
+
+        # Batched: each round sends one page request per folder that still has pages left
+        pending = {folder_id: None for folder_id, _ in folders}
+        attempt = 0
+        while pending:
+            responses = {}
+
+            def callback(request_id, response, exception):
+                responses[request_id] = (response, exception)
+
+            service = self.pool.service()
+            batch = service.new_batch_http_request(callback=callback)
+            for folder_id, page_token in pending.items():
+                batch.add(self.list_request(service, folder_id, page_token), request_id=folder_id)
+            try:
+                self.pool.with_retries(batch.execute)
+            except Exception as e:
+                log('crawl.error', f"Error listing {len(pending)} folders: {e}", level=logging.ERROR,
+                    folders=len(pending), error=str(e))
+                raise
+
+            retry = False
+            for folder_id, (response, exception) in responses.items():
+                if exception is None:
+                    results[folder_id].extend(response.get('files', []))
+                    if response.get('nextPageToken'):
+                        pending[folder_id] = response['nextPageToken']
+                    else:
+                        del pending[folder_id]
+                elif isinstance(exception, HttpError) and self.pool.is_retryable(exception) \
+                        and attempt < self.config.download_max_retries:
+                    retry = True
+                else:
+                    log('crawl.error', f"Error listing folder {folder_id}: {exception}", level=logging.ERROR,
+                        folder_id=folder_id, error=str(exception))
+                    raise exception
+            if retry:
+                delay = min(self.config.download_backoff_max, self.config.download_backoff_base * 2 ** attempt)
+                time.sleep(random.uniform(0, delay))
+                attempt += 1
+        return results
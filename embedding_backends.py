@@ -0,0 +1,128 @@
+import asyncio
+import importlib
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List
+from langchain_core.embeddings import Embeddings
+from instrumentation import log, metrics
+
+
+def openai_embeddings(config, encoder):
+    """Config.embedding_model through the OpenAI API."""
+    # Imported here so a local backend works without the OpenAI client configured
+    from langchain_community.embeddings import OpenAIEmbeddings
+    return OpenAIEmbeddings(model=config.embedding_model,
+                            disallowed_special=(encoder.special_tokens_set - {'<|endoftext|>'}))
+
+
+class LocalEmbeddings(Embeddings):
+    """
+    A sentence-transformers model (Config.local_embedding_model) on CPU, with the 'torch' or 'onnx' runtime.
+
+    The model is loaded on the first request, so starting up costs nothing. Requests from any thread or
+    event loop go through one queue: a batcher thread hands them to local_embed_threads inference threads,
+    and whatever queues up while all of them are busy goes out together as the next batch (up to
+    local_embed_batch_size texts), so concurrent questions share a forward pass instead of waiting in line.
+    Vectors are L2-normalized.
+    """
+
+    def __init__(self, config, encoder=None):
+        self.config = config
+        # What the embedding cache and the collection know the vectors by
+        self.model = config.local_embedding_model
+        self.transformer = None
+        self.load_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.workers = threading.Semaphore(config.local_embed_threads)
+        self.pool = ThreadPoolExecutor(max_workers=config.local_embed_threads, thread_name_prefix='local-embed')
+        self.batcher = None
+
+    def load(self):
+        with self.load_lock:
+            if self.transformer is None:
+                start = time.perf_counter()
+                # Imported here so the OpenAI backend never loads torch
+                from sentence_transformers import SentenceTransformer
+                self.transformer = SentenceTransformer(self.model, device='cpu',
+                                                       backend=self.config.local_embedding_runtime)
+                log('embeddings.loaded', f"Loaded embedding model {self.model} ({self.config.local_embedding_runtime}) "
+                                         f"in {time.perf_counter() - start:.1f}s", model=self.model)
+            return self.transformer
+
+    def submit(self, texts):
+        """Queue texts for embedding; returns a Future of their vectors."""
+        with self.lock:
+            if self.batcher is None:
+                self.batcher = threading.Thread(target=self.batch_loop, name='local-embed-batcher', daemon=True)
+                self.batcher.start()
+        future = Future()
+        self.queue.put((list(texts), future))
+        return future
+
+    def batch_loop(self):
+        size = self.config.local_embed_batch_size
+        while True:
+            batch = [self.queue.get()]
+            # Requests keep queueing while every inference thread is busy
+            self.workers.acquire()
+            count = len(batch[0][0])
+            while count < size:
+                try:
+                    request = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append(request)
+                count += len(request[0])
+            self.pool.submit(self.encode, batch)
+
+    def encode(self, batch):
+        try:
+            texts = [text for request_texts, _ in batch for text in request_texts]
+            start = time.perf_counter()
+            vectors = self.load().encode(texts, batch_size=self.config.local_embed_batch_size,
+                                         normalize_embeddings=True, show_progress_bar=False).tolist()
+            metrics.observe('rag_stage_seconds', time.perf_counter() - start, stage='local_embed')
+            metrics.inc('rag_local_embed_batches_total')
+            metrics.inc('rag_local_embed_texts_total', len(texts))
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        finally:
+            self.workers.release()
+        offset = 0
+        for request_texts, future in batch:
+            future.set_result(vectors[offset:offset + len(request_texts)])
+            offset += len(request_texts)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.submit(texts).result() if texts else []
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await asyncio.wrap_future(self.submit(texts)) if texts else []
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
+
+
+EMBEDDINGS = {'openai': openai_embeddings, 'local': LocalEmbeddings}
+
+
+def make_embeddings(config, encoder):
+    """
+    The embeddings named by Config.embedding_backend: 'openai', 'local', or the dotted path of a LangChain
+    Embeddings class taking (config, encoder), whose model attribute names the model
+    """
+    name = config.embedding_backend
+    if name in EMBEDDINGS:
+        factory = EMBEDDINGS[name]
+    else:
+        module, _, attribute = name.rpartition('.')
+        factory = getattr(importlib.import_module(module), attribute)
+    return factory(config, encoder)
@@ -0,0 +1,156 @@
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+from array import array
+from typing import List
+from langchain_core.embeddings import Embeddings
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper with a persistent SQLite cache keyed by (model, normalized text hash).
+
+    Ingest and query embedding both look in the cache first and only send misses to the
+    wrapped embeddings. The least recently used entries are evicted once the cache holds
+    more than Config.embedding_cache_max_entries vectors. Hits are marked as used in memory and
+    written with the next store (or at close), so reads never write to the database.
+    """
+
+    def __init__(self, embeddings, config):
+        self.embeddings = embeddings
+        self.config = config
+        self.model = getattr(embeddings, 'model', None) or type(embeddings).__name__
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # text hash -> when it was last looked up, not yet written to last_used
+        self.touched = {}
+        self.conn = sqlite3.connect(self.config.embedding_cache_file, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT NOT NULL, text_hash TEXT NOT NULL, vector BLOB NOT NULL, last_used REAL NOT NULL, "
+            "PRIMARY KEY (model, text_hash))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self.conn.commit()
+
+    def key(self, text):
+        # Whitespace differences shouldn't cost a second embedding
+        normalized = re.sub(r'\s+', ' ', text).strip()
+        return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+    def lookup(self, texts):
+        """Return the cached vector (or None) for each text, and mark the hits as recently used."""
+        keys = [self.key(text) for text in texts]
+        found = {}
+        with self.lock:
+            unique_keys = list(set(keys))
+            # Stay below SQLite's limit on query parameters
+            for i in range(0, len(unique_keys), 500):
+                batch = unique_keys[i:i + 500]
+                rows = self.conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({','.join('?' * len(batch))})",
+                    [self.model, *batch]
+                )
+                for text_hash, vector in rows:
+                    found[text_hash] = array('f', vector).tolist()
+            now = time.time()
+            self.touched.update((text_hash, now) for text_hash in found)
+        vectors = [found.get(key) for key in keys]
+        hits = sum(vector is not None for vector in vectors)
+        self.hits += hits
+        self.misses += len(vectors) - hits
+        return keys, vectors
+
+    def store(self, keys, vectors):
+        now = time.time()
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, vector, last_used) VALUES (?, ?, ?, ?)",
+                [(self.model, key, array('f', vector).tobytes(), now) for key, vector in zip(keys, vectors)]
+            )
+            self.flush_touched()
+            self.evict()
+            self.conn.commit()
+
+    def flush_touched(self):
+        """Write the last_used times of the hits since the last flush (the caller holds the lock and commits)."""
+        if self.touched:
+            self.conn.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash = ?",
+                [(used, self.model, text_hash) for text_hash, used in self.touched.items()]
+            )
+            self.touched = {}
+
+    def evict(self):
+        """Drop the least recently used entries beyond the configured size limit."""
+        max_entries = self.config.embedding_cache_max_entries
+        if not max_entries:
+            return
+        count = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        if count > max_entries:
+            self.conn.execute(
+                "DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)",
+                (count - max_entries,)
+            )
+
+    def missing(self, texts, keys, vectors):
+        """The texts (deduplicated by key) that need embedding, with their keys."""
+        todo = {}
+        for text, key, vector in zip(texts, keys, vectors):
+            if vector is None and key not in todo:
+                todo[key] = text
+        return list(todo.keys()), list(todo.values())
+
+    def fill(self, keys, vectors, new_keys, new_vectors):
+        by_key = dict(zip(new_keys, new_vectors))
+        return [vector if vector is not None else by_key[key] for key, vector in zip(keys, vectors)]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, vectors = self.lookup(texts)
+        new_keys, new_texts = self.missing(texts, keys, vectors)
+        new_vectors = self.embeddings.embed_documents(new_texts) if new_texts else []
+        if new_texts:
+            self.store(new_keys, new_vectors)
+        return self.fill(keys, vectors, new_keys, new_vectors)
+
+    def embed_query(self, text: str) -> List[float]:
+        keys, vectors = self.lookup([text])
+        if vectors[0] is None:
+            vectors[0] = self.embeddings.embed_query(text)
+            self.store(keys, vectors)
+        return vectors[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, vectors = self.lookup(texts)
+        new_keys, new_texts = self.missing(texts, keys, vectors)
+        new_vectors = await self.embeddings.aembed_documents(new_texts) if new_texts else []
+        if new_texts:
+            self.store(new_keys, new_vectors)
+        return self.fill(keys, vectors, new_keys, new_vectors)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        keys, vectors = self.lookup([text])
+        if vectors[0] is None:
+            vectors[0] = await self.embeddings.aembed_query(text)
+            self.store(keys, vectors)
+        return vectors[0]
+
+    def stats(self):
+        total = self.hits + self.misses
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM embeddings WHERE model = ?", (self.model,)).fetchone()[0]
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'entries': entries
+        }
+
+    def close(self):
+        with self.lock:
+            self.flush_touched()
+            self.conn.commit()
+            self.conn.close()
@@ -0,0 +1,164 @@
+import asyncio
+import logging
+import random
+import time
+from instrumentation import log, metrics
+
+
+class RateLimiter:
+    """
+    Token bucket that refills a per-minute allowance continuously.
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.available = per_minute
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, amount=1):
+        # A single request larger than the whole allowance still has to go through eventually
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.available >= amount:
+                    self.available -= amount
+                    return
+                await asyncio.sleep((amount - self.available) / self.rate)
+
+
+class EmbeddingScheduler:
+    """
+    Embed ingest batches concurrently while earlier batches are written to the collection.
+
+    Texts are packed into requests under a token budget (counted with the same tiktoken
+    encoder Chroma uses), requests run concurrently under requests-per-minute and
+    tokens-per-minute limits, and rate-limit and server errors are retried with backoff.
+    """
+
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, embeddings, encoder, config):
+        self.embeddings = embeddings
+        self.encoder = encoder
+        self.config = config
+        self.requests = 0
+        self.tokens = 0
+
+    def pack(self, texts):
+        """Split texts into requests of at most embed_batch_size texts and embed_batch_tokens tokens."""
+        counts = [len(tokens) for tokens in self.encoder.encode_batch(texts, disallowed_special=())]
+        batches = []
+        batch, batch_tokens = [], 0
+        for index, count in enumerate(counts):
+            if batch and (len(batch) >= self.config.embed_batch_size
+                          or batch_tokens + count > self.config.embed_batch_tokens):
+                batches.append((batch, batch_tokens))
+                batch, batch_tokens = [], 0
+            batch.append(index)
+            batch_tokens += count
+        if batch:
+            batches.append((batch, batch_tokens))
+        return batches
+
+    def is_retryable(self, error):
+        status = getattr(error, 'status_code', None) or getattr(getattr(error, 'response', None), 'status_code', None)
+        if status in self.RETRY_STATUSES:
+            return True
+        return type(error).__name__ in ('RateLimitError', 'APIConnectionError', 'APITimeoutError', 'InternalServerError')
+
+    async def embed_request(self, texts, tokens):
+        """One embedding request, after waiting for rate-limit budget, retried with exponential backoff and jitter."""
+        attempt = 0
+        while True:
+            await self.request_limiter.acquire()
+            await self.token_limiter.acquire(tokens)
+            try:
+                async with self.in_flight:
+                    start = time.perf_counter()
+                    vectors = await self.embedder.aembed_documents(texts)
+                    metrics.observe('rag_stage_seconds', time.perf_counter() - start, stage='embed')
+                self.requests += 1
+                self.tokens += tokens
+                metrics.inc('rag_embedding_requests_total', outcome='ok')
+                metrics.inc('rag_embedding_tokens_total', tokens)
+                return vectors
+            except Exception as e:
+                retry = self.is_retryable(e) and attempt < self.config.embed_max_retries
+                metrics.inc('rag_embedding_requests_total', outcome='retried' if retry else 'failed')
+                if not retry:
+                    raise
+                delay = min(60.0, 2 ** attempt)
+                log('embed.retry', f"Embedding request failed ({type(e).__name__}), retrying in up to {delay:.0f}s",
+                    level=logging.WARNING, error=type(e).__name__, attempt=attempt + 1)
+                await asyncio.sleep(random.uniform(0, delay))
+                attempt += 1
+
+    async def embed(self, texts):
+        """Embed texts, serving what we can from the embedding cache and sending the rest in concurrent requests."""
+        if hasattr(self.embeddings, 'lookup'):
+            keys, vectors = self.embeddings.lookup(texts)
+            new_keys, new_texts = self.embeddings.missing(texts, keys, vectors)
+        else:
+            new_texts = texts
+        new_vectors = [None] * len(new_texts)
+        if new_texts:
+            requests = self.pack(new_texts)
+            results = await asyncio.gather(*(
+                self.embed_request([new_texts[i] for i in batch], tokens) for batch, tokens in requests
+            ))
+            for (batch, _), batch_vectors in zip(requests, results):
+                for i, vector in zip(batch, batch_vectors):
+                    new_vectors[i] = vector
+        if not hasattr(self.embeddings, 'lookup'):
+            return new_vectors
+        if new_texts:
+            self.embeddings.store(new_keys, new_vectors)
+        return self.embeddings.fill(keys, vectors, new_keys, new_vectors)
+
+    async def pipeline(self, batches, write):
+        """
+        Pull (texts, item) batches from a blocking iterator, embed them concurrently, and call
+        write(item, vectors) for each batch in order, in a worker thread, as soon as it is embedded.
+        At most embed_pipeline_depth batches are embedded ahead of the writer.
+        """
+        # The cache wraps the real embeddings; rate-limited requests go to the real ones
+        self.embedder = getattr(self.embeddings, 'embeddings', self.embeddings)
+        self.in_flight = asyncio.Semaphore(self.config.embed_concurrency)
+        self.request_limiter = RateLimiter(self.config.embed_requests_per_minute)
+        self.token_limiter = RateLimiter(self.config.embed_tokens_per_minute)
+        queue = asyncio.Queue(maxsize=self.config.embed_pipeline_depth)
+        batches = iter(batches)
+        start = time.perf_counter()
+
+        async def producer():
+            while True:
+                # The upstream walk/parse/split stages block, so run them off the event loop
+                batch = await asyncio.to_thread(next, batches, None)
+                if batch is None:
+                    break
+                texts, item = batch
+                await queue.put((item, asyncio.create_task(self.embed(texts))))
+            await queue.put(None)
+
+        async def writer():
+            while True:
+                entry = await queue.get()
+                if entry is None:
+                    break
+                item, task = entry
+                vectors = await task
+                await asyncio.to_thread(write, item, vectors)
+
+        await asyncio.gather(producer(), writer())
+        elapsed = time.perf_counter() - start
+        log('embed.done', f"Embedding: {self.requests} requests, {self.tokens} tokens in {elapsed:.1f}s "
+                          f"({self.tokens / elapsed if elapsed else 0:.0f} tokens/s)",
+            requests=self.requests, tokens=self.tokens, seconds=round(elapsed, 3))
+
+    def run(self, batches, write):
+        asyncio.run(self.pipeline(batches, write))
@@ -1,13 +1,18 @@
 import io
 import os
 import json
+import logging
+import httplib2
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
+from document_parser import MIME_EXTENSIONS, indexable
+from download_pool import DownloadPool
+from drive_crawler import DriveCrawler
+from instrumentation import log
 import datetime
-import hashlib
 from pathlib import Path
 import mimetypes
 import shutil
@@ -15,10 +20,42 @@ import shutil
 
 class GoogleDrive:
 
+    FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+    # Define export formats for Google Workspace files
+    EXPORT_FORMATS = {
+        'application/vnd.google-apps.document': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+        'application/vnd.google-apps.spreadsheet': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        'application/vnd.google-apps.presentation': 'application/vnd.openxmlformats-officedocument.presentationml.presentation',
+        'application/vnd.google-apps.drawing': 'application/pdf',
+        'application/vnd.google-apps.script': 'application/vnd.google-apps.script+json'
+    }
+
+    # Set file extensions
+    EXPORT_EXTENSIONS = {
+        'application/vnd.openxmlformats-officedocument.wordprocessingml.document': '.docx',
+        'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet': '.xlsx',
+        'application/vnd.openxmlformats-officedocument.presentationml.presentation': '.pptx',
+        'application/pdf': '.pdf',
+        'application/vnd.google-apps.script+json': '.json',
+        'text/plain': '.txt',
+        'text/markdown': '.md'
+    }
+
+    # Config.google_docs_export choices for Google Docs
+    DOCS_EXPORT_FORMATS = {
+        'docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+        'markdown': 'text/markdown',
+        'text': 'text/plain'
+    }
+
     def __init__(self, config):
         self.config = config
+        self.export_formats = dict(self.EXPORT_FORMATS)
+        self.export_formats['application/vnd.google-apps.document'] = self.DOCS_EXPORT_FORMATS[config.google_docs_export]
         self.authenticate()
         self.metadata = {}
+        self.sync_state = self.empty_sync_state()
 
     def authenticate(self):
         # If modifying these scopes, delete the file token.json.
@@ -44,317 +81,515 @@ class GoogleDrive:
             with open("token.json", "w") as token:
                 token.write(creds.to_json())
 
+        self.creds = creds
         self.service = build('drive', 'v3', credentials=creds)
 
 
-    def list_all_files(self, folder_id='root', path='', indent=0):
-        """List all files and folders recursively from the specified folder."""
-        # Get all files and folders in the current folder
-        results = []
-        page_token = None
-        
-        while True:
-            response = self.service.files().list(
-                q=f"'{folder_id}' in parents and trashed=false",
-                spaces='drive',
-                fields='nextPageToken, files(id, name, mimeType)',
-                pageToken=page_token
-            ).execute()
-            
-            results.extend(response.get('files', []))
-            page_token = response.get('nextPageToken')
-            
-            if not page_token:
-                break
-        
+    def list_all_files(self, drive_map, folder_id='root', path='', indent=0):
+        """Log the folder tree from a drive_map (at DEBUG), without listing Drive again."""
+        if indent == 0:
+            # Index the map by parent once, then walk it
+            children = {}
+            for folder in drive_map['folders']:
+                children.setdefault(folder['parent_id'], ([], []))[0].append(folder)
+            for file in drive_map['files']:
+                children.setdefault(file['parent_id'], ([], []))[1].append(file)
+            drive_map = children
+
         # Print the current path
-        print(f"{' ' * indent}📂 {path or 'My Drive'}")
-        
-        # Process files and folders
-        folders = []
-        files = []
-        
-        for item in results:
-            if item['mimeType'] == 'application/vnd.google-apps.folder':
-                folders.append(item)
-            else:
-                files.append(item)
-        
+        log('sync.tree', f"{' ' * indent}📂 {path or 'My Drive'}", level=logging.DEBUG, folder=path)
+
+        folders, files = drive_map.get(folder_id, ([], []))
+
         # First list all folders
         for folder in folders:
-            new_path = os.path.join(path, folder['name'])
-            self.list_all_files(folder['id'], new_path, indent + 2)
-        
+            self.list_all_files(drive_map, folder['id'], folder['path'], indent + 2)
+
         # Then list all files
         for file in files:
-            print(f"{' ' * (indent + 2)}📄 {file['name']}")
+            log('sync.tree', f"{' ' * (indent + 2)}📄 {file['name']}", level=logging.DEBUG, file=file['path'])
 
     def map_drive_structure(self, folder_id='root', path=''):
         """Map the structure of Google Drive and return a dictionary of all files and folders."""
-        drive_map = {'files': [], 'folders': []}
-        
-        # Get all files and folders in the current folder
-        results = []
-        page_token = None
-        
-        while True:
-            response = self.service.files().list(
-                q=f"'{folder_id}' in parents and trashed=false",
-                spaces='drive',
-                fields='nextPageToken, files(id, name, mimeType, size, modifiedTime)',
-                pageToken=page_token
-            ).execute()
+        crawler = DriveCrawler(self.config, self.new_service, self.file_item)
+        return crawler.crawl(folder_id, path)
+
+    def file_item(self, item, item_path, parent_id):
+        """Build a drive_map file entry from a Drive API file resource."""
+        return {
+            'id': item['id'],
+            'name': item['name'],
+            'google_drive_url': f"https://drive.google.com/file/d/{item['id']}/view",
+            'path': item_path,
+            'parent_id': parent_id,
+            'mime_type': item['mimeType'],
+            'size': item.get('size'),
+            'modified_time': item.get('modifiedTime'),
+            'md5_checksum': item.get('md5Checksum')
+        }
+
+    def local_path_for(self, file_item, local_base_path):
+        """Return the local path a Drive file is (or will be) stored at, including any export extension."""
+        file_path = os.path.join(local_base_path, file_item['path'])
+        export_mime = self.export_formats.get(file_item['mime_type'])
+        if export_mime:
+            file_extension = self.EXPORT_EXTENSIONS.get(export_mime, '')
+        elif not indexable(file_path):
+            # A file named without the extension its type would be indexed under
+            file_extension = MIME_EXTENSIONS.get(file_item['mime_type'], '')
+        else:
+            file_extension = ''
+        if not file_path.endswith(file_extension):
+            file_path = f"{file_path}{file_extension}"
+        return file_path
+
+    def is_indexable(self, file_item):
+        """Whether a loader can index the file as it will be stored locally; nothing else is downloaded."""
+        return indexable(self.local_path_for(file_item, ''))
+
+    def is_up_to_date(self, file_item, local_base_path):
+        """Check the manifest to see whether a file is already downloaded at its current revision."""
+        entry = self.sync_state['files'].get(file_item['id'])
+        if not entry:
+            return False
+        return (
+            entry['path'] == file_item['path']
+            and entry['modified_time'] == file_item['modified_time']
+            and entry.get('md5_checksum') == file_item.get('md5_checksum')
+            and entry['local_path'] == self.local_path_for(file_item, local_base_path)
+            and os.path.exists(entry['local_path'])
+            and file_item['id'] in self.metadata
+        )
 
-            results.extend(response.get('files', []))
-            page_token = response.get('nextPageToken')
-            
-            if not page_token:
-                break
-        
-        # Process files and folders
-        for item in results:
-            item_path = os.path.join(path, item['name'])
-            
-            if item['mimeType'] == 'application/vnd.google-apps.folder' and item['name'] not in self.config.folders_ignore:
-                # Add folder to the map
-                drive_map['folders'].append({
-                    'id': item['id'],
-                    'name': item['name'],
-                    'path': item_path
-                })
-                
-                # Recursively map files from this folder
-                sub_map = self.map_drive_structure(item['id'], item_path)
-                drive_map['files'].extend(sub_map['files'])
-                drive_map['folders'].extend(sub_map['folders'])
-            else:
-                # Add file to the map
-                drive_map['files'].append({
-                    'id': item['id'],
-                    'name': item['name'],
-                    'google_drive_url': f"https://drive.google.com/file/d/{item['id']}/view",
-                    'path': item_path,
-                    'mime_type': item['mimeType'],
-                    'size': item.get('size'),
-                    'modified_time': item.get('modifiedTime')
-                })
-        
-        return drive_map
-    
     def download_files(self, drive_map, local_base_path):
-        """Download all files from Google Drive and remove local files that no longer exist in Drive."""
-        # Create a set of all remote file paths
-        remote_paths = {item['path'] for item in drive_map['files']}
+        """Download new or changed files from Google Drive and remove local files that no longer exist in Drive."""
+        # Files no loader can index are neither downloaded nor kept
+        indexed_files = [item for item in drive_map['files'] if self.is_indexable(item)]
+        skipped_types = len(drive_map['files']) - len(indexed_files)
+        log('sync.unindexed', f"{skipped_types} files of types that are not indexed will not be downloaded.",
+            files=skipped_types)
+        # Create a set of all expected local file paths
+        remote_paths = {
+            os.path.relpath(self.local_path_for(item, local_base_path), local_base_path)
+            for item in indexed_files
+        }
         local_files_to_delete = []
-        
+
         # First, create all folders
-        print("\nCreating folder structure...")
+        log('sync.stage', "Creating folder structure...", stage='folders')
         for folder in drive_map['folders']:
             folder_path = os.path.join(local_base_path, folder['path'])
             if not os.path.exists(folder_path):
                 os.makedirs(folder_path, exist_ok=True)
-                print(f"Created directory: {folder_path}")
-        
+                log('sync.mkdir', f"Created directory: {folder_path}", level=logging.DEBUG, path=folder_path)
+
         # Find local files that don't exist in remote
-        print("\nChecking for files to delete...")
+        log('sync.stage', "Checking for files to delete...", stage='deletions')
         for root, dirs, files in os.walk(local_base_path):
             for file in files:
                 local_path = os.path.join(root, file)
                 rel_path = os.path.relpath(local_path, local_base_path)
-                
+
                 if rel_path not in remote_paths:
                     local_files_to_delete.append(local_path)
-        
+
         # Delete local files that don't exist in Google Drive
         if local_files_to_delete:
-            print(f"Found {len(local_files_to_delete)} files to delete.")
+            log('sync.deletions', f"Found {len(local_files_to_delete)} files to delete.", files=len(local_files_to_delete))
             for file_path in local_files_to_delete:
                 try:
                     os.remove(file_path)
-                    print(f"Deleted: {file_path}")
+                    log('sync.delete', f"Deleted: {file_path}", level=logging.DEBUG, path=file_path)
                 except Exception as e:
-                    print(f"Error deleting {file_path}: {str(e)}")
+                    log('sync.error', f"Error deleting {file_path}: {str(e)}", level=logging.ERROR, path=file_path,
+                        error=str(e))
         else:
-            print("No files to delete.")
-        
-        # Download all files
-        print("\nDownloading files...")
-        total_files = len(drive_map['files'])
-        for index, file_item in enumerate(drive_map['files']):
-            file_id = file_item['id']
-            file_name = file_item['name']
-            file_path = os.path.join(local_base_path, file_item['path'])
-            progress = f"[{index+1}/{total_files}]"
-            
-            # Check if file is a Google Workspace file
-            if file_item['mime_type'].startswith('application/vnd.google-apps'):
-                self.handle_google_workspace_file(file_item, file_path)
-            else:
-                # Regular file download
-                try:
-                    request = self.service.files().get_media(fileId=file_id)
-                    file_size = int(file_item.get('size', 0)) if file_item.get('size') else 'unknown'
-                    file_size_str = f"{file_size / 1024 / 1024:.2f} MB" if isinstance(file_size, int) else file_size
-                    
-                    print(f"{progress} Downloading: {file_item['path']} ({file_size_str})")
-                    
-                    # Create directory if it doesn't exist
-                    os.makedirs(os.path.dirname(file_path), exist_ok=True)
-                    
-                    with open(file_path, 'wb') as f:                        
-                        downloader = MediaIoBaseDownload(f, request)
-                        done = False
-                        while not done:
-                            status, done = downloader.next_chunk()
-                            print(f"\r{progress} Download {int(status.progress() * 100)}%", end="")
-                        print()  # New line after download completes
-
-                    #--------Extract rich metadata from a file-------
-                    file_path = Path(file_path)
-                    directory_path = Path(self.config.downloaded_files_path)
-                    stat_info = file_path.stat()
-                    
-                    # Get file information
-                    #file_size = stat_info.st_size
-                    created_time = datetime.datetime.fromtimestamp(stat_info.st_ctime)
-                    modified_time = datetime.datetime.fromtimestamp(stat_info.st_mtime)
-                    
-                    # Get relative path from the base directory
-                    rel_path = file_path.relative_to(directory_path)
-                    
-                    # Generate file hash for unique identification
-                    file_hash = ""
-                    try:
-                        with open(file_path, "rb") as f:
-                            content = f.read()
-                            file_hash = hashlib.md5(content).hexdigest()
-                    except Exception as e:
-                        print(f"Could not generate hash for {file_path}: {e}")
-                    
-                    # Get mime type
-                    mime_type, _ = mimetypes.guess_type(str(file_path))
-                    
-                    # Build metadata dict                    
-                    self.metadata[file_hash] = {
-                        "source": str(file_path),
-                        "filename": file_path.name,
-                        "extension": file_path.suffix.lower(),
-                        "created_date": created_time.isoformat(),
-                        "modified_date": modified_time.isoformat(),
-                        "relative_path": str(rel_path),
-                        "parent_directory": str(rel_path.parent),
-                        "file_hash": file_hash,
-                        "mime_type": mime_type or "unknown",
-                        "processing_date": datetime.datetime.now().isoformat(),
-                        "google_drive_url": file_item['google_drive_url'],
-                        "google_drive_id": file_item['id']
-                    }
-                    
-                except Exception as e:
-                    print(f"Error downloading {file_name}: {str(e)}")
+            log('sync.deletions', "No files to delete.", files=0)
+
+        # Forget manifest entries for files that are gone from Drive
+        remote_ids = {item['id'] for item in indexed_files}
+        for file_id in list(self.sync_state['files']):
+            if file_id not in remote_ids:
+                self.forget_file(file_id)
+        self.sync_state['folders'].update({
+            folder['id']: {'name': folder['name'], 'path': folder['path'], 'parent_id': folder['parent_id']}
+            for folder in drive_map['folders']
+        })
+
+        # Download new and changed files
+        log('sync.stage', "Downloading files...", stage='downloads')
+        jobs = []
+        skipped = 0
+        for file_item in indexed_files:
+            if self.is_up_to_date(file_item, local_base_path):
+                skipped += 1
+                continue
+            job = self.download_job(file_item, local_base_path)
+            if job:
+                jobs.append(job)
+        log('sync.downloads', f"{skipped} files unchanged since the last sync, {len(jobs)} to download.",
+            unchanged=skipped, downloads=len(jobs))
+        self.run_downloads(jobs)
 
         # Clean up empty directories
         self.clean_empty_directories(local_base_path)
 
+    def new_service(self):
+        """Build a Drive service with its own HTTP client, for use by a single download worker."""
+        http = AuthorizedHttp(self.creds, http=httplib2.Http())
+        return build('drive', 'v3', http=http, cache_discovery=False)
+
+    def run_downloads(self, jobs):
+        """Download jobs through the parallel pool and record each finished file in the metadata and manifest."""
+        pool = DownloadPool(self.config, self.new_service)
+        for job, error in pool.run(jobs):
+            if error:
+                log('download.error', f"Error downloading {job['file_item']['name']}: {str(error)}",
+                    level=logging.WARNING, path=job['file_item']['path'], error=str(error))
+                continue
+            self.record_file(job['file_item'], job['file_path'], job['file_hash'])
+
+    def download_job(self, file_item, local_base_path):
+        """Describe how to download a single file, for run_downloads (None if it is not to be downloaded)."""
+        if not self.is_indexable(file_item):
+            return None
+        file_path = self.local_path_for(file_item, local_base_path)
+
+        # Check if file is a Google Workspace file
+        if file_item['mime_type'].startswith('application/vnd.google-apps'):
+            return self.handle_google_workspace_file(file_item, file_path)
+
+        # Regular file download
+        file_id = file_item['id']
+        return {
+            'file_item': file_item,
+            'file_path': file_path,
+            'request': lambda service: service.files().get_media(fileId=file_id)
+        }
+
     def handle_google_workspace_file(self, file_item, file_path):
         """Handle Google Workspace files (Docs, Sheets, Slides, etc.) by exporting them."""
         file_id = file_item['id']
         mime_type = file_item['mime_type']
         file_name = file_item['name']
-        
-        # Define export formats for Google Workspace files
-        export_formats = {
-            'application/vnd.google-apps.document': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-            'application/vnd.google-apps.spreadsheet': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            'application/vnd.google-apps.presentation': 'application/vnd.openxmlformats-officedocument.presentationml.presentation',
-            'application/vnd.google-apps.drawing': 'application/pdf',
-            'application/vnd.google-apps.script': 'application/vnd.google-apps.script+json'
-        }
-        
-        # Set file extensions
-        extensions = {
-            'application/vnd.openxmlformats-officedocument.wordprocessingml.document': '.docx',
-            'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet': '.xlsx',
-            'application/vnd.openxmlformats-officedocument.presentationml.presentation': '.pptx',
-            'application/pdf': '.pdf',
-            'application/vnd.google-apps.script+json': '.json'
-        }
-        
-        if mime_type in export_formats:
-            export_mime = export_formats[mime_type]
-            file_extension = extensions.get(export_mime, '')
-            
+
+        if mime_type in self.export_formats:
+            export_mime = self.export_formats[mime_type]
+            file_extension = self.EXPORT_EXTENSIONS.get(export_mime, '')
+
             # Make sure we add the right extension if it's not already there
             if not file_path.endswith(file_extension):
                 file_path = f"{file_path}{file_extension}"
-            
+
+            return {
+                'file_item': file_item,
+                'file_path': file_path,
+                'request': lambda service: service.files().export_media(fileId=file_id, mimeType=export_mime)
+            }
+        else:
+            log('download.unsupported', f"Unsupported Google Workspace format: {mime_type} for file: {file_name}",
+                level=logging.WARNING, mime_type=mime_type, file=file_name)
+            return None
+
+    @staticmethod
+    def drive_timestamp(modified_time):
+        """Seconds since the epoch from Drive's RFC 3339 modifiedTime, or None"""
+        if not modified_time:
+            return None
+        return datetime.datetime.fromisoformat(modified_time.replace('Z', '+00:00')).timestamp()
+
+    def record_file(self, file_item, file_path, file_hash):
+        """Extract rich metadata from a downloaded file (hashed while it streamed) and record it in the manifest."""
+        file_path = Path(file_path)
+        directory_path = Path(self.config.downloaded_files_path)
+        stat_info = file_path.stat()
+
+        # Get file information
+        #file_size = stat_info.st_size
+        created_time = datetime.datetime.fromtimestamp(stat_info.st_ctime)
+        modified_time = datetime.datetime.fromtimestamp(stat_info.st_mtime)
+
+        # Get relative path from the base directory
+        rel_path = file_path.relative_to(directory_path)
+
+        # Get mime type
+        mime_type, _ = mimetypes.guess_type(str(file_path))
+
+        # Drop the metadata of the revision we are replacing (and its old copy if it moved)
+        previous = self.sync_state['files'].get(file_item['id'])
+        if previous:
+            self.forget_file(file_item['id'], delete_local=previous['local_path'] != str(file_path))
+
+        # Build metadata dict, one per Drive file so identical copies keep their own name, folder and link
+        self.metadata[file_item['id']] = {
+            "source": str(file_path),
+            "filename": file_path.name,
+            "extension": file_path.suffix.lower(),
+            "created_date": created_time.isoformat(),
+            "modified_date": modified_time.isoformat(),
+            "modified_timestamp": self.drive_timestamp(file_item.get('modified_time')) or stat_info.st_mtime,
+            "relative_path": str(rel_path),
+            "parent_directory": str(rel_path.parent),
+            "file_hash": file_hash,
+            "mime_type": mime_type or "unknown",
+            "processing_date": datetime.datetime.now().isoformat(),
+            "google_drive_url": file_item['google_drive_url'],
+            "google_drive_id": file_item['id']
+        }
+
+        # Remember which revision we have locally
+        self.sync_state['files'][file_item['id']] = {
+            'name': file_item['name'],
+            'path': file_item['path'],
+            'parent_id': file_item.get('parent_id'),
+            'local_path': str(file_path),
+            'mime_type': file_item['mime_type'],
+            'size': file_item.get('size'),
+            'modified_time': file_item.get('modified_time'),
+            'md5_checksum': file_item.get('md5_checksum'),
+            'google_drive_url': file_item['google_drive_url'],
+            'file_hash': file_hash
+        }
+
+    def forget_file(self, file_id, delete_local=True):
+        """Remove a file from the manifest and metadata, and optionally delete its local copy."""
+        entry = self.sync_state['files'].pop(file_id, None)
+        if not entry:
+            return
+        self.metadata.pop(file_id, None)
+        if delete_local and os.path.exists(entry['local_path']):
             try:
-                request = self.service.files().export_media(fileId=file_id, mimeType=export_mime)
-                
-                print(f"Exporting Google Workspace file: {file_name} as {file_extension}")
-                
-                # Create directory if it doesn't exist
-                os.makedirs(os.path.dirname(file_path), exist_ok=True)
-                
-                with open(file_path, 'wb') as f:
-                    downloader = MediaIoBaseDownload(f, request)
-                    done = False
-                    while not done:
-                        status, done = downloader.next_chunk()
-                        print(f"\rExport {int(status.progress() * 100)}%", end="")
-                    print()  # New line after export completes
-                
-                #--------Extract rich metadata from a file-------
-                file_path = Path(file_path)
-                directory_path = Path(self.config.downloaded_files_path)
-                stat_info = file_path.stat()
-                
-                # Get file information
-                #file_size = stat_info.st_size
-                created_time = datetime.datetime.fromtimestamp(stat_info.st_ctime)
-                modified_time = datetime.datetime.fromtimestamp(stat_info.st_mtime)
-                
-                # Get relative path from the base directory
-                rel_path = file_path.relative_to(directory_path)
-                
-                # Generate file hash for unique identification
-                file_hash = ""
-                try:
-                    with open(file_path, "rb") as f:
-                        content = f.read()
-                        file_hash = hashlib.md5(content).hexdigest()
-                except Exception as e:
-                    print(f"Could not generate hash for {file_path}: {e}")
-                
-                # Get mime type
-                mime_type, _ = mimetypes.guess_type(str(file_path))
-
-                # Build metadata dict                    
-                self.metadata[file_hash] = {
-                    "source": str(file_path),
-                    "filename": file_path.name,
-                    "extension": file_path.suffix.lower(),
-                    "created_date": created_time.isoformat(),
-                    "modified_date": modified_time.isoformat(),
-                    "relative_path": str(rel_path),
-                    "parent_directory": str(rel_path.parent),
-                    "file_hash": file_hash,
-                    "mime_type": mime_type or "unknown",
-                    "processing_date": datetime.datetime.now().isoformat(),
-                    "google_drive_url": file_item['google_drive_url'],
-                    "google_drive_id": file_item['id']
-                }
-                
-                print(f"Exported: {file_path}")
+                os.remove(entry['local_path'])
+                log('sync.delete', f"Deleted: {entry['local_path']}", level=logging.DEBUG, path=entry['local_path'])
             except Exception as e:
-                print(f"Error exporting {file_name}: {str(e)}")
-        else:
-            print(f"Unsupported Google Workspace format: {mime_type} for file: {file_name}")
+                log('sync.error', f"Error deleting {entry['local_path']}: {str(e)}", level=logging.ERROR,
+                    path=entry['local_path'], error=str(e))
+
+    def empty_sync_state(self):
+        return {'start_page_token': None, 'root_id': None, 'folders': {}, 'files': {}}
+
+    def load_sync_state(self):
+        """Load the change-page token, manifest and metadata from the previous sync. Returns True if found."""
+        if not os.path.exists(self.config.sync_state_file) or not os.path.exists(self.config.metadata_file):
+            return False
+        with open(self.config.sync_state_file) as f:
+            self.sync_state = json.load(f)
+        with open(self.config.metadata_file) as f:
+            # Older metadata files are keyed by file hash, with one entry for all identical copies
+            self.metadata = {metadata.get('google_drive_id', key): metadata for key, metadata in json.load(f).items()}
+        return bool(self.sync_state.get('start_page_token'))
+
+    def save_sync_state(self):
+        with open(self.config.sync_state_file, "w") as outfile:
+            json.dump(self.sync_state, outfile, indent=4)
+
+    def begin_full_sync(self):
+        """Record the change-page token before a full crawl, so changes made during the crawl are picked up next time."""
+        self.sync_state['start_page_token'] = self.service.changes().getStartPageToken().execute()['startPageToken']
+        root_id = self.service.files().get(fileId='root', fields='id').execute()['id']
+        self.sync_state['root_id'] = root_id
+        self.sync_state['folders'] = {root_id: {'name': 'My Drive', 'path': '', 'parent_id': None}}
+
+    def fetch_changes(self):
+        """Fetch every change since the stored page token. Returns the changes and the next start token."""
+        changes = {}
+        page_token = self.sync_state['start_page_token']
+        new_start_page_token = None
+
+        while page_token:
+            response = self.service.changes().list(
+                pageToken=page_token,
+                spaces='drive',
+                includeRemoved=True,
+                fields='nextPageToken, newStartPageToken, changes(fileId, removed, file(id, name, mimeType, size, modifiedTime, md5Checksum, parents, trashed))'
+            ).execute()
+
+            # Later changes to the same file supersede earlier ones
+            for change in response.get('changes', []):
+                changes[change['fileId']] = change
+            page_token = response.get('nextPageToken')
+            new_start_page_token = response.get('newStartPageToken', new_start_page_token)
+
+        return list(changes.values()), new_start_page_token
+
+    def sync_changes(self, local_base_path):
+        """Apply added, changed and removed Drive files since the last sync to the local tree and metadata."""
+        changes, new_start_page_token = self.fetch_changes()
+        log('sync.changes', f"Found {len(changes)} changes since the last sync.", changes=len(changes))
+        folders = self.sync_state['folders']
+        jobs = []
+
+        folder_changes = []
+        file_changes = []
+        for change in changes:
+            item = change.get('file')
+            if (item and item['mimeType'] == self.FOLDER_MIME_TYPE) or change['fileId'] in folders:
+                folder_changes.append(change)
+            else:
+                file_changes.append(change)
+
+        # Folders first, so files can be placed under new or moved folders. A folder's
+        # parent may itself be new in this batch, so repeat until nothing else resolves.
+        pending = folder_changes
+        while pending:
+            unresolved = []
+            for change in pending:
+                item = change.get('file')
+                parent_id = (item.get('parents') or [None])[0] if item else None
+                tracked = (
+                    not change.get('removed') and item and not item.get('trashed')
+                    and item['name'] not in self.config.folders_ignore
+                )
+                if tracked and parent_id not in folders:
+                    unresolved.append(change)
+                    continue
+                if not tracked:
+                    if change['fileId'] in folders:
+                        self.remove_folder(change['fileId'])
+                    continue
+                new_path = os.path.join(folders[parent_id]['path'], item['name'])
+                if change['fileId'] not in folders:
+                    # New, or moved in from outside the tracked tree: crawl its contents
+                    jobs.extend(self.add_folder(item['id'], item['name'], new_path, parent_id, local_base_path))
+                elif folders[change['fileId']]['path'] != new_path:
+                    self.move_folder(change['fileId'], new_path, parent_id, local_base_path)
+            if len(unresolved) == len(pending):
+                # Parents outside the tracked tree (ignored folders, shared drives, ...)
+                for change in unresolved:
+                    if change['fileId'] in folders:
+                        self.remove_folder(change['fileId'])
+                break
+            pending = unresolved
+
+        # Files inside newly tracked folders are already queued by the crawl
+        queued = {job['file_item']['id'] for job in jobs}
+        for change in file_changes:
+            if change['fileId'] in queued:
+                continue
+            item = change.get('file')
+            parent_id = (item.get('parents') or [None])[0] if item else None
+            if change.get('removed') or not item or item.get('trashed') or parent_id not in folders:
+                self.forget_file(change['fileId'])
+                continue
+
+            file_item = self.file_item(item, os.path.join(folders[parent_id]['path'], item['name']), parent_id)
+            if not self.is_indexable(file_item):
+                self.forget_file(change['fileId'])
+                continue
+            if self.is_up_to_date(file_item, local_base_path):
+                continue
+            entry = self.sync_state['files'].get(file_item['id'])
+            # Renames bump modifiedTime, so compare content by checksum where Drive has one
+            if entry and entry.get('md5_checksum'):
+                same_content = entry['md5_checksum'] == file_item.get('md5_checksum')
+            else:
+                same_content = entry is not None and entry['modified_time'] == file_item['modified_time']
+            if same_content and os.path.exists(entry['local_path']):
+                # Renamed or moved only: no need to download again
+                self.move_file(file_item, local_base_path)
+            else:
+                job = self.download_job(file_item, local_base_path)
+                if job:
+                    jobs.append(job)
+        self.run_downloads(jobs)
+
+        if new_start_page_token:
+            self.sync_state['start_page_token'] = new_start_page_token
+        self.clean_empty_directories(local_base_path)
+
+    def add_folder(self, folder_id, name, path, parent_id, local_base_path):
+        """Start tracking a folder and return download jobs for everything already inside it."""
+        self.sync_state['folders'][folder_id] = {'name': name, 'path': path, 'parent_id': parent_id}
+        sub_map = self.map_drive_structure(folder_id, path)
+        for folder in sub_map['folders']:
+            self.sync_state['folders'][folder['id']] = {
+                'name': folder['name'], 'path': folder['path'], 'parent_id': folder['parent_id']
+            }
+        os.makedirs(os.path.join(local_base_path, path), exist_ok=True)
+        jobs = []
+        for file_item in sub_map['files']:
+            if not self.is_up_to_date(file_item, local_base_path):
+                job = self.download_job(file_item, local_base_path)
+                if job:
+                    jobs.append(job)
+        return jobs
+
+    def descendant_folders(self, folder_id):
+        """Return the ids of a folder and every tracked folder below it."""
+        descendants = {folder_id}
+        changed = True
+        while changed:
+            changed = False
+            for other_id, folder in self.sync_state['folders'].items():
+                if other_id not in descendants and folder['parent_id'] in descendants:
+                    descendants.add(other_id)
+                    changed = True
+        return descendants
+
+    def remove_folder(self, folder_id):
+        """Stop tracking a folder and delete every file below it."""
+        descendants = self.descendant_folders(folder_id)
+        for file_id, entry in list(self.sync_state['files'].items()):
+            if entry.get('parent_id') in descendants:
+                self.forget_file(file_id)
+        for other_id in descendants:
+            self.sync_state['folders'].pop(other_id, None)
+
+    def move_folder(self, folder_id, new_path, parent_id, local_base_path):
+        """Rename or move a tracked folder locally, updating the paths of everything below it."""
+        folders = self.sync_state['folders']
+        old_path = folders[folder_id]['path']
+        old_local = os.path.join(local_base_path, old_path)
+        new_local = os.path.join(local_base_path, new_path)
+        log('sync.move', f"Moving folder: {old_path} -> {new_path}", level=logging.DEBUG, old=old_path, new=new_path)
+        if os.path.exists(old_local):
+            os.makedirs(os.path.dirname(new_local) or '.', exist_ok=True)
+            shutil.move(old_local, new_local)
+
+        folders[folder_id]['parent_id'] = parent_id
+        folders[folder_id]['name'] = os.path.basename(new_path)
+        for other_id in self.descendant_folders(folder_id):
+            folders[other_id]['path'] = new_path + folders[other_id]['path'][len(old_path):]
+        for file_id, entry in self.sync_state['files'].items():
+            if entry['path'].startswith(old_path + os.sep):
+                entry['path'] = new_path + entry['path'][len(old_path):]
+                entry['local_path'] = new_local + entry['local_path'][len(old_local):]
+                self.update_location(file_id, entry)
+
+    def move_file(self, file_item, local_base_path):
+        """Move an unchanged file to its new local path after a rename or move in Drive."""
+        entry = self.sync_state['files'][file_item['id']]
+        new_local = self.local_path_for(file_item, local_base_path)
+        log('sync.move', f"Moving: {entry['path']} -> {file_item['path']}", level=logging.DEBUG,
+            old=entry['path'], new=file_item['path'])
+        os.makedirs(os.path.dirname(new_local), exist_ok=True)
+        shutil.move(entry['local_path'], new_local)
+        entry.update({
+            'name': file_item['name'],
+            'path': file_item['path'],
+            'parent_id': file_item['parent_id'],
+            'local_path': new_local
+        })
+        self.update_location(file_item['id'], entry)
+
+    def update_location(self, file_id, entry):
+        """Point a file's metadata at its new local path."""
+        metadata = self.metadata.get(file_id)
+        if not metadata:
+            return
+        file_path = Path(entry['local_path'])
+        rel_path = file_path.relative_to(Path(self.config.downloaded_files_path))
+        metadata.update({
+            "source": str(file_path),
+            "filename": file_path.name,
+            "relative_path": str(rel_path),
+            "parent_directory": str(rel_path.parent)
+        })
 
     def save_metadata(self):
          # Serializing json
         json_object = json.dumps(self.metadata, indent=4)
-        
+
         # Writing to sample.json
         with open(self.config.metadata_file, "w") as outfile:
             outfile.write(json_object)
@@ -367,15 +602,19 @@ class GoogleDrive:
                 try:
                     if not os.listdir(dir_path):  # Check if directory is empty
                         os.rmdir(dir_path)
-                        print(f"Removed empty directory: {dir_path}")
+                        log('sync.rmdir', f"Removed empty directory: {dir_path}", level=logging.DEBUG, path=dir_path)
                 except Exception as e:
-                    print(f"Error removing directory {dir_path}: {str(e)}")
+                    log('sync.error', f"Error removing directory {dir_path}: {str(e)}", level=logging.ERROR,
+                        path=dir_path, error=str(e))
 
     def remove_files(self):
         try:
             shutil.rmtree(self.config.downloaded_files_path)
-            print(f"Directory '{self.config.downloaded_files_path}' and its contents removed.")
+            log('sync.reset', f"Directory '{self.config.downloaded_files_path}' and its contents removed.",
+                path=self.config.downloaded_files_path)
         except FileNotFoundError:
-            print(f"Directory '{self.config.downloaded_files_path}' not found.")
+            log('sync.reset', f"Directory '{self.config.downloaded_files_path}' not found.", level=logging.WARNING,
+                path=self.config.downloaded_files_path)
         except OSError as e:
-            print(f"Error removing directory '{self.config.downloaded_files_path}': {e}")
\ No newline at end of file
+            log('sync.error', f"Error removing directory '{self.config.downloaded_files_path}': {e}",
+                level=logging.ERROR, path=self.config.downloaded_files_path, error=str(e))
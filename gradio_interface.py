@@ -1,31 +1,235 @@
+import asyncio
+import threading
+import time
+from collections import Counter, OrderedDict
 import numpy as np
-from langchain.memory import ConversationBufferMemory
-from langchain.chains import ConversationalRetrievalChain
+from langchain.memory.prompt import SUMMARY_PROMPT
+from langchain.chains.conversational_retrieval.prompts import CONDENSE_QUESTION_PROMPT
+from langchain.chains.question_answering.stuff_prompt import PROMPT_SELECTOR
+from langchain_core.output_parsers import StrOutputParser
 from langchain_openai import ChatOpenAI
 import gradio as gr
+from answer_cache import AnswerCache
+from context_compression import ContextCompressor
+from conversation_memory import ConversationMemory
+from instrumentation import metrics, serve_metrics
+from metadata_catalog import to_timestamp
+from reranker import Reranker
 
 class GradioInterface:
-    def __init__(self, config, chroma):
+    def __init__(self, config, chroma, llm=None):
         self.config = config
         self.chroma = chroma
+        self.llm = llm
+        self.cache = AnswerCache(config)
+        # Questions being answered from each index, so a swapped-out index is only closed once they are done
+        self.index_users = Counter()
+        self.index_lock = threading.Lock()
+        # One conversation memory per browser session, least recently used dropped beyond chat_max_sessions
+        self.sessions = OrderedDict()
+        self.sessions_lock = threading.Lock()
         self.chat_setup()
 
     def chat_setup(self):
         # create a new Chat with OpenAI
-        llm = ChatOpenAI(temperature=0.7, model_name=self.config.model)
+        llm = self.llm or ChatOpenAI(temperature=0.7, model_name=self.config.model, streaming=True)
 
-        # set up the conversation memory for the chat
-        memory = ConversationBufferMemory(memory_key='chat_history', return_messages=True)
+        # The steps of a ConversationalRetrievalChain, run one by one so the caches can sit between them:
+        # rephrase a follow-up into a standalone question, retrieve chunks for it, answer from the chunks
+        self.question_generator = CONDENSE_QUESTION_PROMPT | llm | StrOutputParser()
+        self.answer_chain = PROMPT_SELECTOR.get_prompt(llm) | llm | StrOutputParser()
+        # folds turns that leave the memory window into the running summary
+        self.summarizer = SUMMARY_PROMPT | llm | StrOutputParser()
+        # picks the chunks for the answer prompt from a wider pool of search results
+        self.reranker = Reranker(self.config, self.chroma.encoder)
+        # keeps the parts of those chunks that bear on the question, with citations
+        self.compressor = ContextCompressor(self.config, self.chroma.encoder)
 
-        # the retriever is an abstraction over the VectorStore that will be used during RAG
-        retriever = self.chroma.db.as_retriever(search_kwargs={"k": 5})
+    def memory_for(self, session_id):
+        """
+        The conversation memory of a session, created on its first question
+        """
+        with self.sessions_lock:
+            memory = self.sessions.pop(session_id, None)
+            if memory is None:
+                # set up the conversation memory for the chat
+                memory = ConversationMemory(self.config, self.chroma.encoder, self.summarizer)
+            self.sessions[session_id] = memory
+            while len(self.sessions) > self.config.chat_max_sessions:
+                self.sessions.popitem(last=False)
+        return memory
 
-        # putting it together: set up the conversation chain with the GPT 3.5 LLM, the vector store and memory
-        self.conversation_chain = ConversationalRetrievalChain.from_llm(llm=llm, retriever=retriever, memory=memory)
+    async def standalone_question(self, question, memory):
+        chat_history = memory.history()
+        if not chat_history:
+            return question
+        start = time.perf_counter()
+        standalone = await self.question_generator.ainvoke({'question': question, 'chat_history': chat_history})
+        metrics.observe('rag_stage_seconds', time.perf_counter() - start, stage='condense_question')
+        return standalone
 
-    def chat(self, question, history):
-        result = self.conversation_chain.invoke({"question": question})
-        return result["answer"]
-    
-    def run(self):
-        view = gr.ChatInterface(self.chat, type="messages").launch(inbrowser=True)
\ No newline at end of file
+    def acquire_index(self):
+        """The index being served, counted as in use until release_index"""
+        with self.index_lock:
+            chroma = self.chroma
+            self.index_users[chroma] += 1
+        return chroma
+
+    def release_index(self, chroma):
+        with self.index_lock:
+            self.index_users[chroma] -= 1
+            if self.index_users[chroma] <= 0:
+                del self.index_users[chroma]
+
+    def index_in_use(self, chroma):
+        """Whether a question is still being answered from this index"""
+        with self.index_lock:
+            return self.index_users[chroma] > 0
+
+    def retrieve(self, chroma, question, embedding, generation, filters=None):
+        """
+        The chunks for the answer prompt: the top retrieval_candidates search results, diversified, optionally
+        reranked and packed into the prompt's token budget by the reranker
+        """
+        k = self.config.retrieval_k
+        docs = self.cache.get_documents(embedding, k, generation, filters)
+        metrics.inc('rag_retrieval_cache_total', outcome='miss' if docs is None else 'hit')
+        if docs is None:
+            candidates = chroma.search(question, k=self.config.retrieval_candidates, embedding=embedding,
+                                       filters=filters)
+            docs = self.reranker.select(question, candidates, chroma.cached_vectors(candidates))
+            self.cache.put_documents(embedding, k, docs, generation, filters)
+        return docs
+
+    async def stream_answer(self, question, filters=None):
+        """
+        Stream the answer to a standalone question: exact-match cache, then semantic cache, then retrieval
+        (itself cached) and the LLM, whose tokens are yielded as they arrive. The whole answer comes from
+        the index served when the question arrived, even if another is swapped in meanwhile.
+        """
+        chroma = self.acquire_index()
+        try:
+            async for token in self.answer_from(chroma, question, filters):
+                yield token
+        finally:
+            self.release_index(chroma)
+
+    async def answer_from(self, chroma, question, filters):
+        generation = chroma.index_generation()
+        answer = self.cache.get_exact(question, generation, filters)
+        if answer is not None:
+            metrics.inc('rag_chat_requests_total', answered_by='exact_cache')
+            yield answer
+            return
+        start = time.perf_counter()
+        embedding = await chroma.embeddings.aembed_query(question)
+        metrics.observe('rag_stage_seconds', time.perf_counter() - start, stage='embed_query')
+        answer = self.cache.get_similar(embedding, generation, filters)
+        if answer is not None:
+            metrics.inc('rag_chat_requests_total', answered_by='semantic_cache')
+            yield answer
+        else:
+            metrics.inc('rag_chat_requests_total', answered_by='llm')
+            # Chroma's client is synchronous, so search in a worker thread
+            docs = await asyncio.to_thread(self.retrieve, chroma, question, embedding, generation, filters)
+            start = time.perf_counter()
+            context = self.compressor.context(question, docs)
+            metrics.observe('rag_stage_seconds', time.perf_counter() - start, stage='compress_context')
+            metrics.inc('rag_context_tokens_total', self.compressor.count(context))
+            answer = ''
+            start = time.perf_counter()
+            async for token in self.answer_chain.astream({'context': context, 'question': question}):
+                if not answer:
+                    metrics.observe('rag_llm_first_token_seconds', time.perf_counter() - start)
+                answer += token
+                yield token
+            metrics.observe('rag_stage_seconds', time.perf_counter() - start, stage='llm')
+        self.cache.put_answer(question, embedding, answer, generation, filters)
+
+    @staticmethod
+    def search_filters(folder=None, extensions=None, modified_after=None, modified_before=None, files=None):
+        """
+        Search filters from the chat form's inputs (see MetadataCatalog), or None when all are empty.
+        Raises ValueError, with a message for the user, for a date that is not YYYY-MM-DD.
+        """
+        for label, value in (('Modified after', modified_after), ('Modified before', modified_before)):
+            try:
+                to_timestamp((value or '').strip())
+            except ValueError:
+                raise ValueError(f"{label}: '{value.strip()}' is not a date; use YYYY-MM-DD, e.g. 2024-01-02.")
+        filters = {
+            'folder': folder or None,
+            'extensions': list(extensions or []) or None,
+            'modified_after': (modified_after or '').strip() or None,
+            'modified_before': (modified_before or '').strip() or None,
+            'files': [name.strip() for name in (files or '').split(',') if name.strip()] or None
+        }
+        return {key: value for key, value in filters.items() if value} or None
+
+    async def chat(self, question, history, folder=None, extensions=None, modified_after=None, modified_before=None,
+                   files=None, request: gr.Request = None):
+        try:
+            filters = self.search_filters(folder, extensions, modified_after, modified_before, files)
+        except ValueError as e:
+            yield str(e)
+            return
+        memory = self.memory_for(request.session_hash if request else None)
+        standalone = await self.standalone_question(question, memory)
+        answer = ''
+        async for token in self.stream_answer(standalone, filters):
+            answer += token
+            yield answer
+        await memory.asave_context(question, answer)
+
+    def swap_index(self, chroma):
+        """
+        Answer from another index (a newly built generation) from the next question on; the caches
+        invalidate themselves, as the new index has its own generation
+        """
+        with self.index_lock:
+            self.chroma = chroma
+
+    def filter_choices(self):
+        """
+        The folder and file type choices of the index being served, which may have been swapped since the page
+        was built
+        """
+        catalog = self.chroma.catalog
+        return gr.update(choices=[''] + catalog.directories()), gr.update(choices=catalog.extensions())
+
+    def build(self):
+        # Optional filters under the chat box narrow the search to part of the Drive
+        catalog = self.chroma.catalog
+        folder = gr.Dropdown(choices=[''] + catalog.directories(), value='', allow_custom_value=True,
+                             label="Folder (including subfolders)")
+        extensions = gr.CheckboxGroup(choices=catalog.extensions(), label="File types")
+        view = gr.ChatInterface(
+            self.chat, type="messages",
+            additional_inputs=[
+                folder,
+                extensions,
+                gr.Textbox(label="Modified after (YYYY-MM-DD)"),
+                gr.Textbox(label="Modified before (YYYY-MM-DD)"),
+                gr.Textbox(label="Files (names or Drive ids, comma-separated)")
+            ]
+        )
+        # Offer the folders and file types of the index served now, on every page load and when the folder
+        # list is opened
+        with view:
+            view.load(self.filter_choices, outputs=[folder, extensions])
+            folder.focus(self.filter_choices, outputs=[folder, extensions])
+        return view
+
+    def run(self, inbrowser=True, server_name=None, server_port=None):
+        view = self.build()
+        if self.config.metrics_port is not None:
+            serve_metrics(self.config.metrics_port, self.config.metrics_host)
+        # Load the local models while the chat starts up rather than on the first question
+        self.reranker.load()
+        load_embeddings = getattr(self.chroma.embeddings.embeddings, 'load', None)
+        if load_embeddings is not None:
+            threading.Thread(target=load_embeddings, name='embeddings-load', daemon=True).start()
+        # Each chat mostly waits on OpenAI, so serve several at once instead of queueing behind one another
+        view.queue(default_concurrency_limit=self.config.chat_concurrency).launch(
+            inbrowser=inbrowser, server_name=server_name, server_port=server_port
+        )
\ No newline at end of file
@@ -0,0 +1,189 @@
+import copy
+import fcntl
+import json
+import os
+import shutil
+import tempfile
+import uuid
+from contextlib import contextmanager
+
+# Name of the lease on the index at the paths in Config (before any generation)
+BASE = 'base'
+
+
+# Files written in place by processes that only read the index (SQLite's journals and shared memory, and the
+# HNSW files Chroma saves again whenever it closes a collection), which a generation can't share with another
+REWRITTEN_FILES = ('-wal', '-shm', '-journal', '.bin', '.pickle')
+
+
+def link_or_copy(source, destination):
+    """Hard-link a file (copy it where the filesystem can't link, or it's in REWRITTEN_FILES)"""
+    if not source.endswith(REWRITTEN_FILES):
+        try:
+            os.link(source, destination)
+            return destination
+        except OSError:
+            pass
+    return shutil.copy2(source, destination)
+
+
+class Lease:
+    """
+    A process's claim on the generation it serves: a file in the leases directory held under a shared flock,
+    which the system drops when the process exits, however it exits
+    """
+
+    def __init__(self, directory, generation):
+        self.generation = generation
+        os.makedirs(directory, exist_ok=True)
+        name = BASE if generation is None else str(generation)
+        self.path = os.path.join(directory, f"{name}.{os.getpid()}.{uuid.uuid4().hex[:8]}")
+        self.file = open(self.path, 'w')
+        fcntl.flock(self.file, fcntl.LOCK_SH)
+
+    def release(self):
+        if self.file.closed:
+            return
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        self.file.close()
+
+
+class IndexGenerations:
+    """
+    Numbered copies of the index (Chroma collection, lexical index, compact vectors, ingest ledger and
+    near-duplicate signatures) under Config.index_generations_directory, with a pointer file naming
+    the one in use.
+
+    A build copies the current generation into a build directory, indexes into the copy, and publishes it
+    by renaming it to the next number and rewriting the pointer (the files of shards with no changes are
+    hard-linked rather than copied where they are never written to again), so a server answering from the current
+    generation never sees a half-built index. Without a pointer file the index lives at the paths in Config,
+    as it always has.
+
+    Several processes share the generations: building, publishing and pruning happen under an exclusive
+    lock file (see locked()), and every process serving a generation holds a lease on it, so prune() leaves
+    it alone.
+    """
+
+    INDEX_PATHS = ('db_persist_directory', 'lexical_index_directory', 'vector_store_directory', 'ingest_ledger_file',
+                   'dedup_file', 'shards_directory')
+
+    def __init__(self, config):
+        self.config = config
+        self.leases_directory = os.path.join(self.config.index_generations_directory, 'leases')
+
+    @contextmanager
+    def locked(self):
+        """Hold the lock on the generations (blocking until other processes release it)."""
+        with open(f"{self.config.index_pointer_file}.lock", 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def current(self):
+        """The generation number in use, or None for the paths in Config."""
+        try:
+            with open(self.config.index_pointer_file) as f:
+                return json.load(f)['generation']
+        except FileNotFoundError:
+            return None
+
+    def directory(self, generation):
+        return os.path.join(self.config.index_generations_directory, str(generation))
+
+    def config_in(self, directory):
+        """A copy of the config whose index paths point into a directory."""
+        config = copy.copy(self.config)
+        for name in self.INDEX_PATHS:
+            setattr(config, name, os.path.join(directory, os.path.basename(getattr(self.config, name))))
+        return config
+
+    def config_for(self, generation):
+        """A copy of the config whose index paths point into the given generation."""
+        if generation is None:
+            return self.config
+        return self.config_in(self.directory(generation))
+
+    def current_config(self):
+        return self.config_for(self.current())
+
+    def lease(self, generation):
+        """Claim a generation for as long as this process serves it (hold the lock while looking it up)."""
+        return Lease(self.leases_directory, generation)
+
+    def leased(self):
+        """The generations (BASE for the paths in Config) some live process holds a lease on."""
+        names = set()
+        if not os.path.isdir(self.leases_directory):
+            return names
+        for lease in os.listdir(self.leases_directory):
+            path = os.path.join(self.leases_directory, lease)
+            with open(path) as f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    names.add(lease.split('.')[0])
+                    continue
+            # Left behind by a process that is gone
+            os.remove(path)
+        return names
+
+    def prepare_next(self, unchanged=()):
+        """
+        Copy the current generation into a new build directory and return (build directory, config for it);
+        call with the lock held, through publish(). The shards named in unchanged are hard-linked, not copied.
+        """
+        source = self.current_config()
+        os.makedirs(self.config.index_generations_directory, exist_ok=True)
+        build = tempfile.mkdtemp(prefix='build-', dir=self.config.index_generations_directory)
+        target = self.config_in(build)
+        for name in self.INDEX_PATHS:
+            path = getattr(source, name)
+            if name == 'shards_directory' and os.path.isdir(path):
+                os.makedirs(target.shards_directory)
+                for shard in os.listdir(path):
+                    shutil.copytree(os.path.join(path, shard), os.path.join(target.shards_directory, shard),
+                                    copy_function=link_or_copy if shard in unchanged else shutil.copy2)
+            elif os.path.isdir(path):
+                shutil.copytree(path, getattr(target, name))
+            elif os.path.exists(path):
+                shutil.copy2(path, getattr(target, name))
+        return build, target
+
+    def publish(self, build):
+        """Number a finished build directory and make it the current generation; returns its number."""
+        numbers = [int(name) for name in os.listdir(self.config.index_generations_directory) if name.isdigit()]
+        generation = max(numbers + [self.current() or 0]) + 1
+        os.rename(build, self.directory(generation))
+        tmp_path = f"{self.config.index_pointer_file}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'generation': generation}, f)
+        os.replace(tmp_path, self.config.index_pointer_file)
+        return generation
+
+    def prune(self):
+        """
+        Delete every generation but the current one and those leased, and builds left unfinished (including the
+        paths in Config, once a generation replaced them and no one serves them); call with the lock held
+        """
+        current = self.current()
+        if current is None:
+            return
+        kept = self.leased() | {str(current), os.path.basename(self.leases_directory)}
+        if os.path.isdir(self.config.index_generations_directory):
+            for name in os.listdir(self.config.index_generations_directory):
+                if name not in kept:
+                    shutil.rmtree(os.path.join(self.config.index_generations_directory, name), ignore_errors=True)
+        if BASE in kept:
+            return
+        for name in self.INDEX_PATHS:
+            path = getattr(self.config, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,75 @@
+import json
+import os
+from collections import Counter
+
+
+class IngestLedger:
+    """
+    Record of what is indexed in the Chroma collection: for every source file, the hash
+    it was indexed at, the chunker settings it was split with, and the ids of its chunks (none for a file
+    that failed to parse, which stays as it is until the file changes).
+    """
+
+    # Files indexed before chunkers were recorded were split by the original character splitter
+    LEGACY_CHUNKER = 'character:2000:300'
+
+    def __init__(self, config):
+        self.config = config
+        self.files = {}
+        if os.path.exists(self.config.ingest_ledger_file):
+            with open(self.config.ingest_ledger_file) as f:
+                self.files = json.load(f)
+        self.dirty = False
+        # How many files use each chunk id (identical copies of a file share ids)
+        self.refcount = Counter(chunk_id for entry in self.files.values() for chunk_id in entry['chunk_ids'])
+
+    def is_current(self, source, file_hash, chunker):
+        """Whether source is indexed at this hash and was split by a chunker with this signature."""
+        entry = self.files.get(source)
+        return (entry is not None and entry['file_hash'] == file_hash
+                and entry.get('chunker', self.LEGACY_CHUNKER) == chunker)
+
+    def chunk_ids(self, source):
+        entry = self.files.get(source)
+        return entry['chunk_ids'] if entry else []
+
+    def unreferenced(self, chunk_ids, source):
+        """The given chunk ids that no file other than source still uses."""
+        own = set(self.chunk_ids(source))
+        return [chunk_id for chunk_id in chunk_ids if self.refcount[chunk_id] - (chunk_id in own) <= 0]
+
+    def other_sources(self, chunk_ids, source):
+        """{chunk id: a file other than source that uses it} for the given chunk ids still in use elsewhere"""
+        wanted = {chunk_id for chunk_id in chunk_ids if self.refcount[chunk_id] > 0}
+        found = {}
+        for other, entry in self.files.items():
+            if other == source:
+                continue
+            for chunk_id in wanted.intersection(entry['chunk_ids']):
+                found.setdefault(chunk_id, other)
+        return found
+
+    def record(self, source, file_hash, chunk_ids, chunker):
+        self.remove(source)
+        self.files[source] = {'file_hash': file_hash, 'chunker': chunker, 'chunk_ids': chunk_ids}
+        self.refcount.update(chunk_ids)
+        self.dirty = True
+
+    def remove(self, source):
+        entry = self.files.pop(source, None)
+        if entry:
+            self.refcount.subtract(entry['chunk_ids'])
+            self.dirty = True
+        return entry
+
+    def save(self):
+        # Only rewrite on change: the file's mtime doubles as the index generation that
+        # query-side caches are invalidated by
+        if not self.dirty and os.path.exists(self.config.ingest_ledger_file):
+            return
+        # Write to a temporary file first so an interrupted save never leaves a truncated ledger
+        tmp_path = f"{self.config.ingest_ledger_file}.tmp"
+        with open(tmp_path, "w") as outfile:
+            json.dump(self.files, outfile, indent=4)
+        os.replace(tmp_path, self.config.ingest_ledger_file)
+        self.dirty = False
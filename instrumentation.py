@@ -0,0 +1,250 @@
+import cProfile
+import itertools
+import json
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger('rag')
+
+
+class TextFormatter(logging.Formatter):
+    """The message alone, as the pipeline used to print it."""
+
+    def format(self, record):
+        return record.getMessage()
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, event name, message and the event's fields."""
+
+    def format(self, record):
+        entry = {
+            'time': round(record.created, 3),
+            'level': record.levelname.lower(),
+            'event': getattr(record, 'event', record.name),
+            'message': record.getMessage()
+        }
+        entry.update(getattr(record, 'fields', {}))
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(level='INFO', log_format='text', log_file=None):
+    handler = logging.FileHandler(log_file) if log_file else logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if log_format == 'json' else TextFormatter())
+    logger.handlers = [handler]
+    logger.setLevel(level)
+    logger.propagate = False
+
+
+def log(event, message, level=logging.INFO, **fields):
+    """
+    A structured log event: a dotted event name, a human-readable message, and fields for machines
+    """
+    if not logger.handlers:
+        configure_logging()
+    if logger.isEnabledFor(level):
+        logger.log(level, message, extra={'event': event, 'fields': fields})
+
+
+def label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+class Metrics:
+    """
+    Counters, gauges and histograms keyed by name and labels, rendered in the Prometheus text format.
+
+    timer(stage) measures a pipeline stage into the rag_stage_seconds histogram. While a stage runs its
+    thread carries the stage in its name, so py-spy dumps show which stage each thread is in, and stages
+    listed in Config.profile_stages are run under cProfile with the profile written to profile_directory.
+    """
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, math.inf)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.descriptions = {}
+        self.profile_stages = set()
+        self.profile_directory = 'profiles'
+        self.profile_numbers = itertools.count()
+        self.profiling = threading.local()
+
+    def describe(self, name, description):
+        self.descriptions[name] = description
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, label_key(labels))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': [0] * len(self.BUCKETS), 'sum': 0.0, 'count': 0}
+            for index, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    histogram['buckets'][index] += 1
+                    break
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    @contextmanager
+    def timer(self, stage, **labels):
+        thread = threading.current_thread()
+        name = thread.name
+        thread.name = f"{name} [{stage}]"
+        profile = None
+        # cProfile allows one active profiler per thread, so nested profiled stages fold into the outer one
+        if stage in self.profile_stages and not getattr(self.profiling, 'active', False):
+            profile = cProfile.Profile()
+            self.profiling.active = True
+            profile.enable()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('rag_stage_seconds', time.perf_counter() - start, stage=stage, **labels)
+            if profile is not None:
+                profile.disable()
+                self.profiling.active = False
+                os.makedirs(self.profile_directory, exist_ok=True)
+                profile.dump_stats(os.path.join(
+                    self.profile_directory, f"{stage}-{os.getpid()}-{next(self.profile_numbers):06d}.prof"
+                ))
+            thread.name = name
+
+    def value(self, name, **labels):
+        """A counter or gauge's current value (0 if never set)."""
+        key = (name, label_key(labels))
+        with self.lock:
+            return self.counters.get(key, self.gauges.get(key, 0))
+
+    def stages(self):
+        """{stage: {'count', 'seconds', 'mean'}} from rag_stage_seconds, for reports."""
+        totals = {}
+        with self.lock:
+            for (metric, key), histogram in self.histograms.items():
+                if metric == 'rag_stage_seconds':
+                    entry = totals.setdefault(dict(key)['stage'], {'count': 0, 'seconds': 0.0})
+                    entry['count'] += histogram['count']
+                    entry['seconds'] += histogram['sum']
+        return {
+            stage: {'count': entry['count'], 'seconds': round(entry['seconds'], 4),
+                    'mean': round(entry['seconds'] / entry['count'], 6) if entry['count'] else None}
+            for stage, entry in sorted(totals.items())
+        }
+
+    @staticmethod
+    def labels_text(key, extra=()):
+        pairs = list(key) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+        return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            for kind, series in (('counter', self.counters), ('gauge', self.gauges)):
+                for name in sorted({name for name, _ in series}):
+                    if name in self.descriptions:
+                        lines.append(f"# HELP {name} {self.descriptions[name]}")
+                    lines.append(f"# TYPE {name} {kind}")
+                    for (metric, key), value in sorted(series.items()):
+                        if metric == name:
+                            lines.append(f"{name}{self.labels_text(key)} {value}")
+            for name in sorted({name for name, _ in self.histograms}):
+                if name in self.descriptions:
+                    lines.append(f"# HELP {name} {self.descriptions[name]}")
+                lines.append(f"# TYPE {name} histogram")
+                for (metric, key), histogram in sorted(self.histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(self.BUCKETS, histogram['buckets']):
+                        cumulative += count
+                        le = '+Inf' if bound == math.inf else repr(bound)
+                        lines.append(f"{name}_bucket{self.labels_text(key, [('le', le)])} {cumulative}")
+                    lines.append(f"{name}_sum{self.labels_text(key)} {histogram['sum']}")
+                    lines.append(f"{name}_count{self.labels_text(key)} {histogram['count']}")
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+metrics.describe('rag_stage_seconds', 'Time spent in each pipeline stage')
+metrics.describe('rag_drive_list_requests_total', 'Drive folder listing requests')
+metrics.describe('rag_download_bytes_total', 'Bytes downloaded from Drive')
+metrics.describe('rag_download_files_total', 'Files downloaded from Drive, by outcome')
+metrics.describe('rag_parsed_pages_total', 'Pages parsed from downloaded files')
+metrics.describe('rag_parse_files_total', 'Files parsed, by outcome')
+metrics.describe('rag_chunks_total', 'Chunks produced by the chunker')
+metrics.describe('rag_embedding_requests_total', 'Embedding API requests, by outcome')
+metrics.describe('rag_embedding_tokens_total', 'Tokens sent to the embedding API')
+metrics.describe('rag_local_embed_batches_total', 'Batches run by the local embedding model')
+metrics.describe('rag_local_embed_texts_total', 'Texts embedded by the local embedding model')
+metrics.describe('rag_duplicate_chunks_total', 'Chunks not stored because they nearly repeat a stored chunk')
+metrics.describe('rag_upserted_chunks_total', 'Chunks written to the collection')
+metrics.describe('rag_embedding_cache_entries', 'Vectors in the local embedding cache')
+metrics.describe('rag_shards', 'Shards of the index')
+metrics.describe('rag_shard_searches_total', 'Shard searches (one search per shard a query fans out to)')
+metrics.describe('rag_retrieval_cache_total', 'Retrieved-chunk cache lookups, by outcome')
+metrics.describe('rag_chat_requests_total', 'Chat questions, by how they were answered')
+metrics.describe('rag_reranker_total', 'Questions by how far the reranker got within its latency budget')
+metrics.describe('rag_context_tokens_total', 'Context tokens in answer prompts')
+metrics.describe('rag_llm_first_token_seconds', 'Time from prompt to the first streamed LLM token')
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would drown the application's own log
+        pass
+
+
+def serve_metrics(port, host='127.0.0.1'):
+    """
+    Serve /metrics on a background thread; returns the server (its port is server.server_port), or None if
+    the port cannot be bound, e.g. because another process already serves metrics there.
+    """
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as e:
+        log('metrics.error', f"Cannot serve metrics on {host}:{port}: {e}", level=logging.ERROR, host=host, port=port,
+            error=str(e))
+        return None
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    log('metrics.serving', f"Metrics at http://{host}:{server.server_port}/metrics", port=server.server_port)
+    return server
+
+
+def configure(config):
+    """Apply Config's log and profiling settings."""
+    configure_logging(config.log_level, config.log_format, config.log_file)
+    metrics.profile_stages = set(config.profile_stages)
+    metrics.profile_directory = config.profile_directory
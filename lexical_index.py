@@ -0,0 +1,196 @@
+import hashlib
+import math
+import re
+from collections import Counter
+from functools import lru_cache
+import numpy as np
+from segments import Segment, SegmentedIndex
+
+
+TOKEN_PATTERN = re.compile(r'\w+(?:[-./]\w+)*')
+
+
+@lru_cache(maxsize=1 << 20)
+def term_hash(term):
+    """Terms are stored as 64-bit hashes, so the index needs no vocabulary file"""
+    return int.from_bytes(hashlib.blake2b(term.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def tokenize(text):
+    """
+    Lower-cased words. Identifiers such as INV-10234 or report_2024.pdf are kept whole as well as split into parts.
+    """
+    terms = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        terms.append(token)
+        if not token.isalnum():
+            terms.extend(part for part in re.split(r'[-./_]', token) if part)
+    return terms
+
+
+class LexicalSegment(Segment):
+    """
+    Segment of the BM25 index:
+
+    ids      chunk ids, sorted (a document's number is its position here)
+    lengths  document lengths in terms
+    terms    sorted term hashes; postings of terms[i] are docs/tfs[offsets[i]:offsets[i + 1]]
+    live     0 for documents deleted since the segment was written
+    """
+
+    FIELDS = ('ids', 'lengths', 'terms', 'offsets', 'docs', 'tfs', 'live')
+
+    @staticmethod
+    def arrays(ids, lengths, post_terms, post_docs, post_tfs):
+        """Field arrays from postings (term hash, document number, term frequency)."""
+        order = np.lexsort((post_docs, post_terms))
+        post_terms, post_docs, post_tfs = post_terms[order], post_docs[order], post_tfs[order]
+        terms, starts = np.unique(post_terms, return_index=True)
+        return {
+            'ids': ids,
+            'lengths': lengths.astype(np.uint32),
+            'terms': terms.astype(np.uint64),
+            'offsets': np.append(starts, len(post_terms)).astype(np.int64),
+            'docs': post_docs.astype(np.uint32),
+            'tfs': np.minimum(post_tfs, np.iinfo(np.uint16).max).astype(np.uint16)
+        }
+
+    def postings(self, terms):
+        """(term hash, document numbers, term frequencies) of live postings for the query terms present here."""
+        positions = np.searchsorted(self.terms, terms)
+        for term, position in zip(terms, positions):
+            if position >= len(self.terms) or self.terms[position] != term:
+                continue
+            start, end = self.offsets[position], self.offsets[position + 1]
+            docs, tfs = self.docs[start:end], self.tfs[start:end]
+            keep = self.live[docs] == 1
+            yield term, docs[keep], tfs[keep]
+
+
+class LexicalIndex(SegmentedIndex):
+    """
+    BM25 inverted index over the chunks in the Chroma collection, for exact names, numbers and identifiers
+    that dense retrieval misses.
+
+    Every upsert batch becomes a new memory-mapped segment (see SegmentedIndex), so opening the index maps
+    files and reads the manifest; nothing is parsed or held in memory.
+    """
+
+    segment_class = LexicalSegment
+
+    def __init__(self, config):
+        super().__init__(config, config.lexical_index_directory, config.segment_merge_factor)
+
+    def add(self, ids, texts):
+        """Index a batch of chunks as a new segment; ids that are already indexed are skipped."""
+        new = self.missing(ids)
+        if not new:
+            return
+        lengths, post_terms, post_docs, post_tfs = [], [], [], []
+        for number, index in enumerate(new):
+            counts = Counter(term_hash(term) for term in tokenize(texts[index]))
+            lengths.append(sum(counts.values()))
+            post_terms.extend(counts.keys())
+            post_docs.extend([number] * len(counts))
+            post_tfs.extend(counts.values())
+        arrays = LexicalSegment.arrays(
+            self.encode_ids([ids[index] for index in new]), np.array(lengths, dtype=np.int64),
+            np.array(post_terms, dtype=np.uint64), np.array(post_docs, dtype=np.int64), np.array(post_tfs, dtype=np.int64)
+        )
+        self.add_segment(arrays, {'length': int(sum(lengths))})
+
+    def deleted_stats(self, segment, numbers):
+        return {'length': int(segment.lengths[numbers].sum())}
+
+    def merge_arrays(self, segments):
+        ids, masks, order, rank = self.live_order(segments)
+        lengths, post_terms, post_docs, post_tfs = [], [], [], []
+        base = 0
+        for segment, live in zip(segments, masks):
+            # Merged number (before sorting) of every live document in this segment
+            renumber = np.cumsum(live) - 1 + base
+            lengths.append(np.asarray(segment.lengths)[live])
+            docs = np.asarray(segment.docs)
+            keep = live[docs]
+            post_terms.append(np.repeat(np.asarray(segment.terms), np.diff(segment.offsets))[keep])
+            post_docs.append(renumber[docs[keep]])
+            post_tfs.append(np.asarray(segment.tfs)[keep])
+            base += int(live.sum())
+        lengths = np.concatenate(lengths)[order]
+        arrays = LexicalSegment.arrays(
+            ids, lengths, np.concatenate(post_terms), rank[np.concatenate(post_docs)], np.concatenate(post_tfs)
+        )
+        return arrays, {'length': int(lengths.sum())}
+
+    @staticmethod
+    def query_terms(query):
+        return np.array(sorted({term_hash(term) for term in tokenize(query)}), dtype=np.uint64)
+
+    @staticmethod
+    def term_statistics(manifest, postings):
+        df = Counter()
+        for segment_postings in postings:
+            for term, docs, _ in segment_postings:
+                df[term] += len(docs)
+        return (sum(entry['live'] for entry in manifest['segments']),
+                sum(entry['length'] for entry in manifest['segments']), df)
+
+    def statistics(self, query):
+        """
+        (documents, total length, {term: document frequency}) for a query's terms. Added up over several indexes
+        and passed to search(), they score each index's chunks as one index over all of them would.
+        """
+        self.load()
+        segments, manifest = self.segments, self.manifest
+        terms = self.query_terms(query)
+        postings = [list(segment.postings(terms)) for segment in segments] if len(terms) else []
+        return self.term_statistics(manifest, postings)
+
+    def search(self, query, k=20, allowed=None, statistics=None):
+        """
+        Top-k (chunk id, BM25 score) pairs for a query, only among the allowed chunk ids if given; statistics
+        (see statistics()) are those of all the indexes searched together
+        """
+        self.load()
+        segments, manifest = self.segments, self.manifest
+        terms = self.query_terms(query)
+        if not len(terms):
+            return []
+
+        postings = [list(segment.postings(terms)) for segment in segments]
+        total_docs, total_length, df = statistics or self.term_statistics(manifest, postings)
+        if not total_docs:
+            return []
+        average_length = total_length / total_docs
+        # Terms in most documents add little but cost the most; ignore them unless nothing else matched
+        rare = {term for term, count in df.items() if count <= self.config.lexical_max_df * total_docs}
+        if rare:
+            df = {term: count for term, count in df.items() if term in rare}
+        idf = {term: math.log(1 + (total_docs - count + 0.5) / (count + 0.5)) for term, count in df.items()}
+
+        k1, b = self.config.bm25_k1, self.config.bm25_b
+        allowed = self.encode_ids(list(allowed)) if allowed is not None else None
+        candidates = []
+        for segment, segment_postings in zip(segments, postings):
+            if allowed is not None:
+                # Collection statistics stay global; only the candidates are restricted
+                mask = segment.mask(allowed)
+            docs_parts, score_parts = [], []
+            for term, docs, tfs in segment_postings:
+                if allowed is not None:
+                    keep = mask[docs]
+                    docs, tfs = docs[keep], tfs[keep]
+                if term not in idf or not len(docs):
+                    continue
+                tfs = tfs.astype(np.float32)
+                norm = k1 * (1 - b + b * segment.lengths[docs] / average_length)
+                docs_parts.append(docs)
+                score_parts.append(idf[term] * tfs * (k1 + 1) / (tfs + norm))
+            if not docs_parts:
+                continue
+            docs, inverse = np.unique(np.concatenate(docs_parts), return_inverse=True)
+            scores = np.bincount(inverse, weights=np.concatenate(score_parts))
+            top = np.argpartition(-scores, min(k, len(scores)) - 1)[:k]
+            candidates.extend((float(scores[i]), segment.ids[docs[i]].decode('utf-8')) for i in top)
+        candidates.sort(reverse=True)
+        return [(chunk_id, score) for score, chunk_id in candidates[:k]]
@@ -1,42 +1,133 @@
-from download import Download
-from vector_store import Chroma
-from config_file import Config
-from gradio_interface import GradioInterface
+import argparse
 from dotenv import load_dotenv
+from config_file import Config
+from instrumentation import configure
 
-def main():
+# Commands import only what they use, so sync never loads LangChain or Chroma and only serve/daemon load Gradio
 
-    load_dotenv()  
-    config = Config()
-    dwnld = Download(config=config)
-    chroma = Chroma(config=config)
+
+def sync(config, args):
+    """Download new and changed files from Google Drive."""
+    from download import Download
+    Download(config=config).google_drive()
+
+
+def open_index(config):
+    """
+    The current index and a lease on its generation, which keeps other processes from pruning it while this
+    one serves it; hold on to the lease for as long as the index is in use
+    """
+    from index_generations import IndexGenerations
+    from sharded_index import make_index
+    generations = IndexGenerations(config)
+    with generations.locked():
+        lease = generations.lease(generations.current())
+    return make_index(generations.config_for(lease.generation)), lease
+
+
+def index(config, args):
+    """Index new and changed downloaded files into a new index generation and make it the current one."""
+    # Built the way the daemon builds, so a running serve or daemon never reads a half-built index, and a
+    # running daemon switches to the new generation at its next cycle
+    from index_generations import IndexGenerations
+    from instrumentation import log
+    from sharded_index import make_index
+    generations = IndexGenerations(config)
+    with generations.locked():
+        chroma = make_index(generations.current_config())
+        try:
+            pending = chroma.pending_changes()
+            if not pending:
+                log('index.unchanged', "Index is up to date")
+                return
+            build, build_config = generations.prepare_next(chroma.unchanged_shards())
+            log('index.build', f"Indexing {pending} changed files into a new index generation", files=pending)
+            built = make_index(build_config, embeddings=chroma.embeddings.embeddings)
+            try:
+                built.process_and_store()
+            finally:
+                built.close()
+        finally:
+            chroma.close()
+        generation = generations.publish(build)
+        log('index.published', f"Index generation {generation} is now current", generation=generation)
+        generations.prune()
+
+
+def serve(config, args):
+    """Serve the chat from the current index."""
+    from gradio_interface import GradioInterface
+    chroma, lease = open_index(config)
+    GradioInterface(config=config, chroma=chroma).run(
+        inbrowser=not args.no_browser, server_name=args.host, server_port=args.port
+    )
+    lease.release()
+
+
+def daemon(config, args):
+    """Serve the chat while syncing and re-indexing in the background every sync_interval seconds."""
+    from daemon import Daemon
+    from download import Download
+    from gradio_interface import GradioInterface
+    if args.interval:
+        config.sync_interval = args.interval
+    chroma, lease = open_index(config)
     gradio = GradioInterface(config=config, chroma=chroma)
-    
+    Daemon(config, Download(config=config), chroma, lease, gradio).run(
+        inbrowser=False, server_name=args.host, server_port=args.port
+    )
+
+
+def interactive(config, args):
+    """Ask whether to download and index, then serve the chat (what running without a command does)."""
     # Ask for confirmation
     confirm = input("\nDo you want to download all files and folders? (yes/no): ")
     if confirm.lower() in ['yes', 'y']:
         print("Download is started...")
         # Download file from google drive
-        dwnld.google_drive()
+        sync(config, args)
 
+    chroma, lease = open_index(config)
     # Ask for confirmation
     confirm = input("\nDo you want to add all files to chroma? (yes/no): ")
     if confirm.lower() in ['yes', 'y']:
         print("chroma process is started...")
-        #chroma.remove_chroma_db()
         # Add documets to chroma
         chroma.process_and_store()
 
     # Visualize the vector store
-    collection = chroma.db._collection
-    count = collection.count()
+    count = chroma.count()
     print(f"No. of documents in Chromadb collection: {count}")
 
     # Build & run gradio interface
-    gradio.run()
+    from gradio_interface import GradioInterface
+    GradioInterface(config=config, chroma=chroma).run()
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="RAG over your Google Drive. Without a command, asks what to do.")
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('sync', help=sync.__doc__)
+    commands.add_parser('index', help=index.__doc__)
+    for name, command in (('serve', serve), ('daemon', daemon)):
+        subparser = commands.add_parser(name, help=command.__doc__)
+        subparser.add_argument('--host', help='address to serve the chat on (default: localhost)')
+        subparser.add_argument('--port', type=int, help='port to serve the chat on (default: 7860)')
+        if name == 'serve':
+            subparser.add_argument('--no-browser', action='store_true', help="don't open the chat in a browser")
+        else:
+            subparser.add_argument('--interval', type=float, help='seconds between syncs (default: Config.sync_interval)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    load_dotenv()
+    config = Config()
+    configure(config)
+    command = {'sync': sync, 'index': index, 'serve': serve, 'daemon': daemon}.get(args.command, interactive)
+    command(config, args)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
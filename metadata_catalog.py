@@ -0,0 +1,187 @@
+import bisect
+import datetime
+import json
+import os
+from collections import defaultdict
+
+
+def to_timestamp(value, end_of_day=False):
+    """
+    Seconds since the epoch from a number, a datetime, or an ISO date/datetime string ('' or None for no bound)
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, datetime.date) and not isinstance(value, datetime.datetime):
+        value = datetime.datetime.combine(value, datetime.time.max if end_of_day else datetime.time.min)
+    if isinstance(value, str):
+        text = value.strip()
+        value = datetime.datetime.fromisoformat(text.replace('Z', '+00:00'))
+        # A bare date as an upper bound includes that whole day
+        if end_of_day and len(text) == 10:
+            value = datetime.datetime.combine(value.date(), datetime.time.max)
+    return value.timestamp()
+
+
+def modified_timestamp(metadata):
+    """
+    The file's last modification in Drive as a number Chroma can range-filter on; older metadata only has
+    the ISO modified_date of the local copy
+    """
+    if metadata.get('modified_timestamp') is not None:
+        return metadata['modified_timestamp']
+    return to_timestamp(metadata.get('modified_date'))
+
+
+class MetadataCatalog:
+    """
+    Secondary indexes over the indexed files, so query filters can be resolved without touching the collection:
+    directory, extension, Drive id / file name -> sources, modification time (sorted) -> sources, and
+    source -> chunk ids from the ingest ledger (and back, for the chunks several files list: identical copies
+    and near-duplicates, which are stored once under one of the files).
+
+    Filters are a dict with any of:
+
+    folder           relative folder path; the whole subtree matches
+    extensions       e.g. ['.pdf', 'docx']
+    files            Drive ids or file names
+    modified_after   date, datetime, ISO string or timestamp
+    modified_before  same; a bare date includes that whole day
+
+    The catalog is rebuilt when the ledger changes on disk.
+    """
+
+    def __init__(self, config, metadata_store):
+        self.config = config
+        self.metadata_store = metadata_store
+        self.loaded_mtime = None
+        self.chunks_by_source = {}
+        self.shared_chunks = {}
+        self.by_directory = defaultdict(set)
+        self.by_extension = defaultdict(set)
+        self.by_file = defaultdict(set)
+        self.by_time = []
+
+    def load(self):
+        try:
+            mtime = os.stat(self.config.ingest_ledger_file).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self.loaded_mtime:
+            return
+        with open(self.config.ingest_ledger_file) as f:
+            ledger = json.load(f)
+        self.metadata_store.load()
+        chunks_by_source = {}
+        by_directory, by_extension, by_file = defaultdict(set), defaultdict(set), defaultdict(set)
+        by_time = []
+        for source, entry in ledger.items():
+            chunks_by_source[source] = entry['chunk_ids']
+            metadata = self.metadata_store.by_path.get(os.path.normpath(source)) or {}
+            by_directory[self.normalize_folder(metadata.get('parent_directory', os.path.dirname(source)))].add(source)
+            by_extension[os.path.splitext(source)[1].lower()].add(source)
+            for key in ('google_drive_id', 'filename'):
+                if metadata.get(key):
+                    by_file[metadata[key]].add(source)
+            by_file[os.path.basename(source)].add(source)
+            timestamp = modified_timestamp(metadata) if metadata else None
+            if timestamp is not None:
+                by_time.append((timestamp, source))
+        by_time.sort()
+        sources_by_chunk = defaultdict(list)
+        for source, chunk_ids in chunks_by_source.items():
+            for chunk_id in chunk_ids:
+                sources_by_chunk[chunk_id].append(source)
+        self.shared_chunks = {chunk_id: sources for chunk_id, sources in sources_by_chunk.items() if len(sources) > 1}
+        self.chunks_by_source, self.by_directory, self.by_extension = chunks_by_source, by_directory, by_extension
+        self.by_file, self.by_time = by_file, by_time
+        self.loaded_mtime = mtime
+
+    @staticmethod
+    def normalize_folder(folder):
+        folder = os.path.normpath(folder.strip().strip('/\\')) if folder and folder.strip() else '.'
+        return folder
+
+    @staticmethod
+    def normalize_extension(extension):
+        extension = extension.strip().lower()
+        return extension if extension.startswith('.') else f".{extension}"
+
+    def directories(self):
+        self.load()
+        return sorted(directory for directory in self.by_directory if directory != '.')
+
+    def extensions(self):
+        self.load()
+        return sorted(extension for extension in self.by_extension if extension)
+
+    def subtree(self, folder):
+        """The indexed directories at or below a folder."""
+        self.load()
+        folder = self.normalize_folder(folder)
+        if folder == '.':
+            return list(self.by_directory)
+        prefix = folder + os.sep
+        return [directory for directory in self.by_directory if directory == folder or directory.startswith(prefix)]
+
+    def sources(self, filters):
+        """The indexed source files matching all filters."""
+        self.load()
+        matches = None
+
+        def narrow(sources):
+            nonlocal matches
+            matches = set(sources) if matches is None else matches & set(sources)
+
+        if filters.get('folder'):
+            narrow(source for directory in self.subtree(filters['folder']) for source in self.by_directory[directory])
+        if filters.get('extensions'):
+            narrow(source for extension in filters['extensions']
+                   for source in self.by_extension.get(self.normalize_extension(extension), ()))
+        if filters.get('files'):
+            narrow(source for name in filters['files'] for source in self.by_file.get(name, ()))
+        after = to_timestamp(filters.get('modified_after'))
+        before = to_timestamp(filters.get('modified_before'), end_of_day=True)
+        if after is not None or before is not None:
+            start = bisect.bisect_left(self.by_time, (after,)) if after is not None else 0
+            end = bisect.bisect_right(self.by_time, (before, chr(0x10FFFF))) if before is not None else len(self.by_time)
+            narrow(source for _, source in self.by_time[start:end])
+        return set(self.chunks_by_source) if matches is None else matches
+
+    def chunk_ids(self, filters):
+        """Ids of the chunks of every matching file."""
+        return {chunk_id for source in self.sources(filters) for chunk_id in self.chunks_by_source[source]}
+
+    def shared_chunk_ids(self, filters):
+        """
+        Ids of the chunks of matching files that other files list too; the where clause misses those stored
+        under a file that does not match
+        """
+        sources = self.sources(filters)
+        return {chunk_id for chunk_id, listed in self.shared_chunks.items() if sources.intersection(listed)}
+
+    def chunk_sources(self, chunk_id):
+        """The files that list a chunk several files list (empty for the rest)"""
+        self.load()
+        return self.shared_chunks.get(chunk_id, [])
+
+    def where(self, filters):
+        """The same filters as a Chroma where clause over chunk metadata (None if there are none)."""
+        clauses = []
+        if filters.get('folder'):
+            clauses.append({'parent_directory': {'$in': self.subtree(filters['folder']) or ['']}})
+        if filters.get('extensions'):
+            clauses.append({'extension': {'$in': [self.normalize_extension(e) for e in filters['extensions']]}})
+        if filters.get('files'):
+            files = list(filters['files'])
+            clauses.append({'$or': [{'google_drive_id': {'$in': files}}, {'filename': {'$in': files}}]})
+        after = to_timestamp(filters.get('modified_after'))
+        before = to_timestamp(filters.get('modified_before'), end_of_day=True)
+        if after is not None:
+            clauses.append({'modified_timestamp': {'$gte': after}})
+        if before is not None:
+            clauses.append({'modified_timestamp': {'$lte': before}})
+        if not clauses:
+            return None
+        return clauses[0] if len(clauses) == 1 else {'$and': clauses}
@@ -0,0 +1,74 @@
+import hashlib
+import json
+import os
+import logging
+import time
+from instrumentation import log
+
+
+def hash_file(file_path, chunk_size=1024 * 1024):
+    """MD5 of a file, read in chunks so memory stays flat for large files."""
+    md5 = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class HashingWriter:
+    """File wrapper that hashes bytes as they are written, so a download never has to be read back."""
+
+    def __init__(self, f):
+        self.f = f
+        self.md5 = hashlib.md5()
+        self.size = 0
+        self.hash_seconds = 0.0
+
+    def write(self, data):
+        start = time.perf_counter()
+        self.md5.update(data)
+        self.hash_seconds += time.perf_counter() - start
+        self.size += len(data)
+        return self.f.write(data)
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
+
+
+class MetadataStore:
+    """
+    The files_metadata.json written by GoogleDrive (an entry per Drive file), loaded once and indexed by file hash
+    and local path.
+
+    The file is only parsed again when it changes on disk.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.by_hash = {}
+        self.by_path = {}
+        self.loaded_mtime = None
+
+    def load(self):
+        """(Re)load the metadata file if it changed since the last load."""
+        try:
+            mtime = os.path.getmtime(self.config.metadata_file)
+        except FileNotFoundError:
+            log('metadata.missing', f"Metadata file {self.config.metadata_file} not found", level=logging.WARNING,
+                path=self.config.metadata_file)
+            return
+        if mtime == self.loaded_mtime:
+            return
+        with open(self.config.metadata_file) as f:
+            entries = list(json.load(f).values())
+        self.by_hash = {metadata['file_hash']: metadata for metadata in entries}
+        self.by_path = {os.path.normpath(metadata['source']): metadata for metadata in entries}
+        self.loaded_mtime = mtime
+
+    def get(self, file_path):
+        """Look up a downloaded file's metadata by its path, falling back to its hash. Returns None if unknown."""
+        self.load()
+        metadata = self.by_path.get(os.path.normpath(str(file_path)))
+        if metadata is None:
+            metadata = self.by_hash.get(hash_file(file_path))
+        return metadata
@@ -0,0 +1,256 @@
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import zlib
+import numpy as np
+
+WORD_PATTERN = re.compile(r'\w+')
+# Permutations are (a * x + b) mod p on 32-bit shingle hashes x, with a and b drawn from [1, p); the
+# products wrap at 64 bits, which keeps them just as well mixed
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+
+
+def lsh_parameters(threshold, permutations):
+    """
+    (bands, rows) with bands * rows <= permutations whose S-curve best separates pairs above and below the
+    Jaccard threshold, weighing the probability of missing a pair and of checking a needless one equally
+    """
+    similarities = np.linspace(0, 1, 201)
+    best = None
+    for rows in range(1, permutations + 1):
+        bands = permutations // rows
+        candidate = 1 - (1 - similarities ** rows) ** bands
+        error = np.where(similarities < threshold, candidate, 1 - candidate).mean()
+        if best is None or error < best[0]:
+            best = (error, bands, rows)
+    return best[1], best[2]
+
+
+class MinHasher:
+    """
+    MinHash signatures of texts over their word shingles: the share of equal positions in two
+    signatures estimates the Jaccard similarity of the texts' shingle sets
+    """
+
+    def __init__(self, permutations=128, shingle_words=5, seed=1):
+        self.shingle_words = shingle_words
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, MERSENNE_PRIME, size=permutations, dtype=np.uint64)
+        self.b = rng.randint(1, MERSENNE_PRIME, size=permutations, dtype=np.uint64)
+
+    def shingles(self, text):
+        words = WORD_PATTERN.findall(text.lower())
+        if len(words) <= self.shingle_words:
+            return {' '.join(words)}
+        return {' '.join(words[i:i + self.shingle_words]) for i in range(len(words) - self.shingle_words + 1)}
+
+    def signature(self, text):
+        hashes = np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in self.shingles(text)), dtype=np.uint64)
+        values = (np.outer(self.a, hashes) + self.b[:, None]) % MERSENNE_PRIME
+        return (values.min(axis=1) & 0xFFFFFFFF).astype(np.uint32)
+
+
+class NearDuplicateIndex:
+    """
+    MinHash signatures of the stored chunks with an LSH band index over them, in SQLite, to find earlier
+    chunks that a new chunk nearly repeats ("Copy of", "v2" and re-exported versions of the same text).
+
+    A chunk whose estimated Jaccard similarity (over word shingles) to a stored chunk reaches
+    Config.dedup_threshold is not stored again: the file's ledger entry points at the stored chunk, and the
+    file is recorded as an alias of it, with its own chunk metadata. A chunk that reaches only
+    Config.dedup_group_threshold is stored, but joins the stored chunk's duplicate group, and search returns
+    one chunk per group.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.hasher = MinHasher(self.config.dedup_permutations, self.config.dedup_shingle_words)
+        self.bands, self.rows = lsh_parameters(self.config.dedup_group_threshold, self.config.dedup_permutations)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.config.dedup_file, check_same_thread=False)
+        self.conn.executescript(
+            "CREATE TABLE IF NOT EXISTS chunks (chunk_id TEXT PRIMARY KEY, signature BLOB NOT NULL, "
+            "duplicate_group TEXT NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS bands (band INTEGER NOT NULL, bucket INTEGER NOT NULL, chunk_id TEXT NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS bands_bucket ON bands (band, bucket);"
+            "CREATE INDEX IF NOT EXISTS bands_chunk ON bands (chunk_id);"
+            "CREATE TABLE IF NOT EXISTS aliases (chunk_id TEXT NOT NULL, source TEXT NOT NULL, metadata TEXT NOT NULL, "
+            "PRIMARY KEY (chunk_id, source));"
+        )
+        self.conn.commit()
+        # Chunks stored by this run, by the file that stored them, until the ledger lists them
+        self.pending = {}
+        self.aliased = 0
+
+    def buckets(self, signature):
+        """The LSH bucket of each band of a signature, as signed 64-bit integers SQLite can store."""
+        return [
+            int.from_bytes(hashlib.blake2b(signature[band * self.rows:(band + 1) * self.rows].tobytes(),
+                                           digest_size=8).digest(), 'little', signed=True)
+            for band in range(self.bands)
+        ]
+
+    def nearest(self, signature, chunk_id):
+        """
+        (chunk id, group, estimated similarity) of the most similar other stored chunk sharing a bucket, or None
+        """
+        pairs = list(enumerate(self.buckets(signature)))
+        clause = ' OR '.join(['(band = ? AND bucket = ?)'] * len(pairs))
+        rows = self.conn.execute(
+            f"SELECT DISTINCT chunks.chunk_id, chunks.signature, chunks.duplicate_group FROM bands "
+            f"JOIN chunks ON chunks.chunk_id = bands.chunk_id WHERE ({clause}) AND chunks.chunk_id != ?",
+            [value for pair in pairs for value in pair] + [chunk_id]
+        ).fetchall()
+        best = None
+        for chunk_id, blob, group in rows:
+            similarity = float(np.mean(np.frombuffer(blob, dtype=np.uint32) == signature))
+            if best is None or similarity > best[2]:
+                best = (chunk_id, group, similarity)
+        return best
+
+    def add(self, chunk_id, signature, group):
+        self.conn.execute("INSERT OR REPLACE INTO chunks VALUES (?, ?, ?)", (chunk_id, signature.tobytes(), group))
+        self.conn.execute("DELETE FROM bands WHERE chunk_id = ?", (chunk_id,))
+        self.conn.executemany("INSERT INTO bands VALUES (?, ?, ?)",
+                              [(band, bucket, chunk_id) for band, bucket in enumerate(self.buckets(signature))])
+
+    def deduplicate(self, source, chunks, ids, ledger):
+        """
+        Decide for each of a file's chunks whether to store it. Returns (chunks to store, their ids, the ids the
+        file's ledger entry should list), where near-duplicates of stored chunks are listed under the stored id.
+        Chunks to store are registered here, so later files in the same run see them.
+        """
+        stored_chunks, stored_ids, ledger_ids = [], [], []
+        with self.lock:
+            for chunk, chunk_id in zip(chunks, ids):
+                signature = self.hasher.signature(chunk.page_content)
+                match = self.nearest(signature, chunk_id)
+                if match and match[2] >= self.config.dedup_threshold and self.kept_for_others(match[0], source, ledger):
+                    self.conn.execute("INSERT OR REPLACE INTO aliases VALUES (?, ?, ?)",
+                                      (match[0], source, json.dumps(chunk.metadata)))
+                    ledger_ids.append(match[0])
+                    self.aliased += 1
+                    continue
+                group = match[1] if match and match[2] >= self.config.dedup_group_threshold else chunk_id
+                self.add(chunk_id, signature, group)
+                self.pending.setdefault(chunk_id, source)
+                stored_chunks.append(chunk)
+                stored_ids.append(chunk_id)
+                ledger_ids.append(chunk_id)
+            self.conn.commit()
+        return stored_chunks, stored_ids, ledger_ids
+
+    def register(self, chunk_ids, texts):
+        """Add already stored chunks, grouping each with the most similar one added before it."""
+        with self.lock:
+            for chunk_id, text in zip(chunk_ids, texts):
+                signature = self.hasher.signature(text)
+                match = self.nearest(signature, chunk_id)
+                self.add(chunk_id, signature,
+                         match[1] if match and match[2] >= self.config.dedup_group_threshold else chunk_id)
+            self.conn.commit()
+
+    def kept_for_others(self, chunk_id, source, ledger):
+        """
+        Whether a stored chunk belongs to some file other than source (indexed, or stored earlier in this run).
+        A chunk only an earlier version of source itself has is about to go, so it is replaced, not aliased.
+        """
+        if self.pending.get(chunk_id, source) != source:
+            return True
+        return not ledger.unreferenced([chunk_id], source)
+
+    def drop_aliases(self, source, chunk_ids):
+        """Forget that source repeats these chunks."""
+        with self.lock:
+            self.conn.executemany("DELETE FROM aliases WHERE chunk_id = ? AND source = ?",
+                                  [(chunk_id, source) for chunk_id in chunk_ids])
+            self.conn.commit()
+
+    def take_alias(self, chunk_id):
+        """
+        For a stored chunk whose own file no longer has it: (source, chunk metadata) of a file that still
+        repeats it, which becomes the chunk's file from now on, or None
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT source, metadata FROM aliases WHERE chunk_id = ? LIMIT 1",
+                                    (chunk_id,)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute("DELETE FROM aliases WHERE chunk_id = ? AND source = ?", (chunk_id, row[0]))
+            self.conn.commit()
+        return row[0], json.loads(row[1])
+
+    def alias_metadata(self, chunk_id, source):
+        """The chunk metadata a file that repeats a stored chunk would have given it, or None"""
+        with self.lock:
+            row = self.conn.execute("SELECT metadata FROM aliases WHERE chunk_id = ? AND source = ?",
+                                    (chunk_id, source)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def sources(self, chunk_id):
+        """The other files that repeat a stored chunk."""
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT source FROM aliases WHERE chunk_id = ?", (chunk_id,))]
+
+    def delete(self, chunk_ids):
+        with self.lock:
+            for table in ('chunks', 'bands', 'aliases'):
+                self.conn.executemany(f"DELETE FROM {table} WHERE chunk_id = ?", [(chunk_id,) for chunk_id in chunk_ids])
+            self.conn.commit()
+
+    def begin_run(self, ledger):
+        """
+        Drop what an interrupted run registered but never finished: chunks no file lists, and aliases the
+        aliasing file's ledger entry does not list
+        """
+        self.pending.clear()
+        self.aliased = 0
+        with self.lock:
+            stale = [row[0] for row in self.conn.execute("SELECT chunk_id FROM chunks")
+                     if ledger.refcount[row[0]] <= 0]
+            stale_aliases = [row for row in self.conn.execute("SELECT chunk_id, source FROM aliases")
+                             if row[0] not in ledger.chunk_ids(row[1])]
+        if stale:
+            self.delete(stale)
+        if stale_aliases:
+            with self.lock:
+                self.conn.executemany("DELETE FROM aliases WHERE chunk_id = ? AND source = ?", stale_aliases)
+                self.conn.commit()
+
+    def groups(self, chunk_ids):
+        """{chunk id: duplicate group} for stored chunks (a chunk not found is its own group)."""
+        chunk_ids = list(chunk_ids)
+        found = {}
+        with self.lock:
+            for start in range(0, len(chunk_ids), 500):
+                part = chunk_ids[start:start + 500]
+                found.update(self.conn.execute(
+                    f"SELECT chunk_id, duplicate_group FROM chunks WHERE chunk_id IN ({','.join('?' * len(part))})", part
+                ).fetchall())
+        return {chunk_id: found.get(chunk_id, chunk_id) for chunk_id in chunk_ids}
+
+    def diversify(self, ranking, k):
+        """The first k chunk ids of a ranking, skipping chunks of a duplicate group already taken."""
+        groups = self.groups(ranking)
+        taken, result = set(), []
+        for chunk_id in ranking:
+            if groups[chunk_id] in taken:
+                continue
+            taken.add(groups[chunk_id])
+            result.append(chunk_id)
+            if len(result) == k:
+                break
+        return result
+
+    def stats(self):
+        with self.lock:
+            chunks, groups = self.conn.execute("SELECT COUNT(*), COUNT(DISTINCT duplicate_group) FROM chunks").fetchone()
+            aliases = self.conn.execute("SELECT COUNT(*) FROM aliases").fetchone()[0]
+        return {'stored_chunks': chunks, 'duplicate_groups': groups, 'aliases': aliases,
+                'aliased_this_run': self.aliased}
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
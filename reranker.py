@@ -0,0 +1,163 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import numpy as np
+from instrumentation import log, metrics
+
+
+def mmr(vectors, k, lambda_mult):
+    """
+    Maximal marginal relevance order of the first k of a ranking, given each candidate's vector (or None).
+
+    Relevance falls linearly with the candidate's rank, so the order of the hybrid search (vector and BM25)
+    is kept; each pick is the candidate with the best lambda_mult * relevance - (1 - lambda_mult) * (cosine
+    similarity to the closest chunk already picked). A candidate without a vector counts as unlike every other.
+    """
+    count = len(vectors)
+    dimensions = next((len(vector) for vector in vectors if vector is not None), 0)
+    matrix = np.zeros((count, dimensions), dtype=np.float32)
+    for index, vector in enumerate(vectors):
+        if vector is not None:
+            matrix[index] = vector
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    matrix /= np.where(norms == 0, 1.0, norms)
+    similarity = matrix @ matrix.T
+    relevance = 1 - np.arange(count) / max(count, 1)
+
+    picked = []
+    closest = np.full(count, -np.inf, dtype=np.float32)
+    remaining = np.ones(count, dtype=bool)
+    for _ in range(min(k, count)):
+        redundancy = np.where(np.isinf(closest), 0.0, closest)
+        scores = np.where(remaining, lambda_mult * relevance - (1 - lambda_mult) * redundancy, -np.inf)
+        index = int(np.argmax(scores))
+        picked.append(index)
+        remaining[index] = False
+        closest = np.maximum(closest, similarity[index])
+    return picked
+
+
+class Reranker:
+    """
+    Chooses the chunks for the answer prompt from a wider pool of search results:
+
+    1. MMR over the retrieval_candidates results, so overlapping chunks of one file don't crowd out the rest
+    2. optionally, a local cross-encoder (Config.reranker_model) re-scores the first reranker_candidates of
+       the MMR order on CPU, in batches, for at most reranker_budget_ms per question; what it doesn't get
+       to keeps its MMR order after the scored chunks
+    3. the best chunks are packed into the prompt, up to retrieval_k chunks and retrieval_max_tokens tokens
+
+    The model is loaded in the background on first use; until it is ready, questions skip step 2.
+    """
+
+    def __init__(self, config, encoder):
+        self.config = config
+        self.encoder = encoder
+        self.model = None
+        self.loading = None
+        self.failed = False
+        # Moving average of the time one batch takes to score, to skip batches that would overrun the budget
+        self.batch_seconds = 0.0
+        self.lock = threading.Lock()
+        # One scoring thread: under load questions queue for it, and those that wait past their budget skip it
+        self.pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='reranker')
+
+    def load(self):
+        """Start loading the cross-encoder in the background (if one is configured and not loading yet)."""
+        if not self.config.reranker_model:
+            return
+        with self.lock:
+            if self.loading is None:
+                self.loading = threading.Thread(target=self.load_model, name='reranker-load', daemon=True)
+                self.loading.start()
+
+    def load_model(self):
+        try:
+            # Imported here so the chat starts without loading torch when no reranker is configured
+            from sentence_transformers import CrossEncoder
+            start = time.perf_counter()
+            model = CrossEncoder(self.config.reranker_model, max_length=self.config.reranker_max_length,
+                                 device='cpu')
+            # The first call is much slower than the rest; keep it out of the batch time estimate
+            model.predict([('warm up', 'warm up')], show_progress_bar=False)
+            log('reranker.loaded', f"Loaded reranker {self.config.reranker_model} in "
+                                   f"{time.perf_counter() - start:.1f}s", model=self.config.reranker_model)
+            self.model = model
+        except Exception as e:
+            self.failed = True
+            log('reranker.error', f"Could not load reranker {self.config.reranker_model}, answering without it: "
+                                  f"{type(e).__name__}: {e}", level=logging.WARNING, model=self.config.reranker_model)
+
+    def tokens(self, doc):
+        return len(self.encoder.encode(doc.page_content, disallowed_special=()))
+
+    def score(self, pairs):
+        """Cross-encoder scores of (question, chunk) pairs, in the scoring thread."""
+        start = time.perf_counter()
+        scores = self.model.predict(pairs, batch_size=len(pairs), show_progress_bar=False)
+        seconds = time.perf_counter() - start
+        self.batch_seconds = seconds if not self.batch_seconds else 0.8 * self.batch_seconds + 0.2 * seconds
+        return [float(score) for score in scores]
+
+    def rerank(self, question, docs):
+        """
+        docs (in MMR order) reordered by cross-encoder score, as far as the latency budget allows
+        """
+        if self.model is None:
+            self.load()
+            metrics.inc('rag_reranker_total',
+                        outcome='disabled' if not self.config.reranker_model or self.failed else 'loading')
+            return docs
+        start = time.perf_counter()
+        deadline = start + self.config.reranker_budget_ms / 1000
+        candidates = docs[:self.config.reranker_candidates]
+        size = self.config.reranker_batch_size
+        scores = []
+        for offset in range(0, len(candidates), size):
+            remaining = deadline - time.perf_counter()
+            # A batch that can't finish in time would only hold up the next question's scoring. The estimate
+            # shrinks while questions skip scoring altogether, so one slow spell doesn't switch it off for good.
+            if remaining < self.batch_seconds:
+                if not scores:
+                    self.batch_seconds *= 0.9
+                break
+            future = self.pool.submit(self.score, [(question, doc.page_content)
+                                                   for doc in candidates[offset:offset + size]])
+            try:
+                scores.extend(future.result(timeout=remaining))
+            except TimeoutError:
+                # A batch already running finishes in the background; its scores come too late for this question
+                future.cancel()
+                break
+        metrics.observe('rag_stage_seconds', time.perf_counter() - start, stage='rerank')
+        metrics.inc('rag_reranker_total', outcome='scored' if len(scores) == len(candidates) else
+                    'partial' if scores else 'timeout')
+        scored = sorted(range(len(scores)), key=lambda index: scores[index], reverse=True)
+        return [docs[index] for index in scored] + docs[len(scores):]
+
+    def pack(self, docs):
+        """
+        The leading docs that fit in retrieval_k chunks and retrieval_max_tokens tokens (the first always goes in);
+        a chunk too large for what is left is skipped in favour of smaller ones after it
+        """
+        packed, total = [], 0
+        for doc in docs:
+            if len(packed) == self.config.retrieval_k:
+                break
+            tokens = self.tokens(doc)
+            if packed and total + tokens > self.config.retrieval_max_tokens:
+                continue
+            packed.append(doc)
+            total += tokens
+        return packed
+
+    def select(self, question, docs, vectors):
+        """
+        The chunks for the answer prompt out of the search results (best first) and their vectors (None if unknown)
+        """
+        if not docs:
+            return []
+        order = mmr(vectors, len(docs), self.config.mmr_lambda)
+        return self.pack(self.rerank(question, [docs[index] for index in order]))
+
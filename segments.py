@@ -0,0 +1,229 @@
+import json
+import math
+import os
+import threading
+import numpy as np
+
+
+def save_array(path, array):
+    # Write next to the target and rename, so readers that map the old file are unaffected
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+class Segment:
+    """
+    One immutable slice of a segmented index, memory-mapped from one .npy file per field.
+
+    Every segment has 'ids' (chunk ids, sorted, so a row's number is its position there) and 'live'
+    (0 for rows deleted since the segment was written); subclasses add their own row data.
+    """
+
+    FIELDS = ('ids', 'live')
+
+    def __init__(self, directory, name):
+        self.name = name
+        self.base = os.path.join(directory, name)
+        for field in self.FIELDS:
+            setattr(self, field, np.load(self.path(field), mmap_mode='r'))
+
+    def path(self, field):
+        return f"{self.base}.{field}.npy"
+
+    @classmethod
+    def write(cls, directory, name, arrays):
+        """Write the given field arrays (ids sorted) plus an all-live map, and open the segment."""
+        arrays = dict(arrays, live=np.ones(len(arrays['ids']), dtype=np.uint8))
+        for field in cls.FIELDS:
+            save_array(os.path.join(directory, f"{name}.{field}.npy"), arrays[field])
+        return cls(directory, name)
+
+    def find(self, ids):
+        """Row numbers of the given (encoded) chunk ids that are live in this segment."""
+        if not len(self.ids):
+            return np.array([], dtype=np.int64)
+        positions = np.searchsorted(self.ids, ids)
+        inside = positions < len(self.ids)
+        positions, ids = positions[inside], ids[inside]
+        matched = positions[self.ids[positions] == ids]
+        return matched[self.live[matched] == 1]
+
+    def mask(self, ids):
+        """Boolean row mask of the given (encoded) chunk ids that are live here."""
+        mask = np.zeros(len(self.ids), dtype=bool)
+        mask[self.find(ids)] = True
+        return mask
+
+    def remove(self):
+        for field in self.FIELDS:
+            try:
+                os.remove(self.path(field))
+            except FileNotFoundError:
+                pass
+
+
+class SegmentedIndex:
+    """
+    Chunk-id keyed index stored as memory-mapped segments listed in a manifest.json.
+
+    Each add writes a new segment, deletions clear bits in a segment's live map, and segments of the
+    same size tier are merged merge_factor at a time, so writes stay cheap and reads touch only a few
+    segments. Readers reopen the segments when the manifest changes on disk. Subclasses say what a
+    segment holds (segment_class) and how to merge segments (merge_arrays).
+    """
+
+    segment_class = Segment
+
+    def __init__(self, config, directory, merge_factor):
+        self.config = config
+        self.directory = directory
+        self.merge_factor = merge_factor
+        self.manifest_path = os.path.join(self.directory, 'manifest.json')
+        self.lock = threading.Lock()
+        self.manifest = {'next_segment': 0, 'segments': []}
+        self.segments = []
+        self.loaded_mtime = None
+        self.load()
+
+    def exists(self):
+        return os.path.exists(self.manifest_path)
+
+    def load(self):
+        """(Re)open the segments if the manifest changed on disk since we last looked."""
+        try:
+            mtime = os.stat(self.manifest_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        with self.lock:
+            if mtime == self.loaded_mtime:
+                return
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            self.segments = [self.segment_class(self.directory, entry['name']) for entry in manifest['segments']]
+            self.manifest = manifest
+            self.loaded_mtime = mtime
+
+    def save_manifest(self):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=4)
+        os.replace(tmp_path, self.manifest_path)
+        self.loaded_mtime = os.stat(self.manifest_path).st_mtime_ns
+
+    @staticmethod
+    def encode_ids(ids):
+        return np.array([chunk_id.encode('utf-8') for chunk_id in ids], dtype=np.bytes_)
+
+    def live_count(self):
+        return sum(entry['live'] for entry in self.manifest['segments'])
+
+    def missing(self, ids):
+        """Indexes into ids of the entries not yet live in any segment (first occurrence of each id)."""
+        self.load()
+        first = {}
+        for index, chunk_id in enumerate(ids):
+            first.setdefault(chunk_id, index)
+        if first:
+            encoded = self.encode_ids(list(first))
+            for segment in self.segments:
+                for number in segment.find(encoded):
+                    first.pop(segment.ids[number].decode('utf-8'), None)
+        return sorted(first.values(), key=lambda index: ids[index])
+
+    def add_segment(self, arrays, stats=None):
+        """Write a new segment (arrays keyed by field, ids sorted) with its manifest stats, then merge if due."""
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            segment = self.segment_class.write(self.directory, self.new_segment_name(), arrays)
+            self.segments.append(segment)
+            count = len(arrays['ids'])
+            self.manifest['segments'].append({'name': segment.name, 'docs': count, 'live': count, **(stats or {})})
+            self.merge_tiers()
+            self.save_manifest()
+
+    def deleted_stats(self, segment, numbers):
+        """Amounts to subtract from a segment's manifest stats when these rows are deleted."""
+        return {}
+
+    def delete(self, ids):
+        """Mark chunks as deleted in whichever segments hold them."""
+        if not ids:
+            return
+        self.load()
+        with self.lock:
+            encoded = self.encode_ids(ids)
+            changed = False
+            for segment, entry in zip(self.segments, self.manifest['segments']):
+                numbers = segment.find(encoded)
+                if not len(numbers):
+                    continue
+                live = np.array(segment.live)
+                live[numbers] = 0
+                save_array(segment.path('live'), live)
+                segment.live = np.load(segment.path('live'), mmap_mode='r')
+                entry['live'] -= len(numbers)
+                for key, amount in self.deleted_stats(segment, numbers).items():
+                    entry[key] -= amount
+                changed = True
+            if not changed:
+                return
+            # Drop segments with nothing left in them
+            empty = [(segment, entry) for segment, entry in zip(self.segments, self.manifest['segments'])
+                     if entry['live'] == 0]
+            for segment, entry in empty:
+                self.segments.remove(segment)
+                self.manifest['segments'].remove(entry)
+            self.save_manifest()
+            for segment, _ in empty:
+                segment.remove()
+
+    def new_segment_name(self):
+        name = f"segment-{self.manifest['next_segment']:06d}"
+        self.manifest['next_segment'] += 1
+        return name
+
+    def merge_tiers(self):
+        """Merge segments of the same size tier (powers of merge_factor) once a tier fills up."""
+        while True:
+            tiers = {}
+            for segment, entry in zip(self.segments, self.manifest['segments']):
+                tier = int(math.log(max(entry['live'], 1), self.merge_factor))
+                tiers.setdefault(tier, []).append((segment, entry))
+            full = [members for members in tiers.values() if len(members) >= self.merge_factor]
+            if not full:
+                return
+            self.merge(full[0])
+
+    @staticmethod
+    def live_order(segments):
+        """
+        For merging: the live ids of several segments in sorted order, each segment's live row mask,
+        and the merged row number of every live row (in segment order, before sorting)
+        """
+        masks = [np.asarray(segment.live) == 1 for segment in segments]
+        ids = np.concatenate([np.asarray(segment.ids)[mask] for segment, mask in zip(segments, masks)])
+        order = np.argsort(ids, kind='stable')
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        return ids[order], masks, order, rank
+
+    def merge_arrays(self, segments):
+        """Field arrays and manifest stats of one segment holding the live rows of these segments."""
+        raise NotImplementedError
+
+    def merge(self, members):
+        """Rewrite several segments as one, dropping deleted rows."""
+        arrays, stats = self.merge_arrays([segment for segment, _ in members])
+        segment = self.segment_class.write(self.directory, self.new_segment_name(), arrays)
+        for old, entry in members:
+            self.segments.remove(old)
+            self.manifest['segments'].remove(entry)
+        self.segments.append(segment)
+        count = len(arrays['ids'])
+        self.manifest['segments'].append({'name': segment.name, 'docs': count, 'live': count, **stats})
+        self.save_manifest()
+        for old, _ in members:
+            old.remove()
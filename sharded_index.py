@@ -0,0 +1,318 @@
+import copy
+import hashlib
+import os
+import re
+import shutil
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import tiktoken
+from document_parser import ParserPool, indexable
+from embedding_backends import make_embeddings
+from embedding_cache import CachedEmbeddings
+from index_generations import IndexGenerations
+from instrumentation import log, metrics
+from metadata_catalog import MetadataCatalog
+from metadata_store import MetadataStore
+from vector_store import Chroma, ChromaRetriever
+
+# The shard of files at the top of My Drive (or without a value for Config.shard_by)
+ROOT_SHARD = '_root'
+
+
+class ShardCatalog:
+    """The filter choices (folders, file types) of all shards, for the chat's filter inputs."""
+
+    def __init__(self, index):
+        self.index = index
+
+    def directories(self):
+        return sorted({directory for shard in self.index.shards.values() for directory in shard.catalog.directories()})
+
+    def extensions(self):
+        return sorted({extension for shard in self.index.shards.values() for extension in shard.catalog.extensions()})
+
+
+class ShardedChroma:
+    """
+    The index split into shards: one Chroma collection, with its own lexical index, compact vectors, ingest
+    ledger and near-duplicate signatures, per top-level Drive folder (Config.shard_by = 'folder') or per value
+    of another metadata key, each in a directory under Config.shards_directory.
+
+    Indexing only touches the shards whose files changed, so re-indexing one busy folder leaves the rest as
+    they are. A search runs in every shard at once and merges the candidates by score, vector and BM25 results
+    separately (the shards score BM25 with their term statistics added up, as one index would), then fuses
+    the merged lists with reciprocal-rank fusion as Chroma.search does. A folder filter with shard_by =
+    'folder' searches only the shard of that folder. Near-duplicate chunks are found within a shard only.
+
+    Has the parts of Chroma's interface the chat, the daemon and main.py use.
+    """
+
+    def __init__(self, config, embeddings=None):
+        self.config = config
+        self.encoder = tiktoken.get_encoding("cl100k_base")
+        if embeddings is None:
+            embeddings = make_embeddings(self.config, self.encoder)
+        # One embedding cache (and one embedding model) for all shards
+        self.embeddings = CachedEmbeddings(embeddings, self.config)
+        self.metadata_store = MetadataStore(self.config)
+        self.catalog = ShardCatalog(self)
+        self.shards = {}
+        self.lock = threading.Lock()
+        if os.path.isdir(self.config.shards_directory):
+            for name in sorted(os.listdir(self.config.shards_directory)):
+                if os.path.isdir(os.path.join(self.config.shards_directory, name)):
+                    self.open_shard(name)
+        self.search_pool = ThreadPoolExecutor(max_workers=self.config.chat_concurrency,
+                                              thread_name_prefix='shard-search')
+
+    @staticmethod
+    def shard_name(value):
+        """The directory of a shard: readable, and unique per value"""
+        if not value:
+            return ROOT_SHARD
+        slug = re.sub(r'[^\w.-]+', '-', value).strip('-.')[:40]
+        return f"{slug}-{hashlib.sha1(value.encode('utf-8')).hexdigest()[:8]}"
+
+    def shard_value(self, file_path):
+        """The top-level folder of a downloaded file ('' at the top of My Drive), or its Config.shard_by metadata"""
+        metadata = self.metadata_store.get(file_path) or {}
+        if self.config.shard_by == 'folder':
+            folder = metadata.get('parent_directory')
+            if folder is None:
+                folder = os.path.relpath(Path(file_path).parent, self.config.downloaded_files_path)
+            folder = MetadataCatalog.normalize_folder(folder)
+            return '' if folder == '.' else folder.split(os.sep)[0]
+        value = metadata.get(self.config.shard_by)
+        return '' if value is None else str(value)
+
+    def shard_of(self, file_path):
+        return self.shard_name(self.shard_value(file_path))
+
+    def shard_config(self, name):
+        """A copy of the config whose index paths point into the shard's directory"""
+        config = copy.copy(self.config)
+        directory = os.path.join(self.config.shards_directory, name)
+        for path in IndexGenerations.INDEX_PATHS:
+            if path != 'shards_directory':
+                setattr(config, path, os.path.join(directory, os.path.basename(getattr(self.config, path))))
+        return config
+
+    def open_shard(self, name):
+        with self.lock:
+            if name not in self.shards:
+                os.makedirs(os.path.join(self.config.shards_directory, name), exist_ok=True)
+                self.shards[name] = Chroma(self.shard_config(name), embeddings=self.embeddings,
+                                           files=lambda file_path: self.shard_of(file_path) == name)
+            return self.shards[name]
+
+    def remove_shard(self, name):
+        with self.lock:
+            shard = self.shards.pop(name)
+        shard.close()
+        shutil.rmtree(os.path.join(self.config.shards_directory, name), ignore_errors=True)
+
+    def unshare_shard(self, name):
+        """
+        Give a shard hard-linked from the previous generation (see IndexGenerations.prepare_next) copies of its
+        own files before it is written to, so the generation being served stays as it was
+        """
+        directory = os.path.join(self.config.shards_directory, name)
+        if all(os.stat(os.path.join(root, file)).st_nlink == 1
+               for root, _, files in os.walk(directory) for file in files):
+            return self.shards[name]
+        with self.lock:
+            shard = self.shards.pop(name)
+        shard.close()
+        shutil.copytree(directory, f"{directory}.copy")
+        shutil.rmtree(directory)
+        os.rename(f"{directory}.copy", directory)
+        return self.open_shard(name)
+
+    def list_files(self):
+        """
+        Recursively yield every file under the download directory that a loader can index
+        """
+        for root, _, files in os.walk(self.config.downloaded_files_path):
+            for file in files:
+                file_path = Path(root) / file
+                if indexable(file_path):
+                    yield file_path
+
+    def files_by_shard(self):
+        """The downloaded files each shard should hold, from one walk of the download directory"""
+        files = defaultdict(list)
+        for file_path in self.list_files():
+            files[self.shard_of(file_path)].append(file_path)
+        return files
+
+    def process_and_store(self):
+        """
+        Index new and changed files and purge removed ones, shard by shard, skipping shards with nothing to do.
+        A shard whose folder is gone is deleted.
+        """
+        current = self.files_by_shard()
+        # The parser workers (and the libraries they imported) carry over from shard to shard
+        parsers = ParserPool(self.config, persistent=True)
+        try:
+            for name in sorted(set(current) | set(self.shards)):
+                shard = self.open_shard(name)
+                files = current.get(name, [])
+                pending = shard.pending_changes(files)
+                if pending:
+                    log('shards.index', f"Indexing {pending} changed files in shard {name}", shard=name, files=pending)
+                    shard = self.unshare_shard(name)
+                    with metrics.timer('index_shard'):
+                        shard.process_and_store(parsers, files)
+                if name not in current:
+                    log('shards.removed', f"Removed shard {name}, which no longer has any files", shard=name)
+                    self.remove_shard(name)
+        finally:
+            parsers.close()
+        metrics.set('rag_shards', len(self.shards))
+
+    def pending_changes(self):
+        """
+        How many files process_and_store would index or remove, over all shards (including ones not created yet)
+        """
+        return sum(self.changes_by_shard().values())
+
+    def changes_by_shard(self):
+        """How many files process_and_store would index or remove in each shard"""
+        shards = dict(self.shards)
+        current = self.files_by_shard()
+        changes = {name: len(files) for name, files in current.items() if name not in shards}
+        changes.update((name, shard.pending_changes(current.get(name, []))) for name, shard in shards.items())
+        return changes
+
+    def unchanged_shards(self):
+        """The shards process_and_store would leave as they are"""
+        return [name for name, changes in self.changes_by_shard().items() if not changes]
+
+    def index_generation(self):
+        """Changes whenever any shard changes"""
+        return tuple(sorted((name, shard.index_generation()) for name, shard in self.shards.items()))
+
+    def count(self):
+        """Chunks in all shards"""
+        return sum(shard.count() for shard in self.shards.values())
+
+    def route(self, filters):
+        """The shards a search with these filters needs: just the folder's with a folder filter and shard_by 'folder'"""
+        shards = dict(self.shards)
+        folder = (filters or {}).get('folder')
+        if self.config.shard_by != 'folder' or not folder:
+            return shards
+        folder = MetadataCatalog.normalize_folder(folder)
+        if folder == '.':
+            return shards
+        name = self.shard_name(folder.split(os.sep)[0])
+        return {name: shards[name]} if name in shards else {}
+
+    def search(self, query, k=5, embedding=None, filters=None):
+        """
+        Top-k chunks for a query over all shards (see Chroma.search), searching the shards concurrently
+        """
+        with metrics.timer('retrieve'):
+            return self.timed_search(query, k, embedding, filters)
+
+    def timed_search(self, query, k, embedding, filters):
+        shards = self.route(filters)
+        metrics.inc('rag_shard_searches_total', len(shards))
+        if not shards:
+            return []
+        if embedding is None:
+            embedding = self.embeddings.embed_query(query)
+        first = next(iter(shards.values()))
+        candidates = first.candidate_count(k)
+        statistics = self.lexical_statistics(query) if self.config.hybrid_search else None
+        futures = {name: self.search_pool.submit(shard.candidates, query, candidates, embedding, filters, statistics)
+                   for name, shard in shards.items()}
+        # Identical files in two shards give the same chunk id in both; each id is ranked once, at its best score
+        dense, lexical, owners = {}, {}, {}
+        for name, future in futures.items():
+            shard_dense, shard_lexical = future.result()
+            for hit in shard_dense:
+                if hit[0] not in dense or hit[2] > dense[hit[0]][2]:
+                    dense[hit[0]] = hit
+                owners.setdefault(hit[0], name)
+            for chunk_id, score in shard_lexical:
+                lexical[chunk_id] = max(score, lexical.get(chunk_id, score))
+                owners.setdefault(chunk_id, name)
+        dense = sorted(dense.values(), key=lambda hit: hit[2], reverse=True)[:candidates]
+        lexical = sorted(lexical.items(), key=lambda hit: hit[1], reverse=True)[:candidates]
+        top = self.diversify(first.fuse(dense, lexical), k, shards, owners)
+
+        docs = {chunk_id: doc for chunk_id, doc, _ in dense}
+        missing = defaultdict(list)
+        for chunk_id in top:
+            if chunk_id not in docs:
+                missing[owners[chunk_id]].append(chunk_id)
+        for name, ids in missing.items():
+            docs.update(shards[name].documents(ids))
+        cited = {}
+        for chunk_id in top:
+            if chunk_id in docs:
+                cited.setdefault(owners[chunk_id], {})[chunk_id] = docs[chunk_id]
+        docs = {}
+        for name, shard_docs in cited.items():
+            docs.update(shards[name].cite(shard_docs, filters))
+        return [docs[chunk_id] for chunk_id in top if chunk_id in docs]
+
+    def lexical_statistics(self, query):
+        """
+        The BM25 term statistics of all shards added up, so the scores of the shards searched can be merged and
+        match those of one index. Cheap next to a search: only the query terms' postings are counted.
+        """
+        shards = list(self.shards.values())
+        if len(shards) == 1:
+            return None
+        documents, length, df = 0, 0, Counter()
+        for shard_documents, shard_length, shard_df in self.search_pool.map(
+                lambda shard: shard.lexical.statistics(query), shards):
+            documents += shard_documents
+            length += shard_length
+            df.update(shard_df)
+        return documents, length, df
+
+    def diversify(self, ranking, k, shards, owners):
+        """
+        The top k of a ranking of chunk ids, one per duplicate group; each shard knows the groups of its own chunks
+        """
+        by_shard = defaultdict(list)
+        for chunk_id in ranking:
+            by_shard[owners[chunk_id]].append(chunk_id)
+        kept = set()
+        for name, ids in by_shard.items():
+            kept.update(shards[name].diversify(ids, k))
+        return [chunk_id for chunk_id in ranking if chunk_id in kept][:k]
+
+    def cached_vectors(self, docs):
+        """
+        The vector of each document's chunk text from the embedding cache (None where it was evicted), without
+        embedding anything
+        """
+        return self.embeddings.lookup([doc.page_content for doc in docs])[1]
+
+    def as_retriever(self, k=5, filters=None):
+        """
+        A LangChain retriever over search(), with fixed filters
+        """
+        return ChromaRetriever(chroma=self, k=k, filters=filters)
+
+    def close(self):
+        """
+        Release every shard, the thread pool and the cache connection of an index that is no longer served
+        """
+        self.search_pool.shutdown(wait=False)
+        for shard in self.shards.values():
+            shard.close()
+        self.embeddings.close()
+
+
+def make_index(config, embeddings=None):
+    """The index as Config.shard_by asks for: one Chroma collection (None), or shards of them"""
+    if config.shard_by:
+        return ShardedChroma(config, embeddings=embeddings)
+    return Chroma(config, embeddings=embeddings)
@@ -1,30 +1,90 @@
 import os
 from pathlib import Path
 # Langchain imports
-from langchain_community.document_loaders import PyPDFLoader, Docx2txtLoader
 from langchain_community.vectorstores import Chroma as ChromaStore
-from langchain_community.embeddings import OpenAIEmbeddings
 from langchain.schema import Document
-from langchain.text_splitter import CharacterTextSplitter
-from typing import Dict, Any
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.retrievers import BaseRetriever
+from chromadb.api.shared_system_client import SharedSystemClient
+from typing import Dict, Any, List, Optional
 import hashlib
+import logging
 import re
-import json
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import tiktoken
+from document_parser import ParserPool, indexable, parse_file
+from chunker import make_chunker
+from compact_vectors import CompactVectors
+from embedding_backends import make_embeddings
+from embedding_cache import CachedEmbeddings
+from embedding_scheduler import EmbeddingScheduler
+from ingest_ledger import IngestLedger
+from instrumentation import log, metrics
+from lexical_index import LexicalIndex
+from metadata_catalog import MetadataCatalog, modified_timestamp
+from metadata_store import MetadataStore
+from near_duplicates import NearDuplicateIndex
+
+# The model OpenAIEmbeddings used before the embedding model was configurable
+LEGACY_EMBEDDING_MODEL = 'text-embedding-ada-002'
+
+
+def reciprocal_rank_fusion(rankings, rrf_k):
+    """Chunk ids of several rankings ordered by the sum of 1 / (rrf_k + rank) over the rankings they are in."""
+    scores = {}
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (rrf_k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+class ChromaRetriever(BaseRetriever):
+    """
+    LangChain retriever over Chroma.search (hybrid, optionally filtered by folder, type, date or file)
+    """
+    chroma: Any
+    k: int = 5
+    filters: Optional[Dict[str, Any]] = None
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self.chroma.search(query, k=self.k, filters=self.filters)
 
 
 class Chroma:
-    def __init__(self, config):
+    def __init__(self, config, embeddings=None, files=None):
         self.config = config
+        # Which downloaded files belong in this collection (all of them by default); see sharded_index.py
+        self.files = files
         self.pdf_count = 0
         self.docx_count = 0
         enc = tiktoken.get_encoding("cl100k_base") # get the encoding that openAI uses.
-        self.embeddings = OpenAIEmbeddings(disallowed_special=(enc.special_tokens_set - {'<|endoftext|>'}))    
+        self.encoder = enc
+        # Ingest and query embeddings both go through a local cache keyed by model and chunk text
+        if embeddings is None:
+            embeddings = make_embeddings(self.config, enc)
+        # An embedding cache passed in (shared by the shards of one index) stays open until its owner closes it
+        self.owns_embeddings = not isinstance(embeddings, CachedEmbeddings)
+        self.embeddings = CachedEmbeddings(embeddings, self.config) if self.owns_embeddings else embeddings
+        # Splits each parsed file into chunks, sized in tokens of the same encoding
+        self.chunker = make_chunker(self.config, enc)
         self.db = ChromaStore(
             collection_name=self.config.collection_name,
             embedding_function=self.embeddings,
-            persist_directory=self.config.db_persist_directory
+            persist_directory=self.config.db_persist_directory,
+            collection_metadata=self.index_settings()
         )
+        self.check_vector_storage()
+        # In a compact storage mode the vectors live here and Chroma only keeps documents and metadata
+        self.vectors = CompactVectors(self.config) if self.config.vector_storage != 'chroma' else None
+        self.metadata_store = MetadataStore(self.config)
+        # Secondary indexes over the indexed files, for query filters
+        self.catalog = MetadataCatalog(self.config, self.metadata_store)
+        # BM25 index over the same chunks and ids, for hybrid search
+        self.lexical = LexicalIndex(self.config)
+        # MinHash/LSH signatures of the stored chunks, so near-duplicates are stored once
+        self.dedup = NearDuplicateIndex(self.config) if self.config.near_duplicate_dedup else None
+        self.search_pool = ThreadPoolExecutor(max_workers=self.config.chat_concurrency)
     '''
     def remove_chroma_db(self):
         try:
@@ -41,45 +101,91 @@ class Chroma:
             print(f"Error removing directory '{self.config.db_persist_directory}': {e}")
     '''
 
-    def get_documents(self):
+    def index_settings(self):
         """
-        Recursively load all PDF and DOCX documents from the directory
+        What the collection records about how its vectors were made: vectors of another model or storage mode
+        can't be searched alongside them
+        """
+        return {'vector_storage': self.config.vector_storage, 'embedding_model': self.embeddings.model}
+
+    def check_vector_storage(self):
+        """
+        Refuse to mix vector storage modes or embedding models in one collection
+        """
+        collection = self.db._collection
+        metadata = collection.metadata or {}
+        settings = self.index_settings()
+        # Collections from before these were recorded kept float32 vectors of OpenAI's default model
+        stored = {'vector_storage': metadata.get('vector_storage', 'chroma'),
+                  'embedding_model': metadata.get('embedding_model', LEGACY_EMBEDDING_MODEL)}
+        if all(metadata.get(key) == value for key, value in settings.items()):
+            return
+        if collection.count():
+            reset = (f"To switch, delete {self.config.db_persist_directory}, {self.config.ingest_ledger_file}, "
+                     f"{self.config.lexical_index_directory} and {self.config.vector_store_directory} and index again.")
+            if stored['vector_storage'] != settings['vector_storage']:
+                raise ValueError(
+                    f"Collection '{self.config.collection_name}' keeps its vectors as '{stored['vector_storage']}' "
+                    f"but Config.vector_storage is '{self.config.vector_storage}'. {reset}"
+                )
+            if stored['embedding_model'] != settings['embedding_model']:
+                raise ValueError(
+                    f"Collection '{self.config.collection_name}' was built with embedding model "
+                    f"'{stored['embedding_model']}' but the configured model is '{settings['embedding_model']}' "
+                    f"(Config.embedding_backend '{self.config.embedding_backend}'). {reset}"
+                )
+        collection.modify(metadata={**metadata, **settings})
+
+    def list_files(self):
+        """
+        Recursively yield every file under the download directory that a loader can index (and that belongs in
+        this collection)
         """
         self.directory_path = Path(self.config.downloaded_files_path)
-        all_docs = []
-        
+
         if not self.directory_path.exists() or not self.directory_path.is_dir():
-            print(f"The directory {self.directory_path} does not exist or is not a directory")
-            return all_docs
-        
+            log('index.error', f"The directory {self.directory_path} does not exist or is not a directory",
+                level=logging.ERROR, path=str(self.directory_path))
+            return
+
         # Walk through all files and directories
         for root, _, files in os.walk(self.directory_path):
             for file in files:
                 file_path = Path(root) / file
-                file_extension = file_path.suffix.lower()
-                try:    
-                    # Process PDFs
-                    if file_extension == '.pdf':
-                        print(f"Loading PDF: {file_path}")
-                        loader = PyPDFLoader(str(file_path))
-                        docs = loader.load()
-                        # Enhance the metadata for each document page
-                        enhanced_docs = self.enhance_document_metadata(docs, file_path)
-                        all_docs.extend(enhanced_docs)
-                        self.pdf_count += 1
-                    
-                    # Process DOCX files
-                    elif file_extension == '.docx':
-                        print(f"Loading DOCX: {file_path}")
-                        loader = Docx2txtLoader(str(file_path))
-                        docs = loader.load()
-                        # Enhance the metadata for each document page
-                        enhanced_docs = self.enhance_document_metadata(docs, file_path)
-                        all_docs.extend(enhanced_docs)
-                        self.docx_count += 1
-                
-                except Exception as e:
-                    print(f"Error processing {file_path}: {e}")
+                if indexable(file_path) and (self.files is None or self.files(file_path)):
+                    yield file_path
+
+    def load_file(self, file_path):
+        """
+        Load one file in this process into documents with enhanced metadata
+        """
+        return self.to_documents(file_path, parse_file(file_path))
+
+    def to_documents(self, file_path, pages):
+        """
+        Turn parsed (text, metadata) pages into documents with enhanced metadata
+        """
+        file_extension = file_path.suffix.lower()
+        if file_extension == '.pdf':
+            self.pdf_count += 1
+        elif file_extension == '.docx':
+            self.docx_count += 1
+
+        docs = [Document(page_content=text, metadata=metadata) for text, metadata in pages]
+        # Enhance the metadata for each document page
+        return self.enhance_document_metadata(docs, file_path)
+
+    def get_documents(self):
+        """
+        Recursively load all indexable documents from the directory
+        """
+        all_docs = []
+        for file_path in self.list_files():
+            try:
+                all_docs.extend(self.load_file(file_path))
+            except Exception as e:
+                log('parse.error', f"Error processing {file_path}: {e}", level=logging.WARNING,
+                    path=str(file_path), error=str(e))
 
         return all_docs
     
@@ -88,10 +194,10 @@ class Chroma:
         """
         Enhance document metadata by combining file metadata with document-specific metadata
         """
-        enhanced_docs = []
+        file_metadata = self.get_metadata(file_path)
         for doc in docs:
             # Start with the file metadata
-            enhanced_metadata = self.get_metadata(file_path)
+            enhanced_metadata = dict(file_metadata)
             # Add any existing metadata from the document
             #if hasattr(doc, 'metadata') and doc.metadata:
             #    enhanced_metadata.update(doc.metadata)
@@ -103,6 +209,13 @@ class Chroma:
             title_match = re.match(r'^#+\s+(.+)$', content.strip().split('\n')[0]) if content else None
             if title_match:
                 enhanced_metadata['title'] = title_match.group(1)
+            # Page numbers as printed (the PDF loader counts from 0); the chunker carries them into the chunks
+            if doc.metadata.get('page') is not None:
+                enhanced_metadata['page'] = doc.metadata['page'] + 1
+            # Numeric, so date filters can be pushed into Chroma's where clause
+            timestamp = modified_timestamp(enhanced_metadata)
+            if timestamp is not None:
+                enhanced_metadata['modified_timestamp'] = timestamp
             
             # Create a new document with enhanced metadata
             enhanced_doc = Document(
@@ -110,44 +223,516 @@ class Chroma:
                 metadata=enhanced_metadata
             )
             
-            enhanced_docs.append(enhanced_doc)
-        
-        return enhanced_docs
+            yield enhanced_doc
     
     def get_metadata(self, file_path: Path) -> Dict[str, Any]:
         """
-        get metadata from the json file
+        get metadata from the json file, loaded once and indexed by path and hash
         """
-        # Generate file hash for unique identification
-        file_hash = ""
-        try:
-            with open(file_path, "rb") as f:
-                content = f.read()
-                file_hash = hashlib.md5(content).hexdigest()
-        except Exception as e:
-            print(f"Could not generate hash for {file_path}: {e}")
+        metadata = self.metadata_store.get(file_path)
+        if metadata is None:
+            raise KeyError(f"No metadata recorded for {file_path}")
 
-        with open(self.config.metadata_file) as f:
-            d = json.load(f)
+        return dict(metadata)
 
-        metadata = d[file_hash]
+    def chunk_ids(self, file_hash, chunks):
+        """
+        Deterministic chunk ids from the file hash, chunk index and chunk content, so re-indexing is idempotent
+        """
+        ids = []
+        for index, chunk in enumerate(chunks):
+            content_hash = hashlib.sha1(chunk.page_content.encode('utf-8')).hexdigest()[:16]
+            ids.append(f"{file_hash}-{index}-{content_hash}")
+        return ids
 
-        return metadata
+    def changed_files(self, ledger, seen, files=None):
+        """
+        Walk the download directory (or go through the given files of this collection) and yield
+        (file_path, file_hash) for files not indexed at their current hash with the current chunker settings
+        """
+        for file_path in (self.list_files() if files is None else files):
+            seen.add(str(file_path))
+            try:
+                file_hash = self.get_metadata(file_path)['file_hash']
+            except Exception as e:
+                log('index.error', f"Error processing {file_path}: {e}", level=logging.WARNING,
+                    path=str(file_path), error=str(e))
+                continue
+            if not ledger.is_current(str(file_path), file_hash, self.chunker.signature):
+                yield file_path, file_hash
+
+    def split_files(self, files, parsers=None):
+        """
+        Parse files in the process pool (a new one unless given), then enrich and split each one, yielding
+        (source, file_hash, chunks, ids) one file at a time. A file that fails to parse or split is yielded
+        without chunks, so the ledger records it as indexed at this hash (and drops its earlier chunks) rather
+        than retrying it on every run until it changes again.
+        """
+        for file_path, file_hash, pages, error, seconds in (parsers or ParserPool(self.config)).imap(files):
+            metrics.observe('rag_stage_seconds', seconds, stage='parse')
+            if error:
+                metrics.inc('rag_parse_files_total', outcome='error')
+                log('parse.error', f"Error processing {file_path}: {error}", level=logging.WARNING,
+                    path=str(file_path), error=str(error))
+                yield str(file_path), file_hash, [], []
+                continue
+            metrics.inc('rag_parse_files_total', outcome='ok')
+            metrics.inc('rag_parsed_pages_total', len(pages))
+            log('parse.file', f"Parsed {file_path}: {len(pages)} pages in {seconds:.2f}s", level=logging.DEBUG,
+                path=str(file_path), pages=len(pages), seconds=round(seconds, 3))
+            try:
+                with metrics.timer('split'):
+                    chunks = self.chunker.split_documents(self.to_documents(file_path, pages))
+            except Exception as e:
+                log('split.error', f"Error processing {file_path}: {e}", level=logging.WARNING,
+                    path=str(file_path), error=str(e))
+                yield str(file_path), file_hash, [], []
+                continue
+            metrics.inc('rag_chunks_total', len(chunks))
+            yield str(file_path), file_hash, chunks, self.chunk_ids(file_hash, chunks)
+
+    def deduplicate(self, files, ledger):
+        """
+        Drop chunks that nearly repeat a stored chunk, yielding (source, file_hash, chunks, ids, ledger_ids) where
+        ledger_ids lists the file's chunks under the ids they are stored as
+        """
+        for source, file_hash, chunks, ids in files:
+            if self.dedup is None:
+                yield source, file_hash, chunks, ids, ids
+                continue
+            with metrics.timer('dedup'):
+                stored_chunks, stored_ids, ledger_ids = self.dedup.deduplicate(source, chunks, ids, ledger)
+            metrics.inc('rag_duplicate_chunks_total', len(chunks) - len(stored_chunks))
+            yield source, file_hash, stored_chunks, stored_ids, ledger_ids
+
+    def batches(self, files):
+        """
+        Regroup the chunks of consecutive files into batches of at most upsert_batch_size chunks.
+        Yields (chunks, ids, finished), where finished lists the files whose last chunk is in this batch or earlier.
+        """
+        chunks, ids, finished = [], [], []
+        for source, file_hash, file_chunks, file_ids, ledger_ids in files:
+            for chunk, chunk_id in zip(file_chunks, file_ids):
+                chunks.append(chunk)
+                ids.append(chunk_id)
+                if len(chunks) >= self.config.upsert_batch_size:
+                    yield chunks, ids, finished
+                    chunks, ids, finished = [], [], []
+            finished.append((source, file_hash, ledger_ids))
+        if chunks or finished:
+            yield chunks, ids, finished
+
+    def unique_batches(self, batches):
+        """
+        Drop repeated ids from each batch and yield (texts, (ids, chunks, finished)) for the embedding scheduler
+        """
+        for chunks, ids, finished in batches:
+            # Identical copies of a file produce the same ids, so upsert each id once
+            unique = {}
+            for chunk, chunk_id in zip(chunks, ids):
+                unique.setdefault(chunk_id, chunk)
+            chunks = list(unique.values())
+            yield [chunk.page_content for chunk in chunks], (list(unique.keys()), chunks, finished)
+
+    @staticmethod
+    def lexical_text(text, metadata):
+        """
+        What the lexical index sees of a chunk: its path in Drive (so file and folder names match) and its text
+        """
+        return f"{(metadata or {}).get('relative_path', '')}\n{text}"
 
-    def process_and_store(self):
-        # Load all documents
-        documents = self.get_documents()
-        if not documents:
-            print("No documents were loaded")
+    def upsert_batch(self, ids, chunks, vectors):
+        """
+        Upsert an embedded batch of chunks into the collection and the lexical index
+        """
+        if not ids:
+            return
+        if self.vectors is not None:
+            self.vectors.add(ids, vectors)
+            # Chroma requires an embedding per record; a one-dimensional placeholder costs next to nothing
+            vectors = [[0.0]] * len(ids)
+        self.db._collection.upsert(
+            ids=ids,
+            embeddings=vectors,
+            metadatas=[chunk.metadata for chunk in chunks],
+            documents=[chunk.page_content for chunk in chunks]
+        )
+        self.lexical.add(ids, [self.lexical_text(chunk.page_content, chunk.metadata) for chunk in chunks])
+
+    def delete_chunks(self, ids):
+        """
+        Delete chunks from the collection and the lexical index
+        """
+        self.db.delete(ids=ids)
+        self.lexical.delete(ids)
+        if self.vectors is not None:
+            self.vectors.delete(ids)
+        if self.dedup is not None:
+            self.dedup.delete(ids)
+
+    def release_chunks(self, ledger, source, chunk_ids):
+        """
+        Detach a file from chunks it no longer has but other files still use. A chunk stored under this file's
+        metadata is handed to a file that still has it, an identical copy (which shares the chunk id) or a
+        near-duplicate, so results never cite a file that lacks the text.
+        """
+        if not chunk_ids:
+            return
+        if self.dedup is not None:
+            self.dedup.drop_aliases(source, chunk_ids)
+        found = self.db._collection.get(ids=list(chunk_ids), include=['metadatas'])
+        cited = [(chunk_id, metadata) for chunk_id, metadata in zip(found['ids'], found['metadatas'])
+                 if os.path.normpath((metadata or {}).get('source', '')) == os.path.normpath(source)]
+        copies = ledger.other_sources([chunk_id for chunk_id, _ in cited], source)
+        for chunk_id, metadata in cited:
+            replacement = self.copy_metadata(metadata, copies[chunk_id]) if chunk_id in copies else None
+            if replacement is None and self.dedup is not None:
+                alias = self.dedup.take_alias(chunk_id)
+                replacement = alias[1] if alias is not None else None
+            if replacement is not None:
+                self.db._collection.update(ids=[chunk_id], metadatas=[replacement])
+
+    def copy_metadata(self, metadata, source):
+        """
+        A chunk's metadata moved to an identical copy of its file: the copy's file metadata over the chunk's own
+        (title, pages). None if the copy's metadata is unknown.
+        """
+        try:
+            file_metadata = self.get_metadata(Path(source))
+        except Exception:
             return None
-        
-        text_splitter = CharacterTextSplitter(chunk_size=2000, chunk_overlap=300)
-        chunks = text_splitter.split_documents(documents)
-        print(f"Total number of chunks: {len(chunks)}")
-        # Adding documents to vector store
-        print(f"Adding document to Chroma vector store")
-        self.db.add_documents(documents=chunks)
+        metadata = {**metadata, **file_metadata}
+        timestamp = modified_timestamp(file_metadata)
+        if timestamp is not None:
+            metadata['modified_timestamp'] = timestamp
+        return metadata
 
+    def backfill_lexical_index(self, page_size=1000):
+        """
+        Build the lexical index from a collection that was indexed before it existed
+        """
+        offset = 0
+        while True:
+            page = self.db._collection.get(limit=page_size, offset=offset, include=['documents', 'metadatas'])
+            if not page['ids']:
+                break
+            self.lexical.add(page['ids'], [
+                self.lexical_text(text, metadata) for text, metadata in zip(page['documents'], page['metadatas'])
+            ])
+            offset += len(page['ids'])
+        log('index.backfill', f"Lexical index built for {offset} existing chunks", index='lexical', chunks=offset)
 
+    def backfill_near_duplicates(self, page_size=1000):
+        """
+        Sign the chunks of a collection indexed before near-duplicate detection, so new copies are found
+        """
+        offset = 0
+        while True:
+            page = self.db._collection.get(limit=page_size, offset=offset, include=['documents'])
+            if not page['ids']:
+                break
+            self.dedup.register(page['ids'], page['documents'])
+            offset += len(page['ids'])
+        log('index.backfill', f"Near-duplicate signatures computed for {offset} existing chunks",
+            index='near_duplicates', chunks=offset)
+
+    def finish_file(self, ledger, source, file_hash, ids):
+        """
+        Record a fully indexed file and drop chunks from its previous version that were not re-added
+        """
+        dropped = set(ledger.chunk_ids(source)) - set(ids)
+        stale_ids = ledger.unreferenced(dropped, source)
+        if stale_ids:
+            self.delete_chunks(stale_ids)
+        self.release_chunks(ledger, source, dropped - set(stale_ids))
+        ledger.record(source, file_hash, ids, self.chunker.signature)
+
+    def index_generation(self):
+        """
+        Changes whenever chunks are added to or deleted from the collection (the ledger is only rewritten then)
+        """
+        try:
+            return os.stat(self.config.ingest_ledger_file).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+    def count(self):
+        """Chunks in the collection"""
+        return self.db._collection.count()
+
+    def documents(self, ids):
+        """{chunk id: document} for stored chunks"""
+        found = self.db._collection.get(ids=list(ids), include=['documents', 'metadatas'])
+        return {
+            chunk_id: Document(page_content=text, metadata=metadata or {})
+            for chunk_id, text, metadata in zip(found['ids'], found['documents'], found['metadatas'])
+        }
+
+    def dense_search(self, embedding, k, where=None):
+        """
+        (chunk id, document, score) triples nearest to the query embedding, among chunks matching the where clause
+        """
+        results = self.db._collection.query(
+            query_embeddings=[embedding], n_results=k, where=where, include=['documents', 'metadatas', 'distances']
+        )
+        return [
+            (chunk_id, Document(page_content=text, metadata=metadata or {}), -distance)
+            for chunk_id, text, metadata, distance in zip(results['ids'][0], results['documents'][0],
+                                                          results['metadatas'][0], results['distances'][0])
+        ]
+
+    def exact_search(self, embedding, ids, k):
+        """
+        Brute-force nearest neighbours among the given chunk ids. For selective filters this beats an HNSW
+        search that has to skip over almost every node it visits.
+        """
+        found = self.db._collection.get(ids=list(ids), include=['embeddings', 'documents', 'metadatas'])
+        if not found['ids']:
+            return []
+        vectors = np.asarray(found['embeddings'], dtype=np.float32)
+        query = np.asarray(embedding, dtype=np.float32)
+        if (self.db._collection.metadata or {}).get('hnsw:space') == 'cosine':
+            distances = 1 - vectors @ query / (np.linalg.norm(vectors, axis=1) * np.linalg.norm(query) + 1e-12)
+        else:
+            distances = ((vectors - query) ** 2).sum(axis=1)
+        top = np.argsort(distances)[:k]
+        return [
+            (found['ids'][i], Document(page_content=found['documents'][i], metadata=found['metadatas'][i] or {}),
+             -float(distances[i]))
+            for i in top
+        ]
+
+    def compact_search(self, embedding, k, allowed=None):
+        """
+        (chunk id, document, score) triples nearest to the query embedding, from the compact vector store
+        """
+        hits = self.vectors.search(embedding, k, allowed)
+        if not hits:
+            return []
+        docs = self.documents(chunk_id for chunk_id, _ in hits)
+        return [(chunk_id, docs[chunk_id], score) for chunk_id, score in hits if chunk_id in docs]
+
+    def search(self, query, k=5, embedding=None, filters=None):
+        """
+        Top-k chunks for a query; pass the query embedding if it is already known to skip embedding it again.
+        With hybrid_search on, BM25 runs alongside the vector search and the two rankings are fused with
+        reciprocal-rank fusion. Of near-duplicate chunks, only the best ranked is returned.
+
+        filters (see MetadataCatalog) restrict both searches to matching files: a selective filter is resolved
+        to chunk ids through the catalog and searched exactly, a broad one is pushed into Chroma's where clause.
+        """
+        with metrics.timer('retrieve'):
+            return self.timed_search(query, k, embedding, filters)
+
+    def timed_search(self, query, k, embedding, filters):
+        if embedding is None:
+            embedding = self.embeddings.embed_query(query)
+        dense, lexical = self.candidates(query, self.candidate_count(k), embedding, filters)
+        top = self.diversify(self.fuse(dense, lexical), k)
+        docs = {chunk_id: doc for chunk_id, doc, _ in dense}
+        missing = [chunk_id for chunk_id in top if chunk_id not in docs]
+        if missing:
+            docs.update(self.documents(missing))
+        docs = self.cite({chunk_id: docs[chunk_id] for chunk_id in top if chunk_id in docs}, filters)
+        return [docs[chunk_id] for chunk_id in top if chunk_id in docs]
+
+    def candidate_count(self, k):
+        """How many candidates each search contributes for a top k"""
+        # Extra candidates stand in for results dropped as near-duplicates of better ones
+        wider = self.config.hybrid_search or self.config.near_duplicate_dedup
+        return max(k, self.config.hybrid_candidates) if wider else k
+
+    def candidates(self, query, k, embedding, filters=None, statistics=None):
+        """
+        The top k of the vector search as (chunk id, document, score) and, with hybrid_search on, of BM25 as
+        (chunk id, score), best first. Higher scores are better; vector scores are comparable between indexes,
+        and BM25 scores too when they are given the same term statistics (see LexicalIndex.statistics).
+        """
+        allowed = where = None
+        if filters:
+            allowed = self.catalog.chunk_ids(filters)
+            if not allowed:
+                return [], []
+            where = self.catalog.where(filters)
+
+        lexical = None
+        if self.config.hybrid_search:
+            lexical = self.search_pool.submit(self.lexical.search, query, k, allowed, statistics)
+        if self.vectors is not None:
+            dense = self.compact_search(embedding, k, allowed)
+        elif allowed is not None and len(allowed) <= self.config.filter_exact_search_max:
+            dense = self.exact_search(embedding, allowed, k)
+        else:
+            dense = self.dense_search(embedding, k, where)
+            shared = self.catalog.shared_chunk_ids(filters) if filters else None
+            if shared:
+                # Chunks of matching files stored under a copy elsewhere, which the where clause cannot see
+                found = {chunk_id: (chunk_id, doc, score) for chunk_id, doc, score in dense}
+                for hit in self.exact_search(embedding, shared, k):
+                    found.setdefault(hit[0], hit)
+                dense = sorted(found.values(), key=lambda hit: hit[2], reverse=True)[:k]
+        return dense, lexical.result() if lexical is not None else []
 
-        
\ No newline at end of file
+    def cite(self, docs, filters):
+        """
+        {chunk id: document} with each document citing a file that matches the filters: a chunk stored under
+        one file and listed for an identical copy or a near-duplicate among the matching files cites that one
+        """
+        if not filters:
+            return docs
+        sources = {os.path.normpath(source) for source in self.catalog.sources(filters)}
+        cited = {}
+        for chunk_id, doc in docs.items():
+            if os.path.normpath(doc.metadata.get('source', '')) not in sources:
+                for source in self.catalog.chunk_sources(chunk_id):
+                    if os.path.normpath(source) not in sources:
+                        continue
+                    metadata = self.dedup.alias_metadata(chunk_id, source) if self.dedup is not None else None
+                    metadata = metadata or self.copy_metadata(doc.metadata, source)
+                    if metadata is not None:
+                        doc = Document(page_content=doc.page_content, metadata=metadata)
+                        break
+            cited[chunk_id] = doc
+        return cited
+
+    def fuse(self, dense, lexical):
+        """
+        Chunk ids ranked by reciprocal-rank fusion of the two searches (just the vector ranking without hybrid_search)
+        """
+        dense_ranking = [chunk_id for chunk_id, _, _ in dense]
+        if not self.config.hybrid_search:
+            return dense_ranking
+        return reciprocal_rank_fusion([dense_ranking, [chunk_id for chunk_id, _ in lexical]], self.config.rrf_k)
+
+    def diversify(self, ranking, k):
+        """
+        The top k of a ranking of chunk ids, one per duplicate group
+        """
+        if self.dedup is None:
+            return ranking[:k]
+        return self.dedup.diversify(ranking, k)
+
+    def cached_vectors(self, docs):
+        """
+        The vector of each document's chunk text from the embedding cache (None where it was evicted), without
+        embedding anything
+        """
+        return self.embeddings.lookup([doc.page_content for doc in docs])[1]
+
+    def as_retriever(self, k=5, filters=None):
+        """
+        A LangChain retriever over search(), with fixed filters
+        """
+        return ChromaRetriever(chroma=self, k=k, filters=filters)
+
+    def backfill_chunk_metadata(self, page_size=1000):
+        """
+        Add the numeric modified_timestamp that date filters use to chunks indexed before it existed
+        """
+        sample = self.db._collection.get(limit=1, include=['metadatas'])
+        if not sample['ids'] or 'modified_timestamp' in (sample['metadatas'][0] or {}):
+            return
+        offset = updated = 0
+        while True:
+            page = self.db._collection.get(limit=page_size, offset=offset, include=['metadatas'])
+            if not page['ids']:
+                break
+            ids, metadatas = [], []
+            for chunk_id, metadata in zip(page['ids'], page['metadatas']):
+                timestamp = modified_timestamp(metadata or {})
+                if timestamp is not None and 'modified_timestamp' not in metadata:
+                    ids.append(chunk_id)
+                    metadatas.append({**metadata, 'modified_timestamp': timestamp})
+            if ids:
+                self.db._collection.update(ids=ids, metadatas=metadatas)
+                updated += len(ids)
+            offset += len(page['ids'])
+        log('index.backfill', f"Added modified_timestamp to {updated} existing chunks", index='modified_timestamp',
+            chunks=updated)
+
+    def process_and_store(self, parsers=None, files=None):
+        """
+        Stream new and changed files through load -> enrich -> split -> embed -> upsert in bounded batches,
+        and purge chunks of files that were changed or removed. The ledger is saved after every batch, so an
+        interrupted run resumes from the last completed batch. parsers is a ParserPool to parse in, if one
+        is shared with other runs; files are the downloaded files of this collection, if already listed.
+        """
+        ledger = IngestLedger(self.config)
+        if ledger.files and not self.lexical.exists():
+            self.backfill_lexical_index()
+        self.backfill_chunk_metadata()
+        if self.dedup is not None:
+            if ledger.files and not self.dedup.stats()['stored_chunks']:
+                self.backfill_near_duplicates()
+            self.dedup.begin_run(ledger)
+        seen = set()
+        progress = {'files': 0, 'chunks': 0}
+
+        def write(item, vectors):
+            ids, chunks, finished = item
+            # Adding documents to vector store
+            with metrics.timer('upsert'):
+                self.upsert_batch(ids, chunks, vectors)
+            metrics.inc('rag_upserted_chunks_total', len(ids))
+            progress['chunks'] += len(ids)
+            for source, file_hash, file_ids in finished:
+                self.finish_file(ledger, source, file_hash, file_ids)
+            progress['files'] += len(finished)
+            ledger.save()
+            log('index.progress', f"Indexed {progress['files']} files, {progress['chunks']} chunks so far",
+                files=progress['files'], chunks=progress['chunks'])
+
+        # Embedding requests run concurrently, and each batch is written as soon as it is embedded
+        scheduler = EmbeddingScheduler(self.embeddings, self.encoder, self.config)
+        try:
+            files = self.deduplicate(self.split_files(self.changed_files(ledger, seen, files), parsers), ledger)
+            scheduler.run(self.unique_batches(self.batches(files)), write)
+        finally:
+            ledger.save()
+
+        # Purge files that are gone from the download directory
+        removed = [source for source in ledger.files if source not in seen]
+        for source in removed:
+            stale_ids = ledger.unreferenced(ledger.chunk_ids(source), source)
+            if stale_ids:
+                self.delete_chunks(stale_ids)
+            self.release_chunks(ledger, source, set(ledger.chunk_ids(source)) - set(stale_ids))
+            ledger.remove(source)
+
+        ledger.save()
+        log('index.done', f"{len(seen) - progress['files']} files unchanged or failed, {len(removed)} files removed, "
+                          f"{progress['chunks']} chunks added to Chroma vector store",
+            unchanged_or_failed=len(seen) - progress['files'], removed=len(removed), chunks=progress['chunks'])
+        stats = self.embeddings.stats()
+        metrics.set('rag_embedding_cache_entries', stats['entries'])
+        log('embedding_cache.stats', f"Embedding cache: {stats['hits']} hits, {stats['misses']} misses "
+                                     f"({stats['hit_rate']:.0%} hit rate), {stats['entries']} cached vectors", **stats)
+
+    def pending_changes(self, files=None):
+        """
+        How many files process_and_store would index or remove: new, changed, re-chunked and deleted files
+        (of the given files, if already listed)
+        """
+        ledger = IngestLedger(self.config)
+        seen = set()
+        changed = sum(1 for _ in self.changed_files(ledger, seen, files))
+        return changed + sum(1 for source in ledger.files if source not in seen)
+
+    def unchanged_shards(self):
+        """One collection, not shards"""
+        return []
+
+    def close(self):
+        """
+        Release the collection, thread pool and cache connection of an index that is no longer served
+        """
+        self.search_pool.shutdown(wait=False)
+        if self.owns_embeddings:
+            self.embeddings.close()
+        if self.dedup is not None:
+            self.dedup.close()
+        # Chroma keeps one client system per persist directory for the life of the process
+        client = self.db._client
+        system = SharedSystemClient._identifier_to_system.pop(client._identifier, None)
+        if system is not None:
+            system.stop()